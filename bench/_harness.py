@@ -0,0 +1,303 @@
+"""
+基准测试公共工具：以包的形式加载插件模块、伪造 AstrBot 事件/上下文、统计与结果存档
+"""
+import asyncio
+import contextlib
+import importlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+PLUGIN_DIR = BENCH_DIR.parent
+RESULTS_DIR = BENCH_DIR / "results"
+PACKAGE_NAME = "astrbot_plugin_comfyui_pro"
+
+
+def load_plugin_module(name: str):
+    """把插件目录注册为包后导入其子模块（插件内部使用相对导入）"""
+    if PACKAGE_NAME not in sys.modules:
+        package = types.ModuleType(PACKAGE_NAME)
+        package.__path__ = [str(PLUGIN_DIR)]
+        package.__package__ = PACKAGE_NAME
+        sys.modules[PACKAGE_NAME] = package
+    return importlib.import_module(f"{PACKAGE_NAME}.{name}")
+
+
+@contextlib.contextmanager
+def preserved_schema():
+    """插件初始化会改写 _conf_schema.json，基准测试结束后恢复原文件"""
+    schema_path = PLUGIN_DIR / "_conf_schema.json"
+    original = schema_path.read_bytes()
+    try:
+        yield
+    finally:
+        if schema_path.read_bytes() != original:
+            schema_path.write_bytes(original)
+
+
+@contextlib.contextmanager
+def temp_data_dir(workflow_files=()):
+    """创建临时数据目录并复制工作流，期间切换工作目录，避免写入真实数据目录"""
+    tmp = Path(tempfile.mkdtemp(prefix="comfyui_bench_"))
+    (tmp / "workflow").mkdir()
+    for wf in workflow_files:
+        shutil.copy2(wf, tmp / "workflow" / Path(wf).name)
+    cwd = os.getcwd()
+    os.chdir(tmp)
+    try:
+        yield tmp
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def make_config(port: int, workflow: str = "workflow_api.json", **overrides) -> dict:
+    config = {
+        "server_address": f"127.0.0.1:{port}",
+        "workflow_settings": {"json_file": workflow, "input_node_id": "6", "output_node_id": "9"},
+        "llm_settings": {"multi_image_mode": True, "system_prompt": ""},
+        "control": {"cooldown_seconds": 0, "admin_ids": [], "default_private_policy": "lite"},
+        "output_settings": {"delivery_mode": "memory"},
+    }
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            config[key].update(value)
+        else:
+            config[key] = value
+    return config
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def start_fake_server_process(args) -> tuple:
+    """在子进程中启动 fake_comfyui.py（参数取自 add_server_arguments），返回 (进程, 端口)"""
+    import aiohttp
+
+    port = free_port()
+    cmd = [sys.executable, str(BENCH_DIR / "fake_comfyui.py"), "--port", str(port)]
+    for flag in ("latency", "jitter", "per_step", "workers", "image_kb",
+                 "submit_fail_rate", "exec_fail_rate", "max_queue", "seed"):
+        value = getattr(args, flag)
+        if value is not None:
+            cmd.extend([f"--{flag.replace('_', '-')}", str(value)])
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    url = f"http://127.0.0.1:{port}"
+    async with aiohttp.ClientSession() as session:
+        for _ in range(100):
+            try:
+                async with session.get(f"{url}/bench/stats") as resp:
+                    if resp.status == 200:
+                        return proc, port
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError("模拟服务启动超时")
+
+
+async def server_request_count(url: str, reset: bool = False) -> int:
+    """模拟服务累计收到的请求数，reset=True 时读取后清零"""
+    import aiohttp
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{url}/bench/stats") as resp:
+            stats = await resp.json()
+        if reset:
+            async with session.post(f"{url}/bench/stats/reset"):
+                pass
+    return sum(stats.get("requests", {}).values())
+
+
+class FakeContext:
+    """ComfyUIPlugin 构造与钩子执行所需的最小 Context"""
+
+    def __init__(self):
+        self.sent = []
+        self.conversation_manager = None
+
+    def activate_llm_tool(self, name):
+        pass
+
+    async def send_message(self, session, chain):
+        self.sent.append((session, chain))
+        return True
+
+
+class FakeEvent:
+    """最小化的 AstrMessageEvent 替身，记录 event.send 发出的消息"""
+
+    def __init__(self, sender_id: str = "10001", group_id: str = None, message_str: str = "",
+                 platform: str = "bench"):
+        self._sender_id = sender_id
+        self.group_id = group_id
+        self.message_type = "group" if group_id else "private"
+        self.message_str = message_str
+        self.unified_msg_origin = f"{platform}:{self.message_type}:{group_id or sender_id}"
+        self.session_id = group_id or sender_id
+        self._platform = platform
+        self._extras = {}
+        self._result = None
+        self.sent = []
+        self.streamed = []
+        self.image_count = 0
+        self.image_times = []
+        self.image_sent = None
+        self._activity = None
+
+    def get_sender_id(self):
+        return self._sender_id
+
+    def get_group_id(self):
+        return self.group_id
+
+    def get_platform_name(self):
+        return self._platform
+
+    def get_extra(self, key=None, default=None):
+        if key is None:
+            return self._extras
+        return self._extras.get(key, default)
+
+    def set_extra(self, key, value):
+        self._extras[key] = value
+
+    def plain_result(self, text):
+        from astrbot.api.event import MessageEventResult
+        return MessageEventResult().message(text)
+
+    def chain_result(self, chain):
+        from astrbot.api.event import MessageEventResult
+        result = MessageEventResult()
+        result.chain = list(chain)
+        return result
+
+    def set_result(self, result):
+        self._result = result
+
+    def get_result(self):
+        return self._result
+
+    async def send(self, result):
+        from astrbot.api.message_components import Image
+        self.sent.append(result)
+        chain = getattr(result, "chain", None) or []
+        if any(isinstance(c, Image) for c in chain):
+            self.image_count += 1
+            self.image_times.append(time.perf_counter())
+            if self.image_sent is not None and not self.image_sent.done():
+                self.image_sent.set_result(time.perf_counter())
+        if self._activity is not None:
+            self._activity.set()
+
+    async def send_streaming(self, generator, use_fallback: bool = False):
+        """消费流式分片（平台发送耗时忽略不计）"""
+        async for chain in generator:
+            self.streamed.append(chain)
+
+    async def wait_sent(self, count: int = 1, images_only: bool = False, timeout: float = 600) -> bool:
+        """等待 event.send 累计发出 count 条消息（images_only 时只计图片），超时返回 False"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while (self.image_count if images_only else len(self.sent)) < count:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            self._activity = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._activity.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+
+class FakeLLMResponse:
+    def __init__(self, text: str):
+        self.completion_text = text
+        self.result_chain = None
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * q
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def latency_summary(values) -> dict:
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else 0.0,
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "max": max(values) if values else 0.0,
+    }
+
+
+def peak_rss_mb() -> float:
+    """当前进程的峰值常驻内存（MB）"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux 单位为 KB，macOS 为字节
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+    except Exception:
+        return 0.0
+
+
+def plugin_version() -> str:
+    try:
+        for line in (PLUGIN_DIR / "metadata.yaml").read_text(encoding="utf-8").splitlines():
+            if line.startswith("version:"):
+                return line.split(":", 1)[1].strip()
+    except Exception:
+        pass
+    return "unknown"
+
+
+def git_revision() -> str:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=PLUGIN_DIR,
+            capture_output=True, text=True, timeout=10,
+        )
+        return out.stdout.strip() or "nogit"
+    except Exception:
+        return "nogit"
+
+
+def save_results(suite: str, payload: dict, label: str = None) -> Path:
+    """结果写入 bench/results/<suite>-<label>.json，label 默认为 版本-提交-时间"""
+    RESULTS_DIR.mkdir(exist_ok=True)
+    label = label or f"v{plugin_version()}-{git_revision()}-{time.strftime('%Y%m%d-%H%M%S')}"
+    payload = dict(payload, suite=suite, label=label, version=plugin_version(),
+                   revision=git_revision(), created_at=time.strftime("%Y-%m-%d %H:%M:%S"))
+    path = RESULTS_DIR / f"{suite}-{label}.json"
+    path.write_text(json.dumps(payload, indent=2, ensure_ascii=False), encoding="utf-8")
+    return path
+
+
+def load_results(path) -> dict:
+    return json.loads(Path(path).read_text(encoding="utf-8"))
+
+
+def format_delta(new: float, old: float) -> str:
+    if not old:
+        return "n/a"
+    return f"{(new - old) / old * 100:+.1f}%"
@@ -0,0 +1,181 @@
+"""
+端到端吞吐/延迟基准：驱动真实的 ComfyUI 客户端（或插件钩子链）对接本地模拟服务
+
+用法：
+    python bench/bench_e2e.py --mode client --concurrency 1,2,4,8 --jobs 16 --latency 1
+    python bench/bench_e2e.py --mode plugin --concurrency 1,4 --jobs 8 --compare bench/results/e2e-xxx.json
+
+模拟服务默认在子进程中启动，因此峰值 RSS 只统计插件侧进程。
+"""
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from _harness import (  # noqa: E402
+    PLUGIN_DIR, FakeContext, FakeEvent, FakeLLMResponse,
+    format_delta, latency_summary, load_plugin_module, load_results,
+    make_config, peak_rss_mb, preserved_schema, save_results, server_request_count,
+    start_fake_server_process, temp_data_dir,
+)
+from fake_comfyui import add_server_arguments  # noqa: E402
+
+DEFAULT_WORKFLOW = PLUGIN_DIR / "workflow" / "workflow_api.json"
+BENCH_PROMPT = "1girl, solo, smile, upper body, looking at viewer"
+
+
+async def _run_level(job_fn, jobs: int, concurrency: int) -> dict:
+    sem = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one(i):
+        nonlocal errors
+        async with sem:
+            start = time.perf_counter()
+            ok = await job_fn(i)
+            if ok:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    wall_start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(jobs)))
+    wall = time.perf_counter() - wall_start
+    return {
+        "latency": latency_summary(latencies),
+        "errors": errors,
+        "wall_seconds": wall,
+        "jobs_per_sec": len(latencies) / wall if wall else 0.0,
+    }
+
+
+def _client_job_factory(data_dir: Path, port: int, workflow: str):
+    comfyui_api = load_plugin_module("comfyui_api")
+    api = comfyui_api.ComfyUI(make_config(port, workflow), data_dir=data_dir)
+
+    async def job(i):
+        img, err = await api.generate(f"{BENCH_PROMPT}, {i}")
+        return img is not None
+
+    return job
+
+
+def _plugin_job_factory(port: int, workflow: str, timeout: float):
+    main = load_plugin_module("main")
+    plugin = main.ComfyUIPlugin(FakeContext(), make_config(port, workflow))
+
+    async def job(i):
+        from astrbot.api.event import MessageEventResult
+
+        text = f'<think>shot</think><pic prompt="{BENCH_PROMPT}, {i}">她朝你笑了笑。'
+        # 每个任务用不同用户，避免冷却影响测量
+        event = FakeEvent(sender_id=str(20000 + i))
+        event.set_result(MessageEventResult().message(text))
+        event.image_sent = asyncio.get_running_loop().create_future()
+        resp = FakeLLMResponse(text)
+
+        await plugin._extract_prompt_before_filter(event, resp)
+        await plugin._auto_paint_from_llm(event)
+        await plugin._send_multi_image_results(event)
+        try:
+            await asyncio.wait_for(event.image_sent, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    return job
+
+
+def _print_table(levels: list):
+    print(f"{'conc':>5} {'jobs/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'req/job':>8} {'err':>4} {'rss MB':>8}")
+    for lv in levels:
+        lat = lv["latency"]
+        print(
+            f"{lv['concurrency']:>5} {lv['jobs_per_sec']:>8.2f} {lat['p50']:>8.2f} {lat['p95']:>8.2f} "
+            f"{lat['p99']:>8.2f} {lv['requests_per_job']:>8.1f} {lv['errors']:>4} {lv['peak_rss_mb']:>8.1f}"
+        )
+
+
+def _print_compare(levels: list, baseline: dict):
+    old_levels = {lv["concurrency"]: lv for lv in baseline.get("levels", [])}
+    print(f"\n对比基线 {baseline.get('label')}:")
+    for lv in levels:
+        old = old_levels.get(lv["concurrency"])
+        if not old:
+            continue
+        print(
+            f"  conc={lv['concurrency']}: jobs/s {format_delta(lv['jobs_per_sec'], old['jobs_per_sec'])}, "
+            f"p50 {format_delta(lv['latency']['p50'], old['latency']['p50'])}, "
+            f"p95 {format_delta(lv['latency']['p95'], old['latency']['p95'])}, "
+            f"req/job {format_delta(lv['requests_per_job'], old['requests_per_job'])}"
+        )
+
+
+async def run(args) -> dict:
+    proc, port = await start_fake_server_process(args)
+    url = f"http://127.0.0.1:{port}"
+    workflow_path = Path(args.workflow)
+    levels = []
+    try:
+        with preserved_schema(), temp_data_dir([workflow_path]) as data_dir:
+            if args.mode == "plugin":
+                job = _plugin_job_factory(port, workflow_path.name, args.timeout)
+            else:
+                job = _client_job_factory(data_dir, port, workflow_path.name)
+
+            for concurrency in args.concurrency:
+                await server_request_count(url, reset=True)
+                result = await _run_level(job, args.jobs, concurrency)
+                requests = await server_request_count(url)
+                done = result["latency"]["count"] or 1
+                result.update(
+                    concurrency=concurrency,
+                    requests_per_job=requests / done,
+                    peak_rss_mb=peak_rss_mb(),
+                )
+                levels.append(result)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+    return {
+        "mode": args.mode,
+        "jobs": args.jobs,
+        "workflow": workflow_path.name,
+        "server": {k: getattr(args, k) for k in ("latency", "jitter", "per_step", "workers", "image_kb",
+                                                 "submit_fail_rate", "exec_fail_rate")},
+        "levels": levels,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ComfyUI 端到端基准")
+    parser.add_argument("--mode", choices=("client", "plugin"), default="client",
+                        help="client: 直接调用 ComfyUI.generate；plugin: 走 LLM 钩子链")
+    parser.add_argument("--concurrency", default="1,2,4,8",
+                        type=lambda s: [int(x) for x in s.split(",") if x.strip()])
+    parser.add_argument("--jobs", type=int, default=16, help="每个并发级别的任务数")
+    parser.add_argument("--workflow", default=str(DEFAULT_WORKFLOW))
+    parser.add_argument("--timeout", type=float, default=600, help="plugin 模式单任务超时（秒）")
+    parser.add_argument("--label", default=None, help="结果文件标签（默认 版本-提交-时间）")
+    parser.add_argument("--compare", default=None, help="与之前保存的结果文件对比")
+    parser.add_argument("--no-save", action="store_true")
+    add_server_arguments(parser)
+    parser.set_defaults(latency=1.0)
+    args = parser.parse_args()
+
+    payload = asyncio.run(run(args))
+    _print_table(payload["levels"])
+    if args.compare:
+        _print_compare(payload["levels"], load_results(args.compare))
+    if not args.no_save:
+        path = save_results(f"e2e-{args.mode}", payload, args.label)
+        print(f"\n结果已保存: {path}")
+
+
+if __name__ == "__main__":
+    main()
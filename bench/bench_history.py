@@ -0,0 +1,196 @@
+"""
+历史清理基准：模拟一段 N 轮的角色扮演对话（每隔几轮出现一次 <pic>），
+逐轮执行 discard_prompt_from_history 的两处清理，对比旧实现（每次全量解析、全量扫描、全量写回）
+与增量水位 + 延迟合并写回的耗时和数据库写入次数
+
+用法：
+    python bench/bench_history.py                      # 1000 轮，每 3 轮一张图
+    python bench/bench_history.py --turns 2000 --pic-every 1 --burst 4
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from _harness import (  # noqa: E402
+    FakeContext, FakeEvent, format_delta, free_port, load_plugin_module, load_results, make_config,
+    preserved_schema, save_results, temp_data_dir,
+)
+
+CONV_ID = "bench-conversation"
+USER_LINE = "我推开门走进了酒馆，环顾四周，寻找那个传说中的情报贩子。"
+ASSISTANT_LINE = "吧台后的老板抬起头，用下巴指了指角落里那个戴兜帽的身影。火光在她的脸上跳动。"
+
+
+def assistant_reply(turn: int, with_pic: bool) -> str:
+    text = ASSISTANT_LINE * 3
+    if with_pic:
+        text += f'<pic prompt="1girl, hood, tavern, firelight, turn {turn}">'
+    return text + ASSISTANT_LINE
+
+
+class FakeConversationManager:
+    """按 AstrBot 的方式保存历史：数据库里是列表，读取时 json.dumps 成字符串"""
+
+    def __init__(self):
+        self.content = []
+        self.writes = 0
+        self.write_bytes = 0
+
+    async def get_curr_conversation_id(self, unified_msg_origin):
+        return CONV_ID
+
+    async def get_conversation(self, unified_msg_origin, conversation_id):
+        return SimpleNamespace(cid=conversation_id, history=json.dumps(self.content))
+
+    async def update_conversation(self, unified_msg_origin, conversation_id=None, history=None, **_):
+        # 真实实现会序列化整段历史写入 SQLite
+        self.write_bytes += len(json.dumps(history))
+        self.content = history
+        self.writes += 1
+
+
+# ====== 旧实现（优化前的逻辑，作为对照）======
+def legacy_clean_req(plugin_module, conversation):
+    history = json.loads(conversation.history)
+    cleaned = 0
+    for entry in history:
+        if isinstance(entry, dict) and entry.get("role") == "assistant":
+            stripped, count = plugin_module.strip_pic_tags(entry.get("content", ""))
+            if count:
+                entry["content"] = stripped.strip()
+                cleaned += 1
+    if cleaned:
+        conversation.history = json.dumps(history, ensure_ascii=False)
+
+
+async def legacy_cleanup(plugin_module, conv_mgr, umo):
+    conv_id = await conv_mgr.get_curr_conversation_id(umo)
+    conversation = await conv_mgr.get_conversation(umo, conv_id)
+    history = json.loads(conversation.history)
+    modified = False
+    for entry in history:
+        if entry.get("role") != "assistant":
+            continue
+        cleaned, count = plugin_module.strip_pic_tags(str(entry.get("content", "")))
+        if count:
+            entry["content"] = cleaned.strip()
+            modified = True
+    if modified:
+        await conv_mgr.update_conversation(unified_msg_origin=umo, conversation_id=conv_id, history=history)
+
+
+async def simulate(mode: str, args) -> dict:
+    tag_parser = load_plugin_module("tag_parser")
+    conv_mgr = FakeConversationManager()
+    plugin = None
+    if mode == "incremental":
+        main = load_plugin_module("main")
+        ctx = FakeContext()
+        ctx.conversation_manager = conv_mgr
+        plugin = main.ComfyUIPlugin(ctx, make_config(free_port(), llm_settings={"discard_prompt_from_history": True}))
+
+    event = FakeEvent(sender_id="40001")
+    umo = event.unified_msg_origin
+    req_times, reply_times = [], []
+    for turn in range(args.turns):
+        # 请求阶段：框架从数据库读出历史（不计时），插件在发给 LLM 前清理
+        req = SimpleNamespace(system_prompt="", conversation=await conv_mgr.get_conversation(umo, CONV_ID))
+        start = time.perf_counter()
+        if plugin:
+            plugin._clean_pic_tags_from_req(req)
+        else:
+            legacy_clean_req(tag_parser, req.conversation)
+        req_times.append(time.perf_counter() - start)
+
+        # 回复阶段：框架把本轮对话追加进数据库，插件清理历史
+        with_pic = turn % args.pic_every == 0
+        conv_mgr.content = conv_mgr.content + [
+            {"role": "user", "content": USER_LINE},
+            {"role": "assistant", "content": assistant_reply(turn, with_pic)},
+        ]
+        if not with_pic:
+            continue
+        start = time.perf_counter()
+        if plugin:
+            event._comfy_extracted_prompt = "x"
+            await plugin._cleanup_history_prompts(event)
+            # 连续 burst 轮回复落在同一个延迟窗口内，窗口结束时统一写回
+            if (turn // args.pic_every + 1) % args.burst == 0:
+                await plugin._flush_history_cleanups()
+        else:
+            await legacy_cleanup(tag_parser, conv_mgr, umo)
+        reply_times.append(time.perf_counter() - start)
+
+    if plugin:
+        start = time.perf_counter()
+        await plugin._flush_history_cleanups()
+        reply_times.append(time.perf_counter() - start)
+
+    leftover = sum("<pic" in e["content"] for e in conv_mgr.content if e["role"] == "assistant")
+    tail = slice(-max(args.turns // 10, 1), None)
+    return {
+        "mode": mode,
+        "req_total_ms": sum(req_times) * 1000,
+        "req_tail_p50_ms": statistics.median(req_times[tail]) * 1000,
+        "reply_total_ms": sum(reply_times) * 1000,
+        "writes": conv_mgr.writes,
+        "write_mb": conv_mgr.write_bytes / 1024 / 1024,
+        "history_kb": len(json.dumps(conv_mgr.content)) / 1024,
+        "leftover_pics": leftover,
+    }
+
+
+async def run(args) -> dict:
+    with preserved_schema(), temp_data_dir():
+        modes = [await simulate(mode, args) for mode in ("legacy", "incremental")]
+    return {"turns": args.turns, "pic_every": args.pic_every, "burst": args.burst, "modes": modes}
+
+
+def _print(payload: dict):
+    print(f"{payload['turns']} 轮，每 {payload['pic_every']} 轮一张图，历史约 {payload['modes'][0]['history_kb']:.0f} KB")
+    print(f"{'mode':>12} {'req total':>10} {'req p50@end':>12} {'reply total':>12} {'writes':>7} {'written':>9}")
+    for m in payload["modes"]:
+        print(f"{m['mode']:>12} {m['req_total_ms']:>8.1f}ms {m['req_tail_p50_ms']:>10.3f}ms "
+              f"{m['reply_total_ms']:>10.1f}ms {m['writes']:>7} {m['write_mb']:>7.1f}MB")
+        if m["leftover_pics"]:
+            print(f"  ⚠️ {m['mode']}: 历史中仍有 {m['leftover_pics']} 条消息含 <pic>")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对话历史清理基准")
+    parser.add_argument("--turns", type=int, default=1000, help="对话轮数")
+    parser.add_argument("--pic-every", type=int, default=3, help="每隔几轮出现一次 <pic>")
+    parser.add_argument("--burst", type=int, default=3, help="落在同一个延迟写回窗口内的绘图回复数")
+    parser.add_argument("--label", default=None, help="结果文件标签（默认 版本-提交-时间）")
+    parser.add_argument("--compare", default=None, help="与之前保存的结果文件对比")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+    args.pic_every = max(args.pic_every, 1)
+    args.burst = max(args.burst, 1)
+
+    payload = asyncio.run(run(args))
+    _print(payload)
+    old, new = payload["modes"]
+    print(f"\n增量清理：请求阶段 {format_delta(new['req_total_ms'], old['req_total_ms'])}，"
+          f"回复阶段 {format_delta(new['reply_total_ms'], old['reply_total_ms'])}，"
+          f"写入 {old['writes']} -> {new['writes']} 次")
+
+    if args.compare:
+        baseline = load_results(args.compare)
+        base = baseline["modes"][1]
+        print(f"对比基线 {baseline.get('label')}: 请求阶段 {format_delta(new['req_total_ms'], base['req_total_ms'])}，"
+              f"回复阶段 {format_delta(new['reply_total_ms'], base['reply_total_ms'])}")
+    if not args.no_save:
+        path = save_results("history", payload, args.label)
+        print(f"\n结果已保存: {path}")
+
+
+if __name__ == "__main__":
+    main()
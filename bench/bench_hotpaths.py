@@ -0,0 +1,428 @@
+"""
+CPU 热点微基准：提示词提取、敏感词匹配、工作流参数注入
+
+覆盖 _extract_prompt_before_filter 的标签解析、_find_sensitive_words、_build_policy_patterns（及加载缓存）、
+ComfyUI._inject_params 与 _apply_steps_override（workflow/ 下的每个工作流 + 合成的 500 节点工作流）。
+输入包含常规与对抗性样本：50KB 含大量 <pic>/<think> 的 LLM 回复、未闭合标签、完整 sensitive_words.json。
+
+用法：
+    python bench/bench_hotpaths.py                       # 运行并按 hotpath_thresholds.json 检查
+    python bench/bench_hotpaths.py -k sensitive          # 只跑名称包含 sensitive 的用例
+    python bench/bench_hotpaths.py --compare bench/results/hotpaths-xxx.json
+    python bench/bench_hotpaths.py --update-thresholds   # 以本机结果 × headroom 重写阈值
+
+任一用例的中位耗时超过阈值（或比 --compare 基线慢 --max-regression 以上）时退出码为 1。
+"""
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from _harness import (  # noqa: E402
+    BENCH_DIR, PLUGIN_DIR, FakeContext, FakeEvent, FakeLLMResponse,
+    format_delta, load_plugin_module, load_results, make_config,
+    preserved_schema, save_results, temp_data_dir,
+)
+
+THRESHOLDS_FILE = BENCH_DIR / "hotpath_thresholds.json"
+# 插件配置默认值（完整版/精简版系统提示词），在插件改写 schema 之前读取
+SCHEMA_DEFAULTS = json.loads((PLUGIN_DIR / "_conf_schema.json").read_text(encoding="utf-8"))
+SYNTHETIC_WORKFLOW = "bench_synthetic_500.json"
+REPLY_BYTES = 50 * 1024
+
+TAGS = (
+    "1girl", "solo", "long hair", "smile", "looking at viewer", "upper body", "school uniform",
+    "outdoors", "cherry blossoms", "blue sky", "masterpiece", "best quality", "detailed eyes",
+    "(light particles:1.2)", "[depth of field]", "night", "city lights", "from side", "wind",
+)
+NARRATION = (
+    "她轻轻抬起头，目光越过你的肩膀望向远处。", "街灯一盏接一盏亮起来，", "风把她的头发吹得有些乱。",
+    "“你来得正好。”她笑着说，", "空气里有雨后泥土的味道。", "The train pulled in right on time, ",
+    "and nobody seemed to notice the sky turning orange. ",
+)
+
+
+# ====== 计时 ======
+def measure(fn, setup=None, rounds: int = 30, warmup: int = 3, max_time: float = 5.0) -> dict:
+    """
+    重复执行 fn 并统计耗时（毫秒），setup 的返回值作为 fn 的参数且不计入耗时
+    总耗时超过 max_time 后提前结束（至少保留 5 轮）
+    """
+    for _ in range(warmup):
+        fn(*(setup() if setup else ()))
+
+    samples = []
+    deadline = time.perf_counter() + max_time
+    for i in range(rounds):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        fn(*args)
+        samples.append((time.perf_counter() - start) * 1000)
+        if i >= 4 and time.perf_counter() > deadline:
+            break
+
+    return {
+        "rounds": len(samples),
+        "min_ms": min(samples),
+        "median_ms": statistics.median(samples),
+        "mean_ms": statistics.fmean(samples),
+        "stddev_ms": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "max_ms": max(samples),
+    }
+
+
+# ====== 输入构造 ======
+def _prompt(rng: random.Random, n_tags: int = 12) -> str:
+    return ", ".join(rng.sample(TAGS, min(n_tags, len(TAGS))))
+
+
+def _sd_prompt(rng: random.Random, n_tags: int = 24) -> str:
+    """带权重、括号、转义、下划线和 lora 的 SD 语法提示词"""
+    tags = []
+    for tag in rng.sample(TAGS, min(n_tags, len(TAGS))):
+        tag = tag.replace(" ", "_") if rng.random() < 0.5 else tag
+        roll = rng.random()
+        if roll < 0.3:
+            tag = f"({tag}:{rng.uniform(0.5, 1.5):.2f})"
+        elif roll < 0.45:
+            tag = f"[{tag}]"
+        elif roll < 0.55:
+            tag = f"{tag} \\(style\\)"
+        tags.append(tag)
+    tags.append("<lora:detail_tweaker:0.6>")
+    return ", ".join(tags)
+
+
+def _narration(rng: random.Random, size: int) -> str:
+    parts, total = [], 0
+    while total < size:
+        s = rng.choice(NARRATION)
+        parts.append(s)
+        total += len(s.encode("utf-8"))
+    return "".join(parts)
+
+
+def build_reply(rng: random.Random, n_pics: int, n_thinks: int, size: int = REPLY_BYTES,
+                render: bool = True) -> str:
+    """由旁白、<think>、<pic prompt="..."> 交错组成、约 size 字节的 LLM 回复"""
+    blocks = []
+    for _ in range(n_thinks):
+        blocks.append(f"<think>{_narration(rng, 300)}</think>")
+    for _ in range(n_pics):
+        blocks.append(f'<pic prompt="{_prompt(rng)}">')
+    rng.shuffle(blocks)
+
+    fixed = sum(len(b.encode("utf-8")) for b in blocks)
+    filler = max(size - fixed, 0) // (len(blocks) + 1)
+    out = ["<render theme=\"dark\">"] if render else []
+    for block in blocks:
+        out.append(f"<ctx>{_narration(rng, filler)}</ctx>")
+        out.append(block)
+    out.append(_narration(rng, filler))
+    if render:
+        out.append("</render>")
+    return "".join(out)
+
+
+def build_unclosed_reply(rng: random.Random, size: int = REPLY_BYTES, final_pic: bool = True) -> str:
+    """对抗样本：大量未闭合的 <think> 与 <pic prompt=" ，final_pic 时末尾只有一张合法的图"""
+    out, total = [], 0
+    while total < size:
+        chunk = rng.choice(("<think>", '<pic prompt="', "<ctx>", "<render>")) + _narration(rng, 200)
+        out.append(chunk)
+        total += len(chunk.encode("utf-8"))
+    if final_pic:
+        out.append(f'<pic prompt="{_prompt(rng)}">')
+    return "".join(out)
+
+
+def ascii_terms(lexicon: dict) -> list:
+    terms = []
+    for words in lexicon.values():
+        if isinstance(words, list):
+            terms.extend(w for w in words if w and all(ord(c) < 128 for c in w))
+    return sorted(set(terms))
+
+
+def build_sensitive_text(rng: random.Random, terms: list, mode: str, size: int = REPLY_BYTES) -> str:
+    """
+    clean: 只有普通提示词；near_miss: 敏感词嵌在更长的单词里（不应命中，但会触发大量回溯）；
+    dense: 每隔几个标签插入一个真实敏感词
+    """
+    out, total = [], 0
+    while total < size:
+        if mode == "near_miss":
+            word = rng.choice(terms).replace(" ", "_")
+            tag = f"x{word}y"
+        elif mode == "dense" and rng.random() < 0.2:
+            tag = rng.choice(terms)
+        else:
+            tag = rng.choice(TAGS)
+        out.append(tag)
+        total += len(tag) + 2
+    return ", ".join(out)
+
+
+def build_large_workflow(n_nodes: int = 500, n_param_breaks: int = 20) -> tuple:
+    """合成大型 API 工作流：若干 ParameterBreak + 引用它们的采样器链，返回 (workflow, steps 覆盖)"""
+    wf = {
+        "1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "model.safetensors"}},
+        "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "", "clip": ["1", 1]}},
+        "7": {"class_type": "CLIPTextEncode", "inputs": {"text": "lowres, bad anatomy", "clip": ["1", 1]}},
+        "5": {"class_type": "EmptyLatentImage", "inputs": {"width": 768, "height": 1024, "batch_size": 1}},
+    }
+    pb_ids = []
+    for i in range(n_param_breaks):
+        nid = str(1000 + i)
+        pb_ids.append(nid)
+        wf[nid] = {"class_type": "ParameterBreak", "inputs": {"steps": 20, "cfg": 7.0}}
+
+    nid = 2000
+    latent = ["5", 0]
+    while len(wf) < n_nodes - 2:
+        kind = nid % 4
+        key = str(nid)
+        if kind == 0:
+            wf[key] = {"class_type": "KSampler", "inputs": {
+                "seed": 1, "steps": [pb_ids[nid % len(pb_ids)], 0], "cfg": 7.0,
+                "sampler_name": "euler", "scheduler": "normal", "denoise": 1.0,
+                "model": ["1", 0], "positive": ["6", 0], "negative": ["7", 0], "latent_image": latent,
+            }}
+            latent = [key, 0]
+        elif kind == 1:
+            wf[key] = {"class_type": "KSamplerAdvanced", "inputs": {
+                "noise_seed": 1, "steps_total": [pb_ids[nid % len(pb_ids)], 0], "cfg": 7.0,
+                "model": ["1", 0], "positive": ["6", 0], "negative": ["7", 0], "latent_image": latent,
+            }}
+            latent = [key, 0]
+        elif kind == 2:
+            wf[key] = {"class_type": "LatentUpscaleBy", "inputs": {
+                "upscale_method": "nearest-exact", "scale_by": 1.0, "samples": latent,
+            }}
+            latent = [key, 0]
+        else:
+            wf[key] = {"class_type": "PrimitiveNode", "inputs": {"value": nid, "label": f"note {nid}"}}
+        nid += 1
+
+    wf["8"] = {"class_type": "VAEDecode", "inputs": {"samples": latent, "vae": ["1", 2]}}
+    wf["9"] = {"class_type": "SaveImage", "inputs": {"images": ["8", 0], "filename_prefix": "bench"}}
+    overrides = {pb: 12 + i % 3 for i, pb in enumerate(pb_ids[::2])}
+    return wf, overrides
+
+
+def _find_param_breaks(workflow: dict) -> dict:
+    return {
+        str(nid): 12 for nid, node in workflow.items()
+        if isinstance(node, dict) and node.get("class_type") == "ParameterBreak"
+    }
+
+
+# ====== 用例 ======
+def build_cases(plugin, rng: random.Random, data_dir: Path, loop) -> list:
+    """返回 [(名称, fn, setup)]"""
+    cases = []
+
+    def extract(text):
+        def setup():
+            event = FakeEvent(sender_id="10001")
+            return event, FakeLLMResponse(text)
+
+        def run(event, resp):
+            loop.run_until_complete(plugin._extract_prompt_before_filter(event, resp))
+        return run, setup
+
+    replies = {
+        "extract.realistic_4kb": build_reply(rng, n_pics=3, n_thinks=2, size=4 * 1024),
+        "extract.50kb_200pics_100thinks": build_reply(rng, n_pics=200, n_thinks=100),
+        "extract.50kb_no_pics": build_reply(rng, n_pics=0, n_thinks=50, render=False),
+        "extract.50kb_unclosed_tags": build_unclosed_reply(rng),
+        "extract.50kb_never_closed": build_unclosed_reply(rng, final_pic=False),
+    }
+    for name, text in replies.items():
+        cases.append((name, *extract(text)))
+
+    # 人设提示词已有 8KB 时注入绘图提示词（含重复注入判断）
+    persona = _narration(rng, 8 * 1024)
+
+    def inject_prompt_setup():
+        return FakeEvent(sender_id="10001"), SimpleNamespace(system_prompt=persona, conversation=None)
+
+    cases.append(("inject_prompt.persona_8kb",
+                  lambda event, req: loop.run_until_complete(plugin.inject_system_prompt(event, req)),
+                  inject_prompt_setup))
+
+    terms = ascii_terms(plugin.lexicon)
+    private_event = FakeEvent(sender_id="10001")  # 私聊，使用 default_private_policy=lite
+    for mode in ("clean", "near_miss", "dense"):
+        text = build_sensitive_text(rng, terms, mode)
+        cases.append((f"sensitive.full.{mode}_50kb", lambda t=text: plugin._find_sensitive_words(t), None))
+        cases.append((f"sensitive.lite.{mode}_50kb",
+                      lambda t=text: plugin._find_sensitive_words(t, private_event), None))
+    short = _prompt(rng)
+    cases.append(("sensitive.full.single_prompt", lambda: plugin._find_sensitive_words(short), None))
+    sd = _sd_prompt(rng)
+    cases.append(("sensitive.full.sd_syntax_prompt", lambda: plugin._find_sensitive_words(sd), None))
+    cases.append(("sensitive.build_policy_patterns", plugin._build_policy_patterns, None))
+    cases.append(("sensitive.load_cached_matchers", plugin._load_policy_matchers, None))
+
+    api = plugin.api
+    workflow_dir = data_dir / "workflow"
+    for wf_path in sorted(workflow_dir.glob("*.json")):
+        if wf_path.name.endswith((".steps.json", ".compiled.json")):
+            continue
+        raw = wf_path.read_text(encoding="utf-8")
+        workflow = json.loads(raw)
+        overrides = json.loads((wf_path.parent / f"{wf_path.stem}.steps.json").read_text(encoding="utf-8")) \
+            if (wf_path.parent / f"{wf_path.stem}.steps.json").exists() else _find_param_breaks(workflow)
+        input_id = "6" if "6" in workflow else next(iter(workflow))
+
+        def inject(wf, name=wf_path.name, input_id=input_id):
+            api.wf_filename = name
+            api.workflow_path = workflow_dir / name
+            api.input_id = input_id
+            api._inject_params(wf, short)
+
+        stem = wf_path.stem
+        cases.append((f"inject_params.{stem}", inject, lambda raw=raw: (json.loads(raw),)))
+        cases.append((f"steps_override.{stem}",
+                      lambda wf, o=overrides: api._apply_steps_override(wf, o),
+                      lambda w=workflow: (copy.deepcopy(w),)))
+    return cases
+
+
+def prepare_data_dir(data_dir: Path):
+    """写入合成的 500 节点工作流及其 steps 覆盖 sidecar"""
+    workflow, overrides = build_large_workflow()
+    wf_dir = data_dir / "workflow"
+    (wf_dir / SYNTHETIC_WORKFLOW).write_text(json.dumps(workflow), encoding="utf-8")
+    (wf_dir / f"{Path(SYNTHETIC_WORKFLOW).stem}.steps.json").write_text(
+        json.dumps({k: {"steps": v} for k, v in overrides.items()}), encoding="utf-8"
+    )
+
+
+# ====== 阈值与输出 ======
+def load_thresholds() -> dict:
+    if THRESHOLDS_FILE.exists():
+        return json.loads(THRESHOLDS_FILE.read_text(encoding="utf-8"))
+    return {"headroom": 3.0, "cases": {}}
+
+
+def check(results: dict, thresholds: dict, baseline: dict = None, max_regression: float = 0.25) -> list:
+    failures = []
+    budgets = thresholds.get("cases", {})
+    old = (baseline or {}).get("cases", {})
+    for name, stats in results.items():
+        budget = budgets.get(name, {}).get("max_median_ms")
+        if budget is not None and stats["median_ms"] > budget:
+            failures.append(f"{name}: 中位 {stats['median_ms']:.3f}ms 超过阈值 {budget}ms")
+        prev = old.get(name)
+        if prev and stats["median_ms"] > prev["median_ms"] * (1 + max_regression):
+            failures.append(
+                f"{name}: 中位 {stats['median_ms']:.3f}ms 比基线慢 "
+                f"{format_delta(stats['median_ms'], prev['median_ms'])}"
+            )
+    return failures
+
+
+def update_thresholds(results: dict, thresholds: dict):
+    headroom = float(thresholds.get("headroom", 3.0))
+    cases = thresholds.setdefault("cases", {})
+    for name, stats in results.items():
+        # 亚毫秒级用例计时噪声大，设置 0.05ms 的下限
+        cases[name] = {"max_median_ms": round(max(stats["median_ms"] * headroom, 0.05), 3)}
+    thresholds["cases"] = dict(sorted(cases.items()))
+    THRESHOLDS_FILE.write_text(json.dumps(thresholds, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
+
+
+def print_table(results: dict, thresholds: dict):
+    budgets = thresholds.get("cases", {})
+    width = max(len(n) for n in results) if results else 10
+    print(f"{'case':<{width}} {'rounds':>6} {'min':>9} {'median':>9} {'mean':>9} {'stddev':>9} {'budget':>9}")
+    for name, s in results.items():
+        budget = budgets.get(name, {}).get("max_median_ms")
+        print(
+            f"{name:<{width}} {s['rounds']:>6} {s['min_ms']:>9.3f} {s['median_ms']:>9.3f} "
+            f"{s['mean_ms']:>9.3f} {s['stddev_ms']:>9.3f} {budget if budget is not None else '-':>9}"
+        )
+    print("（单位：毫秒）")
+
+
+def run(args) -> dict:
+    rng = random.Random(args.seed)
+    results = {}
+    astrbot_logger = logging.getLogger("astrbot")
+
+    with preserved_schema(), temp_data_dir(sorted((PLUGIN_DIR / "workflow").glob("*.json"))):
+        # 导入 astrbot 会在当前目录创建 data/，必须在切换到临时目录之后
+        main = load_plugin_module("main")
+        prompts = {k: SCHEMA_DEFAULTS["llm_settings"]["items"][k]["default"]
+                   for k in ("system_prompt", "compact_system_prompt")}
+        plugin = main.ComfyUIPlugin(FakeContext(), make_config(8188, llm_settings=prompts))
+        if plugin.api is None:
+            raise RuntimeError("ComfyUI API 初始化失败")
+        # 合成工作流要放进插件实际使用的数据目录，工作流索引才能找到它的 steps 覆盖
+        prepare_data_dir(plugin.data_dir)
+        # 词库平时在后台预热时加载，这里直接加载
+        plugin._ensure_sensitive_words()
+
+        loop = asyncio.new_event_loop()
+        cases = build_cases(plugin, rng, plugin.data_dir, loop)
+        level = astrbot_logger.level
+        # 热点里有 info 日志，基准期间只保留错误输出
+        astrbot_logger.setLevel(logging.ERROR)
+        try:
+            for name, fn, setup in cases:
+                if args.k and args.k not in name:
+                    continue
+                results[name] = measure(fn, setup, rounds=args.rounds, max_time=args.max_time)
+        finally:
+            astrbot_logger.setLevel(level)
+            loop.close()
+
+    return {"seed": args.seed, "rounds": args.rounds, "cases": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU 热点微基准")
+    parser.add_argument("-k", default=None, help="只运行名称包含该子串的用例")
+    parser.add_argument("--rounds", type=int, default=30)
+    parser.add_argument("--max-time", type=float, default=5.0, help="单个用例的最长计时时间（秒）")
+    parser.add_argument("--seed", type=int, default=1234, help="输入生成的随机种子")
+    parser.add_argument("--compare", default=None, help="与之前保存的结果对比，超过 --max-regression 视为退化")
+    parser.add_argument("--max-regression", type=float, default=0.25)
+    parser.add_argument("--update-thresholds", action="store_true", help="按本次结果 × headroom 重写阈值文件")
+    parser.add_argument("--label", default=None)
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+
+    payload = run(args)
+    thresholds = load_thresholds()
+    if args.update_thresholds:
+        update_thresholds(payload["cases"], thresholds)
+        print(f"阈值已更新: {THRESHOLDS_FILE}")
+
+    print_table(payload["cases"], thresholds)
+    if not args.no_save:
+        print(f"\n结果已保存: {save_results('hotpaths', payload, args.label)}")
+
+    baseline = load_results(args.compare) if args.compare else None
+    failures = check(payload["cases"], thresholds, baseline, args.max_regression)
+    if failures:
+        print("\n❌ 性能退化:")
+        for line in failures:
+            print(f"  - {line}")
+        sys.exit(1)
+    print("\n✅ 所有用例均在阈值内")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+模型驻留基准：切换工作流后第一张图的耗时、空闲卸载
+
+模拟服务开启 --load-time：任务用到的模型不在“显存”中时追加加载耗时，/free 后清空。
+每轮：在工作流 A 上出一张图 -> /comfy_use 切换到换了模型的工作流 B -> 等待 gap 秒（管理员切换后用户来画图的间隔）
+-> 在 B 上出第一张图、第二张图。分别在关闭 / 开启 model_residency 时运行，
+开启时另外检查空闲超时后是否调用了 /free。
+
+用法：
+    python bench/bench_residency.py                       # 加载 3s、执行 0.3s、间隔 5s，各 3 轮
+    python bench/bench_residency.py --load-time 8 --gap 10 --rounds 5 --compare bench/results/residency-xxx.json
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from _harness import (  # noqa: E402
+    PLUGIN_DIR, FakeContext, format_delta, load_plugin_module, load_results, make_config, preserved_schema,
+    save_results, temp_data_dir,
+)
+from fake_comfyui import start_server  # noqa: E402
+
+WORKFLOW_A = "workflow_api.json"
+WORKFLOW_B = "bench_residency_b.json"
+PROMPT = "1girl, smile, looking at viewer, cherry blossoms"
+
+
+def _prepare_workflow_b(data_dir: Path):
+    """复制默认工作流并换一个模型名，切换时需要重新加载"""
+    workflow = json.loads((data_dir / "workflow" / WORKFLOW_A).read_text(encoding="utf-8"))
+    for node in workflow.values():
+        if "ckpt_name" in node.get("inputs", {}):
+            node["inputs"]["ckpt_name"] = "bench_other_model.safetensors"
+    (data_dir / "workflow" / WORKFLOW_B).write_text(json.dumps(workflow), encoding="utf-8")
+
+
+async def _timed_generate(api) -> float:
+    start = time.perf_counter()
+    img, err = await api.generate(PROMPT)
+    if not img:
+        raise RuntimeError(f"生成失败: {err}")
+    return time.perf_counter() - start
+
+
+async def run_round(port: int, fake, residency: bool, gap: float) -> dict:
+    main = load_plugin_module("main")
+    config = make_config(port, model_residency={
+        "enabled": residency, "warm_up_on_startup": False, "idle_free_minutes": 0,
+    })
+    plugin = main.ComfyUIPlugin(FakeContext(), config)
+    await plugin.initialize()
+    _prepare_workflow_b(plugin.data_dir)
+    api = plugin.api
+    try:
+        api.reload_config(WORKFLOW_A)
+        warm_a = api.residency.warming if residency else False
+        if warm_a:
+            await api.residency._warm_task
+        await _timed_generate(api)
+        loads_before = fake.model_loads
+
+        api.reload_config(WORKFLOW_B)
+        await asyncio.sleep(gap)
+        first = await _timed_generate(api)
+        second = await _timed_generate(api)
+        result = {"first_ms": first * 1000, "second_ms": second * 1000,
+                  "model_loads": fake.model_loads - loads_before, "freed": None}
+
+        if residency:
+            # 空闲卸载：把空闲时长调到 0.5s，直接执行一次检查
+            api.residency.idle_free_seconds = 0.5
+            await asyncio.sleep(0.6)
+            result["freed"] = await api.residency._maybe_free() and not fake.loaded_models
+    finally:
+        await plugin.terminate()
+    return result
+
+
+async def run(args) -> dict:
+    runner, port, fake = await start_server(latency=args.latency, load_time=args.load_time)
+    scenarios = []
+    try:
+        with preserved_schema():
+            for residency in (False, True):
+                rounds = []
+                for _ in range(args.rounds):
+                    fake.loaded_models = set()
+                    with temp_data_dir(sorted((PLUGIN_DIR / "workflow").glob("*.json"))):
+                        rounds.append(await run_round(port, fake, residency, args.gap))
+                scenarios.append({
+                    "scenario": "residency" if residency else "baseline",
+                    "rounds": len(rounds),
+                    "first_ms": statistics.median(r["first_ms"] for r in rounds),
+                    "second_ms": statistics.median(r["second_ms"] for r in rounds),
+                    "model_loads": sum(r["model_loads"] for r in rounds),
+                    "freed": [r["freed"] for r in rounds] if residency else None,
+                })
+    finally:
+        await runner.cleanup()
+    return {"load_time": args.load_time, "latency": args.latency, "gap": args.gap, "scenarios": scenarios}
+
+
+def _print(payload: dict):
+    print(f"模型加载 {payload['load_time']:g}s · 执行 {payload['latency']:g}s · 切换后 {payload['gap']:g}s 出图")
+    print(f"{'scenario':>10} {'切换后首图':>10} {'第二张':>9} {'加载次数':>8} {'空闲卸载':>8}")
+    for s in payload["scenarios"]:
+        freed = "-" if s["freed"] is None else f"{sum(bool(f) for f in s['freed'])}/{s['rounds']}"
+        print(f"{s['scenario']:>10} {s['first_ms']:>10.0f}ms {s['second_ms']:>7.0f}ms {s['model_loads']:>8} {freed:>8}")
+    print("（耗时为各轮中位数；加载次数为切换后模型加载的总次数，开启驻留时由预热任务承担）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模型驻留基准")
+    parser.add_argument("--load-time", type=float, default=3.0, help="模拟的模型加载耗时（秒）")
+    parser.add_argument("--latency", type=float, default=0.3, help="模拟的单次执行耗时（秒）")
+    parser.add_argument("--gap", type=float, default=5.0, help="切换工作流到第一次出图的间隔（秒）")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--label", default=None, help="结果文件标签（默认 版本-提交-时间）")
+    parser.add_argument("--compare", default=None, help="与之前保存的结果文件对比")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+
+    payload = asyncio.run(run(args))
+    _print(payload)
+
+    if args.compare:
+        baseline = {s["scenario"]: s for s in load_results(args.compare)["scenarios"]}
+        print(f"\n对比基线:")
+        for s in payload["scenarios"]:
+            base = baseline.get(s["scenario"])
+            if base:
+                print(f"  {s['scenario']}: 切换后首图 {format_delta(s['first_ms'], base['first_ms'])}")
+    if not args.no_save:
+        path = save_results("residency", payload, args.label)
+        print(f"\n结果已保存: {path}")
+
+
+if __name__ == "__main__":
+    main()
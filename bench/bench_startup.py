@@ -0,0 +1,135 @@
+"""
+启动耗时基准：插件构造（__init__）、initialize()、以及后台预热完成（可以按完整状态处理请求）的耗时，
+并统计每次加载是否改写了 _conf_schema.json
+
+两种场景：
+    first_install  每轮使用全新的数据目录（复制默认文件、首次编译敏感词匹配器）
+    restart        同一个数据目录反复加载（插件重载 / AstrBot 重启）
+
+第一轮单独列出：进程内第一次加载要承担模块导入和框架查找数据目录等一次性开销
+
+用法：
+    python bench/bench_startup.py                   # 每个场景 10 轮
+    python bench/bench_startup.py --rounds 30 --compare bench/results/startup-xxx.json
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from _harness import (  # noqa: E402
+    PLUGIN_DIR, FakeContext, FakeEvent, format_delta, load_plugin_module, load_results, make_config,
+    preserved_schema, save_results, temp_data_dir,
+)
+from fake_comfyui import start_server  # noqa: E402
+
+SCHEMA_PATH = PLUGIN_DIR / "_conf_schema.json"
+WORKFLOWS = sorted((PLUGIN_DIR / "workflow").glob("*.json"))
+PROBE_TEXT = "1girl, smile, looking at viewer, cherry blossoms"
+
+
+def _schema_stamp():
+    st = SCHEMA_PATH.stat()
+    return st.st_mtime_ns, st.st_size
+
+
+async def load_once(port: int) -> dict:
+    """加载一次插件：构造 -> initialize -> 等待后台预热 -> 第一次敏感词检查"""
+    main = load_plugin_module("main")
+    config = make_config(port)
+    config["control"]["default_private_policy"] = "full"
+    stamp = _schema_stamp()
+
+    start = time.perf_counter()
+    plugin = main.ComfyUIPlugin(FakeContext(), config)
+    constructed = time.perf_counter()
+    await plugin.initialize()
+    initialized = time.perf_counter()
+    # 第一次检查：预热未完成时由请求路径同步加载
+    plugin._find_sensitive_words(PROBE_TEXT, FakeEvent(sender_id="50001"))
+    first_check = time.perf_counter() - initialized
+    warmup = getattr(plugin, "_warmup_task", None)
+    if warmup is not None:
+        await warmup
+    ready = time.perf_counter()
+
+    schema_written = _schema_stamp() != stamp
+    await plugin.terminate()
+    return {
+        "init_ms": (constructed - start) * 1000,
+        "initialize_ms": (initialized - constructed) * 1000,
+        "first_check_ms": first_check * 1000,
+        "ready_ms": (ready - start) * 1000,
+        "schema_written": schema_written,
+    }
+
+
+def _summarize(name: str, rounds: list) -> dict:
+    rest = rounds[1:] or rounds
+    summary = {"scenario": name, "rounds": len(rounds), "first": rounds[0]}
+    for key in ("init_ms", "initialize_ms", "first_check_ms", "ready_ms"):
+        summary[key] = statistics.median(r[key] for r in rest)
+    summary["schema_writes"] = sum(r["schema_written"] for r in rounds)
+    return summary
+
+
+async def run(args) -> dict:
+    runner, port, _ = await start_server(latency=0.1)
+    scenarios = []
+    try:
+        with preserved_schema():
+            # 重启场景：同一个数据目录反复加载
+            with temp_data_dir(WORKFLOWS):
+                rounds = [await load_once(port) for _ in range(args.rounds)]
+            scenarios.append(_summarize("restart", rounds))
+            # 首次安装：每轮新建数据目录
+            rounds = []
+            for _ in range(args.rounds):
+                with temp_data_dir(WORKFLOWS):
+                    rounds.append(await load_once(port))
+            scenarios.append(_summarize("first_install", rounds))
+    finally:
+        await runner.cleanup()
+    return {"rounds": args.rounds, "scenarios": scenarios}
+
+
+def _print(payload: dict):
+    print(f"{'scenario':>14} {'1st init':>9} {'init':>8} {'initialize':>11} {'1st check':>10} {'ready':>8} {'schema writes':>14}")
+    for s in payload["scenarios"]:
+        print(f"{s['scenario']:>14} {s['first']['init_ms']:>7.1f}ms {s['init_ms']:>6.1f}ms {s['initialize_ms']:>9.2f}ms "
+              f"{s['first_check_ms']:>8.2f}ms {s['ready_ms']:>6.1f}ms {s['schema_writes']:>8}/{s['rounds']}")
+    print("（除 1st init 外均为第 2 轮起的中位数；ready 为构造开始到后台预热完成）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="插件启动耗时基准")
+    parser.add_argument("--rounds", type=int, default=10, help="每个场景的加载次数")
+    parser.add_argument("--label", default=None, help="结果文件标签（默认 版本-提交-时间）")
+    parser.add_argument("--compare", default=None, help="与之前保存的结果文件对比")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+    args.rounds = max(args.rounds, 2)
+
+    payload = asyncio.run(run(args))
+    _print(payload)
+
+    if args.compare:
+        baseline = {s["scenario"]: s for s in load_results(args.compare)["scenarios"]}
+        print(f"\n对比基线:")
+        for s in payload["scenarios"]:
+            base = baseline.get(s["scenario"])
+            if base:
+                print(f"  {s['scenario']}: init {format_delta(s['init_ms'], base['init_ms'])}，"
+                      f"ready {format_delta(s['ready_ms'], base['ready_ms'])}，"
+                      f"schema 写入 {base['schema_writes']} -> {s['schema_writes']}")
+    if not args.no_save:
+        path = save_results("startup", payload, args.label)
+        print(f"\n结果已保存: {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+流式提前出图基准：模拟 LLM 按固定速度流式输出带多个 <pic> 的回复，
+分别在关闭/开启 llm_settings.streaming_early_dispatch 时测量每张图从回复开始到发出的耗时
+
+用法：
+    python bench/bench_streaming.py                              # 默认 3 张图、回复流式输出约 6 秒
+    python bench/bench_streaming.py --pics 1 --stream-seconds 10 --latency 3
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from _harness import (  # noqa: E402
+    PLUGIN_DIR, FakeContext, FakeEvent, FakeLLMResponse, format_delta, load_plugin_module,
+    load_results, make_config, preserved_schema, save_results, start_fake_server_process, temp_data_dir,
+)
+from fake_comfyui import add_server_arguments  # noqa: E402
+
+DEFAULT_WORKFLOW = PLUGIN_DIR / "workflow" / "workflow_api.json"
+PARAGRAPH = "她停下脚步，回头看了你一眼，晚风把她的发梢吹得有些乱。"
+
+
+def build_reply(pics: int) -> str:
+    """文字与 <pic> 交替，<pic> 均匀分布在回复中"""
+    out = []
+    for i in range(pics):
+        out.append(PARAGRAPH * 4)
+        out.append(f'<think>镜头 {i + 1}</think><pic prompt="1girl, solo, evening, wind, shot {i + 1}">')
+    out.append(PARAGRAPH * 4)
+    return "".join(out)
+
+
+async def stream_chunks(text: str, seconds: float, chunk_chars: int):
+    from astrbot.core.message.message_event_result import MessageChain
+
+    chunks = [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)]
+    delay = seconds / max(len(chunks), 1)
+    for chunk in chunks:
+        await asyncio.sleep(delay)
+        yield MessageChain().message(chunk)
+
+
+async def one_reply(plugin, reply: str, args, user: int) -> dict:
+    from astrbot.api.event import MessageEventResult
+
+    event = FakeEvent(sender_id=str(30000 + user))
+    await plugin.inject_system_prompt(event, SimpleNamespace(system_prompt="", conversation=None))
+
+    start = time.perf_counter()
+    await event.send_streaming(stream_chunks(reply, args.stream_seconds, args.chunk_chars))
+    stream_done = time.perf_counter() - start
+
+    # 流式结束后框架依次触发 on_llm_response 与 on_decorating_result
+    event.set_result(MessageEventResult().message(reply))
+    await plugin._extract_prompt_before_filter(event, FakeLLMResponse(reply))
+    await plugin._auto_paint_from_llm(event)
+    await plugin._send_multi_image_results(event)
+    if not await event.wait_sent(args.pics, images_only=True, timeout=args.timeout):
+        raise RuntimeError("等待图片超时")
+    return {"stream": stream_done, "images": [t - start for t in event.image_times]}
+
+
+async def run_mode(port: int, workflow: str, early: bool, args) -> dict:
+    main = load_plugin_module("main")
+    config = make_config(port, workflow, llm_settings={"streaming_early_dispatch": early})
+    plugin = main.ComfyUIPlugin(FakeContext(), config)
+    reply = build_reply(args.pics)
+    runs = [await one_reply(plugin, reply, args, i) for i in range(args.rounds)]
+    first = [r["images"][0] for r in runs]
+    last = [r["images"][-1] for r in runs]
+    return {
+        "early_dispatch": early,
+        "stream_seconds": statistics.median(r["stream"] for r in runs),
+        "first_image": statistics.median(first),
+        "last_image": statistics.median(last),
+        "per_image": [statistics.median(r["images"][i] for r in runs) for i in range(args.pics)],
+    }
+
+
+async def run(args) -> dict:
+    proc, port = await start_fake_server_process(args)
+    workflow_path = Path(args.workflow)
+    try:
+        with preserved_schema(), temp_data_dir([workflow_path]):
+            modes = [await run_mode(port, workflow_path.name, early, args) for early in (False, True)]
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+    return {
+        "pics": args.pics,
+        "rounds": args.rounds,
+        "stream_seconds": args.stream_seconds,
+        "server": {k: getattr(args, k) for k in ("latency", "jitter", "workers")},
+        "modes": modes,
+    }
+
+
+def _print(payload: dict):
+    print(f"{'early':>6} {'stream':>8} {'first':>8} {'last':>8}  per image (s)")
+    for m in payload["modes"]:
+        per = " ".join(f"{t:.2f}" for t in m["per_image"])
+        print(f"{'on' if m['early_dispatch'] else 'off':>6} {m['stream_seconds']:>8.2f} "
+              f"{m['first_image']:>8.2f} {m['last_image']:>8.2f}  {per}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="流式提前出图基准")
+    parser.add_argument("--pics", type=int, default=3, help="每条回复中的 <pic> 数量")
+    parser.add_argument("--stream-seconds", type=float, default=6.0, help="整条回复流式输出耗时（秒）")
+    parser.add_argument("--chunk-chars", type=int, default=8, help="每个流式分片的字符数")
+    parser.add_argument("--rounds", type=int, default=3, help="每种模式重复次数（取中位数）")
+    parser.add_argument("--timeout", type=float, default=300, help="等待图片发出的超时（秒）")
+    parser.add_argument("--workflow", default=str(DEFAULT_WORKFLOW))
+    parser.add_argument("--label", default=None, help="结果文件标签（默认 版本-提交-时间）")
+    parser.add_argument("--compare", default=None, help="与之前保存的结果文件对比")
+    parser.add_argument("--no-save", action="store_true")
+    add_server_arguments(parser)
+    parser.set_defaults(latency=1.0, workers=2)
+    args = parser.parse_args()
+    args.pics = max(args.pics, 1)
+
+    payload = asyncio.run(run(args))
+    _print(payload)
+    off, on = payload["modes"]
+    print(f"\n开启提前出图后：首图 {format_delta(on['first_image'], off['first_image'])}，"
+          f"末图 {format_delta(on['last_image'], off['last_image'])}")
+
+    if args.compare:
+        baseline = load_results(args.compare)
+        old_on = baseline["modes"][1]
+        print(f"对比基线 {baseline.get('label')}: 首图 {format_delta(on['first_image'], old_on['first_image'])}，"
+              f"末图 {format_delta(on['last_image'], old_on['last_image'])}")
+    if not args.no_save:
+        path = save_results("streaming", payload, args.label)
+        print(f"\n结果已保存: {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+"""
+本地 ComfyUI 模拟服务（无需 GPU）
+
+实现插件用到的接口：/prompt、/history/{id}、/view、/queue、/interrupt、/free、/ws，
+并额外提供 /bench/stats 用于统计每个接口的请求次数。
+--load-time 模拟模型加载：任务用到的模型（ckpt_name/unet_name）不在“显存”中时追加加载耗时，/free 清空。
+
+用法：
+    python bench/fake_comfyui.py --port 8188 --latency 2 --jitter 0.5 --workers 1
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import struct
+import time
+import uuid
+import zlib
+
+from aiohttp import web, WSMsgType
+
+
+def _make_png(size_kb: int) -> bytes:
+    """生成一张合法的 1x1 PNG，并用 tEXt 块填充到指定大小"""
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    ihdr = struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0)
+    idat = zlib.compress(b"\x00\xff\xff\xff")
+    body = chunk(b"IHDR", ihdr) + chunk(b"IDAT", idat)
+    padding = max(size_kb * 1024 - len(body) - 64, 0)
+    if padding:
+        body += chunk(b"tEXt", b"pad\x00" + os.urandom(padding // 2).hex().encode()[:padding])
+    return b"\x89PNG\r\n\x1a\n" + body + chunk(b"IEND", b"")
+
+
+class FakeComfyUI:
+    def __init__(self, latency: float = 2.0, jitter: float = 0.0, per_step: float = 0.0,
+                 workers: int = 1, image_kb: int = 512, submit_fail_rate: float = 0.0,
+                 exec_fail_rate: float = 0.0, max_queue: int = 0, seed: int = None, load_time: float = 0.0):
+        self.latency = latency
+        self.load_time = load_time
+        self.loaded_models = set()
+        self.model_loads = 0
+        self.jitter = jitter
+        self.per_step = per_step
+        self.workers = max(int(workers), 1)
+        self.submit_fail_rate = submit_fail_rate
+        self.exec_fail_rate = exec_fail_rate
+        self.max_queue = max_queue
+        self.rng = random.Random(seed)
+        self.image = _make_png(image_kb)
+
+        self.queue = asyncio.Queue()
+        self.pending = {}
+        self.running = {}
+        self.history = {}
+        self.request_counts = {}
+        self.sockets = {}
+        self._number = 0
+        self._interrupts = set()
+        self._worker_tasks = []
+
+    # ====== 调度 ======
+    def _count(self, name: str):
+        self.request_counts[name] = self.request_counts.get(name, 0) + 1
+
+    def _exec_time(self, workflow: dict) -> float:
+        steps = 0
+        for node in workflow.values():
+            if isinstance(node, dict):
+                value = (node.get("inputs") or {}).get("steps")
+                if isinstance(value, (int, float)):
+                    steps += int(value)
+        base = self.latency + self.per_step * steps
+        models = {value for node in workflow.values() if isinstance(node, dict)
+                  for key, value in (node.get("inputs") or {}).items()
+                  if key in ("ckpt_name", "unet_name") and isinstance(value, str)}
+        if self.load_time and models - self.loaded_models:
+            base += self.load_time
+            self.model_loads += 1
+        self.loaded_models = models or self.loaded_models
+        if self.jitter:
+            base += self.rng.uniform(-self.jitter, self.jitter)
+        return max(base, 0.0)
+
+    async def _worker(self):
+        while True:
+            prompt_id = await self.queue.get()
+            job = self.pending.pop(prompt_id, None)
+            if job is None:
+                continue
+            self.running[prompt_id] = job
+            started = time.time()
+            job["messages"].append(["execution_start", {"prompt_id": prompt_id, "timestamp": int(started * 1000)}])
+            await self._broadcast(job["client_id"], "executing", {"node": "1", "prompt_id": prompt_id})
+
+            duration = self._exec_time(job["workflow"])
+            deadline = time.perf_counter() + duration
+            interrupted = False
+            while time.perf_counter() < deadline:
+                if prompt_id in self._interrupts:
+                    interrupted = True
+                    break
+                await asyncio.sleep(min(0.05, max(deadline - time.perf_counter(), 0)))
+
+            self.running.pop(prompt_id, None)
+            self._interrupts.discard(prompt_id)
+            now_ms = int(time.time() * 1000)
+            if interrupted:
+                job["messages"].append(["execution_interrupted", {"prompt_id": prompt_id, "timestamp": now_ms}])
+                outputs, status = {}, "error"
+            elif self.rng.random() < self.exec_fail_rate:
+                job["messages"].append(["execution_error", {"prompt_id": prompt_id, "timestamp": now_ms}])
+                outputs, status = {}, "error"
+            else:
+                job["messages"].append(["execution_success", {"prompt_id": prompt_id, "timestamp": now_ms}])
+                outputs = {job["output_id"]: {"images": [
+                    {"filename": f"{prompt_id}.png", "subfolder": "", "type": "output"}
+                ]}}
+                status = "success"
+
+            self.history[prompt_id] = {
+                "prompt": [job["number"], prompt_id, job["workflow"], {}, [job["output_id"]]],
+                "outputs": outputs,
+                "status": {"status_str": status, "completed": status == "success", "messages": job["messages"]},
+            }
+            await self._broadcast(job["client_id"], "executing", {"node": None, "prompt_id": prompt_id})
+
+    async def _broadcast(self, client_id: str, msg_type: str, data: dict):
+        ws = self.sockets.get(client_id)
+        if ws is None or ws.closed:
+            return
+        try:
+            await ws.send_str(json.dumps({"type": msg_type, "data": data}))
+        except Exception:
+            pass
+
+    @staticmethod
+    def _output_node(workflow: dict) -> str:
+        for nid, node in workflow.items():
+            if isinstance(node, dict) and node.get("class_type") in ("SaveImage", "PreviewImage"):
+                return str(nid)
+        return next(iter(workflow), "9")
+
+    # ====== HTTP 接口 ======
+    async def handle_prompt(self, request):
+        self._count("prompt")
+        try:
+            payload = await request.json()
+        except Exception:
+            return web.json_response({"error": "invalid json"}, status=400)
+        workflow = payload.get("prompt")
+        if not isinstance(workflow, dict) or not workflow:
+            return web.json_response({"error": "no prompt"}, status=400)
+        if self.rng.random() < self.submit_fail_rate:
+            return web.json_response({"error": "injected failure"}, status=500)
+        if self.max_queue and len(self.pending) >= self.max_queue:
+            return web.json_response({"error": "queue full"}, status=503)
+
+        prompt_id = str(uuid.uuid4())
+        self._number += 1
+        self.pending[prompt_id] = {
+            "number": self._number,
+            "workflow": workflow,
+            "client_id": payload.get("client_id", ""),
+            "output_id": self._output_node(workflow),
+            "messages": [],
+        }
+        self.queue.put_nowait(prompt_id)
+        return web.json_response({"prompt_id": prompt_id, "number": self._number, "node_errors": {}})
+
+    async def handle_history(self, request):
+        self._count("history")
+        prompt_id = request.match_info["prompt_id"]
+        entry = self.history.get(prompt_id)
+        return web.json_response({prompt_id: entry} if entry else {})
+
+    async def handle_view(self, request):
+        self._count("view")
+        filename = request.query.get("filename", "")
+        if not filename.endswith(".png"):
+            return web.Response(status=404)
+        return web.Response(body=self.image, content_type="image/png")
+
+    async def handle_queue(self, request):
+        self._count("queue")
+        running = [[job["number"], pid, {}, {}, [job["output_id"]]] for pid, job in self.running.items()]
+        pending = [[job["number"], pid, {}, {}, [job["output_id"]]] for pid, job in self.pending.items()]
+        return web.json_response({"queue_running": running, "queue_pending": pending})
+
+    async def handle_interrupt(self, request):
+        self._count("interrupt")
+        try:
+            target = (await request.json()).get("prompt_id")
+        except Exception:
+            target = None
+        self._interrupts.update(pid for pid in self.running if target in (None, pid))
+        return web.Response(status=200)
+
+    async def handle_queue_post(self, request):
+        self._count("queue_delete")
+        try:
+            payload = await request.json()
+        except Exception:
+            return web.json_response({"error": "invalid json"}, status=400)
+        if payload.get("clear"):
+            self.pending.clear()
+        for prompt_id in payload.get("delete") or []:
+            self.pending.pop(prompt_id, None)
+        return web.Response(status=200)
+
+    async def handle_free(self, request):
+        self._count("free")
+        self.loaded_models = set()
+        return web.Response(status=200)
+
+    async def handle_ws(self, request):
+        self._count("ws")
+        client_id = request.query.get("clientId", "")
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets[client_id] = ws
+        await ws.send_str(json.dumps({"type": "status", "data": {
+            "status": {"exec_info": {"queue_remaining": len(self.pending) + len(self.running)}},
+            "sid": client_id,
+        }}))
+        async for msg in ws:
+            if msg.type == WSMsgType.ERROR:
+                break
+        self.sockets.pop(client_id, None)
+        return ws
+
+    async def handle_stats(self, request):
+        return web.json_response({
+            "requests": self.request_counts,
+            "completed": len(self.history),
+            "pending": len(self.pending),
+            "running": len(self.running),
+            "model_loads": self.model_loads,
+        })
+
+    async def handle_stats_reset(self, request):
+        self.request_counts.clear()
+        return web.json_response({"ok": True})
+
+    # ====== 生命周期 ======
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/prompt", self.handle_prompt)
+        app.router.add_get("/history/{prompt_id}", self.handle_history)
+        app.router.add_get("/view", self.handle_view)
+        app.router.add_get("/queue", self.handle_queue)
+        app.router.add_post("/queue", self.handle_queue_post)
+        app.router.add_post("/interrupt", self.handle_interrupt)
+        app.router.add_post("/free", self.handle_free)
+        app.router.add_get("/ws", self.handle_ws)
+        app.router.add_get("/bench/stats", self.handle_stats)
+        app.router.add_post("/bench/stats/reset", self.handle_stats_reset)
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+    async def _on_startup(self, app):
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def _on_cleanup(self, app):
+        for task in self._worker_tasks:
+            task.cancel()
+
+
+async def start_server(host: str = "127.0.0.1", port: int = 0, **options):
+    """在当前事件循环中启动模拟服务，返回 (runner, 实际端口, FakeComfyUI)"""
+    fake = FakeComfyUI(**options)
+    runner = web.AppRunner(fake.build_app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    sockets = site._server.sockets if site._server else []
+    actual_port = sockets[0].getsockname()[1] if sockets else port
+    return runner, actual_port, fake
+
+
+def add_server_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency", type=float, default=2.0, help="单次执行基础耗时（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="执行耗时随机抖动（±秒）")
+    parser.add_argument("--per-step", type=float, default=0.0, help="按工作流 steps 总数追加的每步耗时（秒）")
+    parser.add_argument("--workers", type=int, default=1, help="并行执行槽位数（模拟 GPU 数）")
+    parser.add_argument("--image-kb", type=int, default=512, help="/view 返回的图片大小（KB）")
+    parser.add_argument("--submit-fail-rate", type=float, default=0.0, help="/prompt 返回 500 的概率")
+    parser.add_argument("--exec-fail-rate", type=float, default=0.0, help="执行失败（execution_error）的概率")
+    parser.add_argument("--max-queue", type=int, default=0, help="排队上限，超过返回 503（0 为不限）")
+    parser.add_argument("--seed", type=int, default=None, help="随机种子（复现失败注入）")
+    parser.add_argument("--load-time", type=float, default=0.0, help="任务用到的模型未加载时追加的加载耗时（秒）")
+
+
+def server_options(args) -> dict:
+    return {
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "per_step": args.per_step,
+        "workers": args.workers,
+        "image_kb": args.image_kb,
+        "submit_fail_rate": args.submit_fail_rate,
+        "exec_fail_rate": args.exec_fail_rate,
+        "max_queue": args.max_queue,
+        "seed": args.seed,
+        "load_time": args.load_time,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 ComfyUI 模拟服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8188)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    fake = FakeComfyUI(**server_options(args))
+    print(f"Fake ComfyUI listening on http://{args.host}:{args.port}")
+    web.run_app(fake.build_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
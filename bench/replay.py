@@ -0,0 +1,311 @@
+"""
+流量回放：把 traffic_capture 录制的匿名流量按原始时间间隔（或加速）喂给插件钩子，后端为本地模拟服务
+
+    command -> cmd_paint / cmd_paint_no
+    tool    -> comfyui_txt2img
+    llm     -> _extract_prompt_before_filter -> _auto_paint_from_llm -> _send_multi_image_results
+
+提示词与回复文本按录制的长度和 <pic> 数量用固定随机种子合成，同一录制文件每次回放的输入完全一致，
+可用于对比调度、缓存等改动前后的排队延迟与吞吐。
+
+用法：
+    python bench/replay.py traffic.jsonl                       # 原速回放
+    python bench/replay.py traffic.jsonl --speed 10 --latency 0.5
+    python bench/replay.py traffic.jsonl --speed 10 --compare bench/results/replay-xxx.json
+"""
+import argparse
+import asyncio
+import logging
+import random
+import sys
+from collections import Counter
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from _harness import (  # noqa: E402
+    PLUGIN_DIR, FakeContext, FakeEvent, FakeLLMResponse,
+    format_delta, latency_summary, load_plugin_module, load_results,
+    make_config, peak_rss_mb, preserved_schema, save_results, server_request_count,
+    start_fake_server_process, temp_data_dir,
+)
+from fake_comfyui import add_server_arguments  # noqa: E402
+
+DEFAULT_WORKFLOW = PLUGIN_DIR / "workflow" / "workflow_api.json"
+TAGS = (
+    "1girl", "solo", "smile", "long hair", "looking at viewer", "upper body", "outdoors",
+    "night", "city lights", "rain", "umbrella", "school uniform", "from side", "blue sky",
+    "masterpiece", "best quality", "cinematic lighting", "depth of field", "wind", "flowers",
+)
+FILLER = "她看着窗外的雨，轻声说了些什么。"
+
+
+# ====== 输入合成 ======
+def synth_prompt(rng: random.Random, length: int) -> str:
+    length = max(int(length), 3)
+    tags = []
+    total = 0
+    while total < length:
+        tag = rng.choice(TAGS)
+        tags.append(tag)
+        total += len(tag) + 2
+    return ", ".join(tags)[:length].rstrip(", ") or "1girl"
+
+
+def synth_reply(rng: random.Random, prompts: list, reply_length: int) -> str:
+    pics = [f'<pic prompt="{p}">' for p in prompts]
+    used = sum(len(p) for p in pics) + len("<think></think>")
+    filler_len = max(reply_length - used, 0)
+    per_part = filler_len // (len(pics) + 1) if pics else filler_len
+    filler = (FILLER * (per_part // len(FILLER) + 1))[:per_part]
+
+    parts = [f"<think>{filler[:20]}</think>"]
+    for pic in pics:
+        parts.append(filler)
+        parts.append(pic)
+    parts.append(filler)
+    return "".join(parts)
+
+
+def make_event(entry: dict, message_str: str = "") -> FakeEvent:
+    return FakeEvent(
+        sender_id=entry.get("user") or "anonymous",
+        group_id=entry.get("group") or None,
+        message_str=message_str,
+    )
+
+
+# ====== 单条回放 ======
+def _classify(results: list) -> str:
+    """根据指令/工具产出的结果判断结果：image / rejected / error"""
+    from astrbot.api.message_components import Image, Node, Plain
+
+    for result in results:
+        for comp in getattr(result, "chain", None) or []:
+            if isinstance(comp, (Image, Node)):
+                return "image"
+    for result in results:
+        for comp in getattr(result, "chain", None) or []:
+            if isinstance(comp, Plain) and comp.text.startswith(("🚫", "⏱️")):
+                return "rejected"
+    return "error"
+
+
+async def replay_command(plugin, entry: dict, prompts: list, timeout: float) -> tuple:
+    command = "/画图no" if entry.get("direct_send") else "/画图"
+    event = make_event(entry, f"{command} {prompts[0]}")
+    handler = plugin.cmd_paint_no if entry.get("direct_send") else plugin.cmd_paint
+
+    async def collect():
+        return [r async for r in handler(event)]
+
+    results = await asyncio.wait_for(collect(), timeout)
+    outcome = _classify(results)
+    return outcome, 1 if outcome == "image" else 0
+
+
+async def replay_tool(plugin, entry: dict, prompts: list, timeout: float) -> tuple:
+    event = make_event(entry)
+
+    async def collect():
+        return [r async for r in plugin.comfyui_txt2img(event, prompt=prompts[0])]
+
+    results = await asyncio.wait_for(collect(), timeout)
+    outcome = _classify(results)
+    return outcome, 1 if outcome == "image" else 0
+
+
+async def replay_llm(plugin, entry: dict, prompts: list, reply: str, timeout: float) -> tuple:
+    from astrbot.api.event import MessageEventResult
+
+    event = make_event(entry)
+    event.set_result(MessageEventResult().message(reply))
+    resp = FakeLLMResponse(reply)
+
+    await plugin._extract_prompt_before_filter(event, resp)
+    await plugin._auto_paint_from_llm(event)
+    await asyncio.wait_for(plugin._send_multi_image_results(event), timeout)
+
+    if not prompts:
+        return "no_pic", 0
+    if event.get_extra("comfy_multi_image_mode"):
+        images = event.image_count
+    elif getattr(event, "_comfy_extracted_prompt", None):
+        # 单图模式由后台任务生成后 event.send，成功发图片、失败/拒绝发文字
+        await event.wait_sent(1, timeout=timeout)
+        images = event.image_count
+    else:
+        images = 0
+    if images:
+        return "image", images
+    return ("rejected" if event.sent else "error"), 0
+
+
+# ====== 调度 ======
+async def replay(plugin, entries: list, args) -> dict:
+    rng = random.Random(args.seed)
+    # 先统一合成输入，保证不同速度下的输入一致
+    jobs = []
+    for entry in entries:
+        lengths = entry.get("prompt_lengths") or []
+        if entry["kind"] in ("command", "tool") and not lengths:
+            lengths = [40]
+        prompts = [synth_prompt(rng, n) for n in lengths]
+        reply = synth_reply(rng, prompts, entry.get("reply_length", 0)) if entry["kind"] == "llm" else ""
+        jobs.append((entry, prompts, reply))
+
+    loop = asyncio.get_running_loop()
+    t0 = entries[0]["ts"]
+    start = loop.time()
+    records = []
+
+    async def run_one(entry, prompts, reply):
+        scheduled = start + (entry["ts"] - t0) / args.speed
+        delay = scheduled - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        began = loop.time()
+        try:
+            if entry["kind"] == "command":
+                outcome, images = await replay_command(plugin, entry, prompts, args.timeout)
+            elif entry["kind"] == "tool":
+                outcome, images = await replay_tool(plugin, entry, prompts, args.timeout)
+            else:
+                outcome, images = await replay_llm(plugin, entry, prompts, reply, args.timeout)
+        except asyncio.TimeoutError:
+            outcome, images = "timeout", 0
+        except Exception as e:
+            print(f"回放异常 ({entry['kind']}): {e}")
+            outcome, images = "error", 0
+        records.append({
+            "kind": entry["kind"],
+            "outcome": outcome,
+            "images": images,
+            "lag": began - scheduled,
+            "latency": loop.time() - began,
+        })
+
+    await asyncio.gather(*(run_one(*job) for job in jobs))
+    wall = loop.time() - start
+    return summarize(records, wall, entries)
+
+
+def summarize(records: list, wall: float, entries: list) -> dict:
+    by_kind = {}
+    for kind in sorted({r["kind"] for r in records}):
+        rows = [r for r in records if r["kind"] == kind]
+        drawn = [r["latency"] for r in rows if r["outcome"] == "image"]
+        by_kind[kind] = {
+            "events": len(rows),
+            "outcomes": dict(Counter(r["outcome"] for r in rows)),
+            "images": sum(r["images"] for r in rows),
+            "latency": latency_summary(drawn),
+        }
+    images = sum(r["images"] for r in records)
+    span = entries[-1]["ts"] - entries[0]["ts"] if entries else 0.0
+    return {
+        "events": len(records),
+        "images": images,
+        "recorded_seconds": span,
+        "wall_seconds": wall,
+        "images_per_sec": images / wall if wall else 0.0,
+        "max_lag": max((r["lag"] for r in records), default=0.0),
+        "latency": latency_summary([r["latency"] for r in records if r["outcome"] == "image"]),
+        "by_kind": by_kind,
+        "workflows": dict(Counter(e.get("workflow", "") for e in entries)),
+        "groups": len({e.get("group") for e in entries if e.get("group")}),
+        "users": len({e.get("user") for e in entries if e.get("user")}),
+    }
+
+
+def print_summary(summary: dict, speed: float):
+    print(f"事件 {summary['events']} 个 | 群 {summary['groups']} 个 | 用户 {summary['users']} 个 | "
+          f"录制时长 {summary['recorded_seconds']:.1f}s，{speed}x 回放耗时 {summary['wall_seconds']:.1f}s")
+    print(f"出图 {summary['images']} 张，{summary['images_per_sec']:.2f} 张/s，最大调度滞后 {summary['max_lag'] * 1000:.1f}ms")
+    print(f"{'kind':>8} {'events':>7} {'images':>7} {'p50':>8} {'p95':>8} {'p99':>8}  outcomes")
+    for kind, s in summary["by_kind"].items():
+        lat = s["latency"]
+        print(f"{kind:>8} {s['events']:>7} {s['images']:>7} {lat['p50']:>8.2f} {lat['p95']:>8.2f} "
+              f"{lat['p99']:>8.2f}  {s['outcomes']}")
+
+
+def print_compare(summary: dict, baseline: dict):
+    print(f"\n对比基线 {baseline.get('label')}:")
+    print(f"  张/s {format_delta(summary['images_per_sec'], baseline['images_per_sec'])}, "
+          f"p50 {format_delta(summary['latency']['p50'], baseline['latency']['p50'])}, "
+          f"p95 {format_delta(summary['latency']['p95'], baseline['latency']['p95'])}, "
+          f"p99 {format_delta(summary['latency']['p99'], baseline['latency']['p99'])}")
+
+
+async def run(args) -> dict:
+    traffic = load_plugin_module("traffic")
+    entries = traffic.load_traffic(args.trace)
+    if args.kinds:
+        entries = [e for e in entries if e["kind"] in args.kinds]
+    if args.limit:
+        entries = entries[:args.limit]
+    if not entries:
+        raise SystemExit("录制文件中没有可回放的事件")
+
+    proc, port = await start_fake_server_process(args)
+    url = f"http://127.0.0.1:{port}"
+    workflow_path = Path(args.workflow)
+    try:
+        with preserved_schema(), temp_data_dir([workflow_path]):
+            main = load_plugin_module("main")
+            # 录制时能到达插件的群默认都放行，避免白名单拒绝掩盖真实负载
+            groups = sorted({e["group"] for e in entries if e.get("group")})
+            config = make_config(port, workflow_path.name, control={
+                "cooldown_seconds": args.cooldown, "whitelist_group_ids": groups,
+            })
+            plugin = main.ComfyUIPlugin(FakeContext(), config)
+            await server_request_count(url, reset=True)
+            if not args.verbose:
+                logging.getLogger("astrbot").setLevel(logging.WARNING)
+            summary = await replay(plugin, entries, args)
+            summary["server_requests"] = await server_request_count(url)
+            summary["peak_rss_mb"] = peak_rss_mb()
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+    summary.update(
+        trace=str(args.trace),
+        speed=args.speed,
+        cooldown=args.cooldown,
+        server={k: getattr(args, k) for k in ("latency", "jitter", "per_step", "workers", "image_kb",
+                                              "submit_fail_rate", "exec_fail_rate")},
+    )
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="录制流量回放")
+    parser.add_argument("trace", help="traffic_capture 录制的 JSONL 文件")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放倍速（>1 为加速，只压缩事件间隔）")
+    parser.add_argument("--limit", type=int, default=0, help="只回放前 N 个事件")
+    parser.add_argument("--kinds", default=None, type=lambda s: {k.strip() for k in s.split(",") if k.strip()},
+                        help="只回放指定来源，如 llm,command")
+    parser.add_argument("--cooldown", type=int, default=0, help="回放时使用的冷却秒数")
+    parser.add_argument("--timeout", type=float, default=600, help="单个事件的超时（秒）")
+    parser.add_argument("--workflow", default=str(DEFAULT_WORKFLOW))
+    parser.add_argument("--label", default=None)
+    parser.add_argument("--compare", default=None, help="与之前保存的回放结果对比")
+    parser.add_argument("--no-save", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="回放期间保留插件的 INFO 日志")
+    add_server_arguments(parser)
+    parser.set_defaults(latency=1.0, seed=0)
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error("--speed 必须大于 0")
+
+    summary = asyncio.run(run(args))
+    print_summary(summary, args.speed)
+    if args.compare:
+        print_compare(summary, load_results(args.compare))
+    if not args.no_save:
+        print(f"\n结果已保存: {save_results('replay', summary, args.label)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import asyncio
+import statistics
+import time
+from astrbot.api import logger
+
+from .job_journal import JobHandedOff
+from .metrics import JOBS_IN_FLIGHT
+
+# 基准使用的一次性提示词与种子：每个任务用 BENCH_SEED + 序号，
+# 既保证每次测试的输入一致，又避免 ComfyUI 命中执行缓存直接返回
+BENCH_PROMPT = "a plain white cube on a grey background, studio lighting, simple"
+BENCH_SEED = 20240601
+
+
+class CapacityBenchmark:
+    """
+    对当前后端 + 当前工作流做一次受控的容量测试
+    流程：1 个冷启动任务 -> 各并发级别依次跑 jobs_per_level × 并发数 个任务，统计延迟、每分钟出图数和拐点
+    """
+
+    def __init__(self, api, levels=(1, 2, 4), jobs_per_level: int = 4, max_runtime: float = 300,
+                 knee_gain: float = 0.1):
+        self.api = api
+        self.levels = sorted({max(int(c), 1) for c in levels}) or [1]
+        self.jobs_per_level = max(int(jobs_per_level), 1)
+        self.max_runtime = float(max_runtime)
+        self.knee_gain = float(knee_gain)
+        self._seq = 0
+        self._own_in_flight = 0
+        self.user_jobs_seen = 0
+
+    async def preflight(self) -> str:
+        """检查是否可以开始测试，返回拒绝原因（可以开始时返回空字符串）"""
+        if self._user_in_flight() > 0:
+            return f"插件内还有 {int(self._user_in_flight())} 个用户任务在生成"
+        try:
+            queued = await self.api.get_queue_size()
+        except Exception as e:
+            return f"无法查询后端队列: {e}"
+        if queued:
+            return f"后端队列中还有 {queued} 个任务"
+        return ""
+
+    def _user_in_flight(self) -> float:
+        return sum(v for _, v in JOBS_IN_FLIGHT.items()) - self._own_in_flight
+
+    async def _one_job(self) -> tuple:
+        seed = BENCH_SEED + self._seq
+        self._seq += 1
+        self.user_jobs_seen = max(self.user_jobs_seen, int(self._user_in_flight()))
+        self._own_in_flight += 1
+        start = time.perf_counter()
+        try:
+            img_data, error_msg = await self.api.generate(BENCH_PROMPT, seed=seed)
+        except JobHandedOff as e:
+            img_data, error_msg = None, str(e)
+        finally:
+            self._own_in_flight -= 1
+        return time.perf_counter() - start, bool(img_data), error_msg
+
+    async def _run_level(self, concurrency: int, deadline: float) -> dict:
+        sem = asyncio.Semaphore(concurrency)
+        latencies = []
+        errors = []
+
+        async def worker():
+            async with sem:
+                if time.perf_counter() >= deadline:
+                    return
+                elapsed, ok, error_msg = await self._one_job()
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors.append(error_msg)
+
+        start = time.perf_counter()
+        total = self.jobs_per_level * concurrency
+        tasks = [asyncio.create_task(worker()) for _ in range(total)]
+        truncated = False
+        try:
+            await asyncio.wait_for(asyncio.gather(*tasks), max(deadline - time.perf_counter(), 0.001))
+        except asyncio.TimeoutError:
+            truncated = True
+        wall = time.perf_counter() - start
+        return {
+            "concurrency": concurrency,
+            "completed": len(latencies),
+            "errors": errors,
+            "wall": wall,
+            "per_minute": len(latencies) / wall * 60 if wall else 0.0,
+            "p50": statistics.median(latencies) if latencies else 0.0,
+            "max": max(latencies) if latencies else 0.0,
+            "total": total,
+            "truncated": truncated or len(latencies) + len(errors) < total,
+        }
+
+    def find_knee(self, levels: list):
+        """拐点：再提高并发后每分钟出图数的提升不足 knee_gain 的第一个并发级别"""
+        usable = [lv for lv in levels if lv["completed"] and not lv["truncated"]]
+        for prev, cur in zip(usable, usable[1:]):
+            if prev["per_minute"] and (cur["per_minute"] - prev["per_minute"]) / prev["per_minute"] < self.knee_gain:
+                return prev["concurrency"]
+        return None
+
+    async def run(self, cold: bool = False) -> dict:
+        started = time.perf_counter()
+        deadline = started + self.max_runtime
+        report = {"cold_freed": False, "cold": None, "levels": [], "knee": None, "truncated": False}
+
+        if cold:
+            report["cold_freed"] = await self.api.free_models()
+
+        # 冷启动：第一个任务可能包含模型加载
+        try:
+            elapsed, ok, error_msg = await asyncio.wait_for(self._one_job(), self.max_runtime)
+        except asyncio.TimeoutError:
+            report["truncated"] = True
+            report["elapsed"] = time.perf_counter() - started
+            return report
+        if not ok:
+            report["error"] = error_msg
+            report["elapsed"] = time.perf_counter() - started
+            return report
+        report["cold"] = elapsed
+
+        for concurrency in self.levels:
+            if time.perf_counter() >= deadline:
+                report["truncated"] = True
+                break
+            level = await self._run_level(concurrency, deadline)
+            report["levels"].append(level)
+            logger.info(
+                f"[ComfyUI] 🏁 容量测试 并发 {concurrency}: {level['per_minute']:.1f} 张/分钟, "
+                f"p50 {level['p50']:.2f}s, 完成 {level['completed']}/{level['total']}"
+            )
+            if level["truncated"]:
+                report["truncated"] = True
+                break
+
+        report["knee"] = self.find_knee(report["levels"])
+        report["elapsed"] = time.perf_counter() - started
+        report["user_jobs_seen"] = self.user_jobs_seen
+        return report
+
+
+def format_report(report: dict, workflow: str, backend: str, max_runtime: float, knee_gain: float) -> list:
+    lines = ["🏁 ComfyUI 容量测试", "━━━━━━━━━━━━━━━━━━", f"工作流: {workflow}", f"后端: {backend}"]
+    if report.get("error"):
+        lines.append(f"❌ 冷启动任务失败: {report['error']}")
+        return lines
+    if report["cold"] is None:
+        lines.append(f"⏱️ 冷启动任务在 {max_runtime:.0f}s 内未完成，测试中止")
+        return lines
+
+    levels = report["levels"]
+    warm = levels[0]["p50"] if levels and levels[0]["concurrency"] == 1 and levels[0]["completed"] else None
+    cold_tag = "（已先释放模型）" if report["cold_freed"] else ""
+    warm_text = f"{warm:.2f}s" if warm is not None else "-"
+    lines.append(f"🧊 冷启动: {report['cold']:.2f}s{cold_tag} | 🔥 热态: {warm_text}（单并发 p50）")
+    lines.append("")
+    for lv in levels:
+        suffix = f" | 失败 {len(lv['errors'])}" if lv["errors"] else ""
+        if lv["truncated"]:
+            suffix += " | ⚠️ 超时中止"
+        lines.append(
+            f"  • 并发 {lv['concurrency']}: {lv['per_minute']:.1f} 张/分钟 | p50 {lv['p50']:.2f}s | "
+            f"最慢 {lv['max']:.2f}s{suffix}"
+        )
+
+    lines.append("")
+    if report["knee"] is not None:
+        lines.append(f"📐 拐点: 并发 {report['knee']}（继续提高并发，出图速度提升不足 {knee_gain:.0%}）")
+    elif len(levels) > 1:
+        lines.append(
+            f"📐 拐点: 未出现，提高到并发 {levels[-1]['concurrency']} 时出图速度仍提升 ≥ {knee_gain:.0%}，可尝试更高并发"
+        )
+    if report["truncated"]:
+        lines.append(f"⚠️ 达到最长运行时间 {max_runtime:.0f}s，结果不完整；已提交的任务仍会在后端执行完")
+    if report.get("user_jobs_seen"):
+        lines.append("⚠️ 测试期间有用户任务同时生成，结果可能偏低")
+    lines.append(f"⏳ 总耗时 {report['elapsed']:.1f}s")
+    return lines
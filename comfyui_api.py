@@ -3,19 +3,43 @@ import random
 import os
 import aiohttp
 import asyncio
+import time
 from pathlib import Path
 from astrbot.api import logger
 import re
 
+from .job_journal import JobHandedOff
+from .metrics import JOBS_IN_FLIGHT, JOBS_TOTAL, STAGE_ERRORS_TOTAL, observe_stage, time_stage
+from .residency import ModelResidency
+from .tracing import NULL_TRACE
+from .workflow_compiler import (
+    NEGATIVE_INPUT_KEYS, PROMPT_INPUT_KEYS, SEED_INPUT_KEYS, analyze, is_link, normalize, unreachable,
+    warm_up_workflow,
+)
+from .workflow_index import SEEDS_SUFFIX, describe_seed_policy, parse_seed_policy, parse_steps_override, sidecar_name
+
 
 DEFAULT_CONNECT_TIMEOUT = 10
 DEFAULT_READ_TIMEOUT = 180
 DEFAULT_REQUEST_TIMEOUT = (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)
 DEFAULT_RETRY_TOTAL = 3
 DEFAULT_RETRY_BACKOFF = 1.0
+GENERATE_TIMEOUT_MSG = "生成超时"
+# 插件关闭时仍在等待结果的任务：日志保留记录，重载后继续取回
+GENERATE_HANDOFF_MSG = "插件正在重载，图片将在重载后继续发送"
+# 预热任务使用的提示词（内容无关紧要，只为让后端加载模型）
+WARM_UP_PROMPT = "warm up"
 _HTTP_SESSION = None
 
 
+def _compiled_slot(compiled: dict, role: str, node_id: str):
+    """编译元数据中 role（positive/negative）节点的文本字段；节点与当前配置不一致时返回 None"""
+    slot = compiled.get(role) if compiled else None
+    if slot and slot["node"] == node_id:
+        return slot["key"]
+    return None
+
+
 def _normalize_server_address(server_address):
     server_address = (server_address or "").strip()
     if not server_address:
@@ -84,13 +108,14 @@ def _http_post(url, **kwargs):
 
 
 class ComfyUI:
-    def __init__(self, config: dict, data_dir: Path = None) -> None:
+    def __init__(self, config: dict, data_dir: Path = None, workflow_index=None) -> None:
         """
         初始化 ComfyUI API 客户端
         
         Args:
             config: 插件配置字典
             data_dir: 持久化数据目录（由 main.py 传入）
+            workflow_index: 工作流目录索引（由 main.py 传入，缺省时直接读文件）
         """
         # 读取基础配置
         self.server_address = _normalize_server_address(config.get("server_address", "127.0.0.1:8188"))
@@ -117,8 +142,14 @@ class ComfyUI:
         self.input_id = str(wf_conf.get("input_node_id", "6"))
         self.neg_node_id = str(wf_conf.get("neg_node_id", "")) 
         self.output_id = str(wf_conf.get("output_node_id", "9"))
+        # 提交前删除与输出节点无关的节点（默认关闭）
+        self.prune_unreachable = bool(wf_conf.get("prune_unreachable", False))
 
         self.seed_id = None
+        # 任务日志（JobJournal，由 main.py 设置）；closing 为 True 时等待中的任务交给重载后的实例
+        self.journal = None
+        self.closing = False
+        self._background = set()
 
         # ====== 关键改动：使用持久化目录 ======
         if data_dir is not None:
@@ -130,6 +161,18 @@ class ComfyUI:
         
         self.workflow_dir = self.data_dir / "workflow"
         self.workflow_path = self.workflow_dir / self.wf_filename
+        self.workflow_index = workflow_index
+
+        # 模型驻留管理（默认关闭）：切换/启动后预热，空闲后 /free
+        res_conf = config.get("model_residency", {})
+        self.residency = None
+        if res_conf.get("enabled", False):
+            self.residency = ModelResidency(
+                self,
+                idle_free_seconds=float(res_conf.get("idle_free_minutes", 30) or 0) * 60,
+                warm_up_on_switch=res_conf.get("warm_up_on_switch", True),
+                warm_up_on_startup=res_conf.get("warm_up_on_startup", True),
+            )
         
         logger.info(f"[ComfyUI API] 已加载 | 工作流目录: {self.workflow_dir} | 当前工作流: {self.wf_filename}")
 
@@ -145,8 +188,10 @@ class ComfyUI:
         if neg_node_id:
             self.neg_node_id = str(neg_node_id)
         
-        exists = self.workflow_path.exists()
+        exists = self._workflow_exists()
         status = "存在" if exists else "不存在(请检查文件名)"
+        if exists and self.residency is not None and self.residency.warm_up_on_switch:
+            self.residency.schedule_warm_up("切换工作流")
 
         logger.info(
             f"[ComfyUI] 切换工作流 -> {filename} [{status}] | "
@@ -155,14 +200,32 @@ class ComfyUI:
         return exists, (f"已切换至 {filename}，文件{status}。\n"
                         f"当前节点设置: Positive={self.input_id}, Negative={self.neg_node_id}, Output={self.output_id or '自动'}")
 
+    def _workflow_exists(self) -> bool:
+        if self.workflow_index is not None:
+            return self.workflow_index.get(self.wf_filename) is not None
+        return self.workflow_path.exists()
+
     def _load_workflow(self):
+        if self.workflow_index is not None:
+            # 索引缓存了原文，只在文件变化时重新读盘
+            entry = self.workflow_index.get(self.wf_filename)
+            if entry is None:
+                raise FileNotFoundError(f"工作流文件不存在: {self.workflow_path}")
+            return entry.load()
         if not self.workflow_path.exists():
             raise FileNotFoundError(f"工作流文件不存在: {self.workflow_path}")
         with open(self.workflow_path, "r", encoding="utf-8") as f:
             return json.load(f)
 
-    def _inject_params(self, workflow, prompt):
-        """参数注入：写提示词 + 覆盖步数 + 强制改所有 seed/noise_seed"""
+    def _inject_params(self, workflow, prompt, seed=None):
+        """
+        参数注入：写提示词 + 覆盖步数 + 重新随机种子（seed 为空时随机）
+        工作流有编译元数据时直接使用预先算好的注入位置，不再逐个节点查找
+        种子默认只改主采样器的，其余节点的种子和提示词不变时的文本输入保持原样，
+        ComfyUI 可以直接复用采样器上游节点的缓存结果
+        """
+        entry = self.workflow_index.get(self.wf_filename) if self.workflow_index is not None else None
+        compiled = entry.compiled if entry is not None else None
     
         # ========== 1. 注入正向提示词（原有代码）==========
         node = workflow.get(self.input_id)
@@ -171,22 +234,22 @@ class ComfyUI:
             return
 
         inputs = node.get("inputs", {})
-        target_keys = [
-            "text", "opt_text", "string",
-            "text_positive", "positive",
-            "prompt", "wildcard_text",
-        ]
-        for key in target_keys:
-            if key in inputs:
-                inputs[key] = prompt
-                break
+        slot = _compiled_slot(compiled, "positive", self.input_id)
+        if slot is not None and slot in inputs:
+            inputs[slot] = prompt
+        else:
+            for key in PROMPT_INPUT_KEYS:
+                if key in inputs:
+                    inputs[key] = prompt
+                    break
     
         # 注入负面提示词（原有代码）
         if self.neg_node_id and self.neg_prompt:
             neg_node = workflow.get(self.neg_node_id)
             if neg_node:
                 n_inputs = neg_node.get("inputs", {})
-                n_keys = ["text", "string", "negative", "text_negative", "prompt"]
+                slot = _compiled_slot(compiled, "negative", self.neg_node_id)
+                n_keys = (slot,) if slot is not None and slot in n_inputs else NEGATIVE_INPUT_KEYS
                 for n_key in n_keys:
                     if n_key in n_inputs:
                         existing_neg = str(n_inputs.get(n_key, "")).strip()
@@ -199,7 +262,7 @@ class ComfyUI:
                         break
 
         # ========== 2. 覆盖步数（按节点ID）==========
-        overrides = self._load_steps_override()
+        overrides = self._load_steps_override(entry)
         if overrides:
             count = self._apply_steps_override(workflow, overrides)
             if count > 0:
@@ -208,67 +271,113 @@ class ComfyUI:
             else:
                 logger.info(f"[ComfyUI] ⚠ 配置了步数覆盖但未找到匹配的引用")
     
-        # ========== 3. 随机化种子（原有代码）==========
-        base_seed = random.randint(1, 999999999999999)
-        ks_count = 0
-        offset = 0
+        # ========== 3. 随机化种子 ==========
+        base_seed = int(seed) if seed is not None else random.randint(1, 999999999999999)
+        seeded = set()
+        policy = self._load_seed_policy(entry)
+        for offset, (nid, key) in enumerate(self._seed_slots(workflow, compiled, policy)):
+            workflow[nid]["inputs"][key] = base_seed + offset
+            seeded.add(nid)
+        ks_count = len(seeded)
 
+        logger.info(
+            f"[ComfyUI] 本次基础随机种: {base_seed}，已写入 {ks_count} 个节点的 seed/noise_seed 输入"
+            f"（{describe_seed_policy(policy)}）"
+        )
+
+    def pruned_nodes(self, workflow: dict = None) -> tuple:
+        """
+        当前工作流提交时会被裁剪掉的节点 ID
+        输出节点优先用配置的 output_id，它不是识别出的输出节点时用导入时识别出的主输出；都没有时不裁剪
+        有索引时结果按工作流版本 + 输出节点缓存，没有索引时每次现算
+        """
+        entry = self.workflow_index.get(self.wf_filename) if self.workflow_index is not None else None
+        try:
+            if entry is not None:
+                return entry.pruned_nodes(self.output_id)
+            normalized = normalize(workflow if workflow is not None else self._load_workflow())
+        except (ValueError, FileNotFoundError) as e:
+            logger.warning(f"[ComfyUI] 计算裁剪节点失败，本次不裁剪: {e}")
+            return ()
+        meta = analyze(normalized)
+        output_id = self.output_id if self.output_id in meta["outputs"] else meta["output"]
+        return unreachable(normalized, output_id)
+
+    def _prune_workflow(self, workflow: dict) -> int:
+        """删除与输出节点无关的节点，返回删除的节点数"""
+        removed = 0
+        for nid in self.pruned_nodes(workflow):
+            if workflow.pop(nid, None) is not None:
+                removed += 1
+        return removed
+
+    @staticmethod
+    def _seed_slots(workflow: dict, compiled: dict = None, policy=None) -> list:
+        """
+        需要写入种子的 (节点ID, 字段)
+        policy：None 为自动（主采样器），"all" 为全部，节点 ID 元组为指定节点；
+        没有编译元数据时按全部处理
+        """
+        if isinstance(policy, tuple):
+            slots = []
+            for nid in policy:
+                n_inputs = (workflow.get(nid) or {}).get("inputs", {})
+                for key in SEED_INPUT_KEYS:
+                    if key in n_inputs and not is_link(n_inputs[key]):
+                        slots.append((nid, key))
+            return slots
+        if compiled is not None:
+            seeds = compiled["seeds"] if policy == "all" else compiled["primary_seeds"]
+            return [(nid, key) for nid, key in seeds if nid in workflow]
+        slots = []
         for nid, node_data in workflow.items():
             if not isinstance(node_data, dict):
                 continue
             n_inputs = node_data.get("inputs", {})
             if not isinstance(n_inputs, dict):
                 continue
+            for key in SEED_INPUT_KEYS:
+                if key in n_inputs:
+                    slots.append((nid, key))
+        return slots
+
+    def seed_slots(self) -> list:
+        """当前工作流每次生成会重新随机的种子位置（供 /comfy_seed 展示）"""
+        entry = self.workflow_index.get(self.wf_filename) if self.workflow_index is not None else None
+        compiled = entry.compiled if entry is not None else None
+        return self._seed_slots(self._load_workflow(), compiled, self._load_seed_policy(entry))
+
+    def _load_seed_policy(self, entry=None):
+        """读取当前工作流的种子配置（<工作流名>.seeds.json），没有时为 None（自动）"""
+        if self.workflow_index is not None:
+            entry = entry or self.workflow_index.get(self.wf_filename)
+            return entry.seed_policy if entry else None
+        sidecar = self.workflow_path.parent / sidecar_name(self.workflow_path.name, SEEDS_SUFFIX)
+        try:
+            if not sidecar.exists():
+                return None
+            with open(sidecar, "r", encoding="utf-8") as f:
+                return parse_seed_policy(json.load(f))
+        except Exception as e:
+            logger.warning(f"[ComfyUI] 读取种子配置文件失败: {e}")
+            return None
 
-            changed = False
-
-            if "seed" in n_inputs:
-                n_inputs["seed"] = base_seed + offset
-                offset += 1
-                changed = True
-
-            if "noise_seed" in n_inputs:
-                n_inputs["noise_seed"] = base_seed + offset
-                offset += 1
-                changed = True
-
-            if changed:
-                ks_count += 1
-
-        logger.info(
-            f"[ComfyUI] 本次基础随机种: {base_seed}，已写入 {ks_count} 个 seed/noise_seed 输入"
-        )
-    def _load_steps_override(self) -> dict:
+    def _load_steps_override(self, entry=None) -> dict:
         """
         读取当前工作流的 steps 覆盖配置
         返回格式：{"3839": 20, "4521": 50} 或 {}
         """
+        if self.workflow_index is not None:
+            entry = entry or self.workflow_index.get(self.wf_filename)
+            return dict(entry.steps_overrides) if entry else {}
         try:
-            stem = self.workflow_path.stem
-            sidecar = self.workflow_path.parent / f"{stem}.steps.json"
+            sidecar = self.workflow_path.parent / sidecar_name(self.workflow_path.name)
         
             if not sidecar.exists():
                 return {}
         
             with open(sidecar, "r", encoding="utf-8") as f:
-                data = json.load(f)
-        
-            if not isinstance(data, dict):
-                return {}
-        
-            # 转换格式：支持旧格式 {"steps": 20} 和新格式 {"3839": {"steps": 20}}
-            result = {}
-            for key, value in data.items():
-                if isinstance(value, dict) and "steps" in value:
-                    # 新格式：{"3839": {"steps": 20}}
-                    steps = value.get("steps")
-                    if isinstance(steps, (int, float)) and steps > 0:
-                        result[str(key)] = int(steps)
-                elif isinstance(value, (int, float)) and value > 0:
-                    # 兼容简化格式：{"3839": 20}
-                    result[str(key)] = int(value)
-        
-            return result
+                return parse_steps_override(json.load(f))
     
         except Exception as e:
             logger.warning(f"[ComfyUI] 读取 steps 覆盖文件失败: {e}")
@@ -334,64 +443,321 @@ class ComfyUI:
                         logger.debug(f"[ComfyUI] 节点 {nid}.{key}: [{ref_node_id}] -> {new_steps}")
     
         return override_count
-    async def generate(self, prompt):
-        """异步生成图片"""
-        client_id = str(random.randint(100000, 999999))
+    async def generate(self, prompt, trace=None, seed=None, job=None):
+        """
+        异步生成图片
+        
+        Args:
+            prompt: 正向提示词
+            trace: 调用方的 RequestTrace，用于记录各阶段 span（可选）
+            seed: 固定基础种子（可选，默认随机）
+            job: 结果要发往的会话 {"target": unified_msg_origin, "platform": 平台名}，提供时写入任务日志（可选）
+
+        Raises:
+            JobHandedOff: 插件关闭时任务仍未完成，已交给重载后的实例继续取回
+        """
+        labels = self.metric_labels()
+        trace = trace or NULL_TRACE
+        trace.set_attr("workflow", self.wf_filename)
+        JOBS_IN_FLIGHT.inc(**labels)
+        if self.residency is not None:
+            self.residency.touch()
+        outcome = "error"
+        try:
+            img_data, error_msg = await self._generate(prompt, labels, trace, seed, job)
+            if img_data:
+                outcome = "success"
+                if self.residency is not None:
+                    self.residency.mark_loaded(labels["workflow"])
+            elif error_msg == GENERATE_TIMEOUT_MSG:
+                outcome = "timeout"
+            return img_data, error_msg
+        except JobHandedOff:
+            outcome = "handoff"
+            raise
+        finally:
+            JOBS_IN_FLIGHT.dec(**labels)
+            JOBS_TOTAL.inc(outcome=outcome, **labels)
+
+    def metric_labels(self) -> dict:
+        """指标标签：按工作流文件 + 后端地址区分"""
+        return {"workflow": self.wf_filename, "backend": self.url}
+
+    def _observe_execution(self, entry: dict, submitted_at: float, labels: dict, trace=NULL_TRACE):
+        """用 history 中的 execution_start/结束时间戳拆分排队与执行耗时"""
+        done_at = time.time()
+        started = finished = None
+        messages = (entry.get("status") or {}).get("messages") or []
+        for msg in messages:
+            if not (isinstance(msg, (list, tuple)) and len(msg) == 2 and isinstance(msg[1], dict)):
+                continue
+            ts = msg[1].get("timestamp")
+            if not isinstance(ts, (int, float)):
+                continue
+            if msg[0] == "execution_start":
+                started = ts / 1000
+            elif msg[0] in ("execution_success", "execution_error", "execution_interrupted"):
+                finished = ts / 1000
+
+        total = done_at - submitted_at
+        if started is None:
+            observe_stage("execute", total, **labels)
+            trace.add_span("execute", submitted_at, total)
+            return
+        # 两端时钟可能不同步，限制在本地观测到的总耗时内
+        queue_wait = min(max(started - submitted_at, 0.0), total)
+        execute = min(max((finished or done_at) - started, 0.0), total - queue_wait)
+        observe_stage("queue_wait", queue_wait, **labels)
+        observe_stage("execute", execute, **labels)
+        trace.add_span("queue_wait", submitted_at, queue_wait)
+        trace.add_span("execute", submitted_at + queue_wait, execute)
+
+    async def get_queue_size(self) -> int:
+        """后端队列中正在执行 + 等待执行的任务数"""
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=DEFAULT_CONNECT_TIMEOUT)) as session:
+            async with session.get(f"{self.url}/queue") as resp:
+                if resp.status != 200:
+                    raise RuntimeError(f"查询队列失败: {resp.status}")
+                data = await resp.json()
+        return len(data.get("queue_running") or []) + len(data.get("queue_pending") or [])
+
+    async def free_models(self) -> bool:
+        """请求后端卸载模型并释放显存（ComfyUI /free 接口）"""
+        payload = {"unload_models": True, "free_memory": True}
         try:
-            workflow = self._load_workflow()
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=DEFAULT_CONNECT_TIMEOUT)) as session:
+                async with session.post(f"{self.url}/free", json=payload) as resp:
+                    freed = resp.status == 200
         except Exception as e:
-            return None, str(e)
-        
-        self._inject_params(workflow, prompt)
+            logger.warning(f"[ComfyUI] 释放模型失败: {e}")
+            return False
+        if freed and self.residency is not None:
+            self.residency.mark_freed()
+        return freed
 
+    async def warm_up(self, timeout: float = 600, on_submitted=None) -> tuple:
+        """
+        提交一个最小任务（小画布、1 步、不保存图片）让后端加载当前工作流的模型，返回 (是否成功, 错误信息)
+        种子每次随机：完全相同的任务会命中 ComfyUI 的执行缓存，直接返回而不加载模型
+        不计入出图指标，也不写任务日志；on_submitted(prompt_id) 在提交成功后调用，供调用方在取消时撤销任务
+        """
+        try:
+            workflow = normalize(self._load_workflow())
+            entry = self.workflow_index.get(self.wf_filename) if self.workflow_index is not None else None
+            meta = entry.compiled if entry is not None and entry.compiled else analyze(workflow)
+            self._inject_params(workflow, WARM_UP_PROMPT)
+            workflow = warm_up_workflow(workflow, meta)
+        except (ValueError, FileNotFoundError) as e:
+            return False, str(e)
+
+        deadline = time.monotonic() + timeout
         async with aiohttp.ClientSession() as session:
-            payload = {"prompt": workflow, "client_id": client_id}
+            payload = {"prompt": workflow, "client_id": f"warmup-{random.randint(100000, 999999)}"}
+            submit = asyncio.ensure_future(self._submit(session, self.url, payload))
             try:
-                async with session.post(f"{self.url}/prompt", json=payload) as resp:
-                    if resp.status != 200:
-                        return None, f"连接 ComfyUI 失败: {resp.status}"
-                    res_json = await resp.json()
-                    prompt_id = res_json.get("prompt_id")
+                status, res_json = await asyncio.shield(submit)
+            except asyncio.CancelledError:
+                await self._revoke_submitted(submit)
+                raise
             except Exception as e:
-                return None, f"请求报错: {str(e)}"
-
-            for _ in range(300): 
+                return False, f"请求报错: {e}"
+            if status != 200:
+                return False, f"提交失败: {status}"
+            prompt_id = res_json.get("prompt_id")
+            if on_submitted is not None:
+                on_submitted(prompt_id)
+
+            while time.monotonic() < deadline:
                 await asyncio.sleep(1)
+                if self.closing:
+                    return False, "插件正在关闭"
                 try:
                     async with session.get(f"{self.url}/history/{prompt_id}") as h_resp:
                         if h_resp.status != 200:
                             continue
                         history = await h_resp.json()
-                except:
+                except Exception:
                     continue
-
                 if prompt_id in history:
-                    outputs = history[prompt_id].get("outputs", {})
-                    img_info = None
-                    
-                    if self.output_id and self.output_id in outputs:
-                        imgs = outputs[self.output_id].get("images", [])
-                        if imgs:
-                            img_info = imgs[0]
-                    
-                    if not img_info:
-                        for node_out in outputs.values():
-                            if "images" in node_out and node_out["images"]:
-                                img_info = node_out["images"][0]
-                                break
-                    
-                    if img_info:
-                        fname = img_info['filename']
-                        sfolder = img_info['subfolder']
-                        itype = img_info['type']
-                        img_url = f"{self.url}/view?filename={fname}&subfolder={sfolder}&type={itype}"
-                        
+                    status = (history[prompt_id].get("status") or {}).get("status_str")
+                    return (False, "预热任务执行失败") if status == "error" else (True, "")
+        return False, "预热超时"
+
+    async def _generate(self, prompt, labels, trace, seed=None, job=None):
+        client_id = str(random.randint(100000, 999999))
+        try:
+            with trace.span("load_workflow"):
+                workflow = self._load_workflow()
+        except Exception as e:
+            return None, str(e)
+        
+        with trace.span("inject_params"):
+            self._inject_params(workflow, prompt, seed=seed)
+            if self.prune_unreachable:
+                trace.set_attr("pruned_nodes", self._prune_workflow(workflow))
+
+        async with aiohttp.ClientSession() as session:
+            payload = {"prompt": workflow, "client_id": client_id}
+            submitted_at = time.time()
+            submit = asyncio.ensure_future(self._submit(session, self.url, payload))
+            try:
+                with time_stage("submit", **labels), trace.span("submit"):
+                    status, res_json = await asyncio.shield(submit)
+            except asyncio.CancelledError:
+                # 取消时 POST 可能已经到达后端：等它返回拿到 prompt_id 再撤销，否则队列里会留下没人取回的任务
+                await self._revoke_submitted(submit)
+                raise
+            except Exception as e:
+                return None, f"请求报错: {str(e)}"
+            if status != 200:
+                STAGE_ERRORS_TOTAL.inc(stage="submit", **labels)
+                return None, f"连接 ComfyUI 失败: {status}"
+            prompt_id = res_json.get("prompt_id")
+            trace.set_attr("prompt_id", prompt_id)
+
+            journal = self.journal if job else None
+            if journal is not None:
+                journal.submitted(prompt_id, self.url, self.output_id, job.get("target"), job.get("platform", ""),
+                                  prompt, submitted_at)
+            try:
+                return await self._poll_result(session, self.url, prompt_id, self.output_id, submitted_at,
+                                               labels, trace, 300)
+            except asyncio.CancelledError:
+                # 插件关闭导致的取消交给重载后的实例继续取回；其余取消（例如提前提交后被拒绝）同时撤销后端任务
+                if not self.closing:
+                    self._spawn(self.cancel_prompt(prompt_id))
+                raise
+            finally:
+                # 只有关闭时保留记录，由重载后的实例继续取回
+                if journal is not None and not self.closing:
+                    journal.finished(prompt_id)
+
+    @staticmethod
+    async def _submit(session, url: str, payload: dict) -> tuple:
+        """提交任务，返回 (HTTP 状态码, 响应 JSON)"""
+        async with session.post(f"{url}/prompt", json=payload) as resp:
+            return resp.status, (await resp.json() if resp.status == 200 else None)
+
+    async def _revoke_submitted(self, submit):
+        """等待被取消的提交请求结束；后端已经接收时撤销这个任务"""
+        try:
+            status, res_json = await submit
+        except Exception:
+            return
+        prompt_id = (res_json or {}).get("prompt_id") if status == 200 else None
+        if prompt_id:
+            self._spawn(self.cancel_prompt(prompt_id))
+
+    def _spawn(self, coro):
+        """后台运行，不随调用方一起被取消"""
+        task = asyncio.get_running_loop().create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def cancel_prompt(self, prompt_id: str, url: str = None) -> bool:
+        """
+        撤销已提交的任务：还在排队时从队列删除，正在执行时中断
+        /interrupt 带上 prompt_id，只中断这个任务（旧版 ComfyUI 忽略参数、中断当前任务，此前已确认当前任务就是它）
+        """
+        url = url or self.url
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=DEFAULT_CONNECT_TIMEOUT)) as session:
+                async with session.get(f"{url}/queue") as resp:
+                    data = await resp.json() if resp.status == 200 else {}
+                running = {item[1] for item in data.get("queue_running") or []
+                           if isinstance(item, (list, tuple)) and len(item) > 1}
+                if prompt_id in running:
+                    async with session.post(f"{url}/interrupt", json={"prompt_id": prompt_id}) as resp:
+                        ok = resp.status == 200
+                else:
+                    async with session.post(f"{url}/queue", json={"delete": [prompt_id]}) as resp:
+                        ok = resp.status == 200
+        except Exception as e:
+            logger.warning(f"[ComfyUI] 撤销任务 {prompt_id} 失败: {e}")
+            return False
+        logger.info(f"[ComfyUI] 🛑 已撤销后端任务 {prompt_id}{'（执行中，已中断）' if prompt_id in running else ''}")
+        return ok
+
+    async def resume(self, prompt_id: str, url: str, output_id: str, submitted_at: float, timeout: float):
+        """
+        继续等待重启前提交的任务（ComfyUI 端的任务不受插件重启影响）
+        任务既不在 /history 也不在队列中时（例如后端也重启过）直接放弃
+        """
+        labels = {"workflow": self.wf_filename, "backend": url}
+        async with aiohttp.ClientSession() as session:
+            if not await self._in_history(session, url, prompt_id):
+                if not await self._in_queue(session, url, prompt_id) \
+                        and not await self._in_history(session, url, prompt_id):
+                    return None, "任务已不在 ComfyUI 队列中"
+            return await self._poll_result(session, url, prompt_id, output_id, submitted_at, labels, NULL_TRACE,
+                                           max(int(timeout), 1), first_delay=0)
+
+    async def _in_history(self, session, url: str, prompt_id: str) -> bool:
+        try:
+            async with session.get(f"{url}/history/{prompt_id}") as resp:
+                return resp.status == 200 and prompt_id in await resp.json()
+        except Exception:
+            return False
+
+    async def _in_queue(self, session, url: str, prompt_id: str) -> bool:
+        try:
+            async with session.get(f"{url}/queue") as resp:
+                if resp.status != 200:
+                    return True   # 查不到队列时按仍在排队处理，交给超时兜底
+                data = await resp.json()
+        except Exception:
+            return True
+        for item in (data.get("queue_running") or []) + (data.get("queue_pending") or []):
+            if isinstance(item, (list, tuple)) and len(item) > 1 and item[1] == prompt_id:
+                return True
+        return False
+
+    async def _poll_result(self, session, url, prompt_id, output_id, submitted_at, labels, trace, attempts,
+                           first_delay=1):
+        """每秒轮询 /history，完成后下载第一张输出图片"""
+        for attempt in range(attempts):
+            if attempt or first_delay:
+                await asyncio.sleep(1)
+            if self.closing:
+                raise JobHandedOff(GENERATE_HANDOFF_MSG)
+            try:
+                async with session.get(f"{url}/history/{prompt_id}") as h_resp:
+                    if h_resp.status != 200:
+                        continue
+                    history = await h_resp.json()
+            except:
+                continue
+
+            if prompt_id in history:
+                self._observe_execution(history[prompt_id], submitted_at, labels, trace)
+                outputs = history[prompt_id].get("outputs", {})
+                img_info = None
+
+                if output_id and output_id in outputs:
+                    imgs = outputs[output_id].get("images", [])
+                    if imgs:
+                        img_info = imgs[0]
+
+                if not img_info:
+                    for node_out in outputs.values():
+                        if "images" in node_out and node_out["images"]:
+                            img_info = node_out["images"][0]
+                            break
+
+                if img_info:
+                    fname = img_info['filename']
+                    sfolder = img_info['subfolder']
+                    itype = img_info['type']
+                    img_url = f"{url}/view?filename={fname}&subfolder={sfolder}&type={itype}"
+
+                    with time_stage("download", **labels), trace.span("download"):
                         async with session.get(img_url) as img_res:
                             if img_res.status == 200:
                                 return await img_res.read(), None 
                             else:
+                                STAGE_ERRORS_TOTAL.inc(stage="download", **labels)
                                 return None, "下载图片失败"
-                    else:
-                        return None, "工作流执行完成，但未找到输出图片"
-            
-            return None, "生成超时"
\ No newline at end of file
+                else:
+                    return None, "工作流执行完成，但未找到输出图片"
+
+        return None, GENERATE_TIMEOUT_MSG
\ No newline at end of file
@@ -0,0 +1,21 @@
+"""
+数据目录下的文件写入
+"""
+
+import os
+from pathlib import Path
+
+
+def atomic_write(path: Path, data: bytes):
+    """
+    先写同目录下的临时文件再替换：读取方只会看到旧文件或完整的新文件，
+    并发启动或中途退出也不会留下写了一半的内容
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
@@ -0,0 +1,161 @@
+"""
+对话历史中 <pic> 标签的增量清理
+
+按对话记录水位：上次读到的历史 JSON 字符串的位置（末尾 `]` 之前）以及该位置前的一小段签名。
+框架追加新消息时旧内容不变，签名一致就只需要在水位之后查找 `<pic`；没有新的 `<pic` 时连 JSON 都不用解析，
+需要解析时也只解析水位之后追加的条目。历史被改写（删除、压缩、切换对话、清理结果写回）时签名对不上，自动退回全量清理
+"""
+
+import json
+from collections import OrderedDict
+
+from .tag_parser import strip_pic_tags
+
+# 水位签名长度：水位前这么多字符一致，才认为之前的内容没有被改写
+_SIG_LEN = 64
+_PIC_MARK = "<pic"
+
+
+def strip_history(history: list, start: int = 0) -> int:
+    """从 history[start:] 的 assistant 消息中删除 <pic> 标签（原地修改），返回被修改的条数"""
+    cleaned = 0
+    for entry in history[start:] if start else history:
+        if not isinstance(entry, dict) or entry.get("role") != "assistant":
+            continue
+        content = entry.get("content", "")
+        if not isinstance(content, str):
+            continue
+        stripped, count = strip_pic_tags(content)
+        if count:
+            entry["content"] = stripped.strip()
+            cleaned += 1
+    return cleaned
+
+
+class HistoryWatermarks:
+    """
+    按对话 ID 保存清理水位，只保留最近使用的 max_conversations 个对话
+    水位记在实际读到的原始字符串上；清理结果还没写回数据库时，同时缓存水位之前内容的清理结果，
+    延迟写回窗口内的后续请求读到的仍是未清理的原文，只要是在末尾追加，就把新增部分接在缓存结果后面
+    """
+
+    def __init__(self, max_conversations: int = 1024, max_pending: int = 64):
+        self.max_conversations = max(int(max_conversations), 1)
+        self.max_pending = max(int(max_pending), 1)
+        self._marks = OrderedDict()     # 对话 ID -> (位置, 签名)
+        self._pending = OrderedDict()   # 对话 ID -> 水位之前内容清理后的 JSON 字符串（尚未写回）
+
+    def __len__(self):
+        return len(self._marks)
+
+    def mark(self, key, raw):
+        """
+        记录 raw 为该对话的水位（raw 中水位之前已无待清理的 <pic>）
+        raw 为 None 表示刚把清理结果写回、不知道下次读到的字符串格式：清除水位，下次从头查找 `<pic`
+        """
+        if key is None:
+            return
+        self._pending.pop(key, None)
+        if raw is None:
+            self._marks.pop(key, None)
+            return
+        self._set_mark(key, raw)
+
+    def _set_mark(self, key, raw: str):
+        end = len(raw.rstrip()) - 1
+        if end < 0 or raw[end] != "]":
+            self.forget(key)
+            return
+        self._marks[key] = (end, raw[max(end - _SIG_LEN, 0):end])
+        self._marks.move_to_end(key)
+        while len(self._marks) > self.max_conversations:
+            old, _ = self._marks.popitem(last=False)
+            self._pending.pop(old, None)
+
+    def _set_pending(self, key, text: str):
+        self._pending[key] = text
+        self._pending.move_to_end(key)
+        while len(self._pending) > self.max_pending:
+            # 缓存结果被淘汰后，水位之前的原文就不能再当作已清理
+            old, _ = self._pending.popitem(last=False)
+            self._marks.pop(old, None)
+
+    def forget(self, key):
+        self._marks.pop(key, None)
+        self._pending.pop(key, None)
+
+    def _resume(self, key, raw: str) -> int:
+        """水位仍然有效时返回字符位置，否则返回 0"""
+        mark = self._marks.get(key)
+        if mark is None:
+            return 0
+        offset, sig = mark
+        if len(raw) <= offset or not raw.startswith(sig, offset - len(sig)):
+            return 0
+        return offset
+
+    def clean(self, key, raw: str) -> tuple:
+        """
+        清理 JSON 字符串形式的历史
+        返回 (清理后的 JSON 字符串, 本次新清理的条数)；原文不需要改动时返回 (None, 0)
+        清理结果写回数据库后由调用方调用 mark(key, None)
+        """
+        offset = self._resume(key, raw)
+        if offset:
+            rest = raw[offset:].lstrip()
+            if rest.startswith("]"):
+                # 与上次读到的内容相同
+                return self._pending.get(key), 0
+            if rest.startswith(","):
+                result = self._clean_tail(key, raw, offset, rest)
+                if result is not None:
+                    return result
+        return self._clean_full(key, raw)
+
+    def _clean_tail(self, key, raw: str, offset: int, rest: str):
+        """只处理水位之后追加的条目；追加部分无法单独解析时返回 None，由调用方全量清理"""
+        pending = self._pending.get(key)
+        if raw.find(_PIC_MARK, offset) < 0:
+            self._set_mark(key, raw)
+            if pending is None:
+                return None, 0
+            text = pending[:-1] + raw[offset:]
+            self._set_pending(key, text)
+            return text, 0
+
+        try:
+            tail = json.loads("[" + rest[1:])
+        except ValueError:
+            return None
+        if not isinstance(tail, list):
+            return None
+        cleaned = strip_history(tail)
+        self._set_mark(key, raw)
+        if not cleaned and pending is None:
+            # 新内容里的 <pic 不是完整标签（或在用户消息里），同样不必再看
+            return None, 0
+        base = pending if pending is not None else raw[:offset] + "]"
+        text = base[:-1] + ", " + json.dumps(tail)[1:] if cleaned else base[:-1] + raw[offset:]
+        self._set_pending(key, text)
+        return text, cleaned
+
+    def _clean_full(self, key, raw: str) -> tuple:
+        self._pending.pop(key, None)
+        if raw.find(_PIC_MARK) < 0:
+            self._set_mark(key, raw)
+            return None, 0
+        try:
+            history = json.loads(raw)
+        except ValueError:
+            history = None
+        if not isinstance(history, list):
+            self.forget(key)
+            return None, 0
+        cleaned = strip_history(history)
+        self._set_mark(key, raw)
+        if not cleaned:
+            return None, 0
+        # 与框架序列化格式一致
+        text = json.dumps(history)
+        self._set_pending(key, text)
+        return text, cleaned
@@ -0,0 +1,144 @@
+"""
+生成任务日志：把已提交给 ComfyUI、还没有结果的任务记录在数据目录下的 SQLite 中
+
+插件或 AstrBot 在生成途中重启时，ComfyUI 仍会把任务跑完；启动后按日志里的 prompt_id 到 /history 取回结果，
+发给原来的会话，超过有效期的记录直接丢弃
+
+写入放大尽量小：
+- WAL 模式 + synchronous=NORMAL，提交不需要每次 fsync 主库
+- 提交/完成先放进内存缓冲区，延迟 flush_delay 秒后在一个事务里批量写入
+- 同一个缓冲周期内提交并完成的任务（大多数快速任务）两条操作互相抵消，不产生任何写入
+- 任务完成直接删除记录，表里只留未完成的任务
+"""
+
+import asyncio
+import sqlite3
+import time
+from pathlib import Path
+
+from astrbot.api import logger
+
+
+class JobHandedOff(Exception):
+    """插件关闭时任务仍在等待结果：记录保留在任务日志中，由重载后的实例取回并发送，调用方不应按失败处理"""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    prompt_id    TEXT PRIMARY KEY,
+    backend      TEXT NOT NULL,
+    output_id    TEXT,
+    target       TEXT NOT NULL,
+    platform     TEXT,
+    prompt       TEXT,
+    submitted_at REAL NOT NULL
+)
+"""
+_COLUMNS = ("prompt_id", "backend", "output_id", "target", "platform", "prompt", "submitted_at")
+
+
+class JobJournal:
+    def __init__(self, path: Path, flush_delay: float = 1.0, max_age: float = 1800):
+        self.path = Path(path)
+        self.flush_delay = max(float(flush_delay), 0.0)
+        self.max_age = float(max_age)
+        self._conn = None
+        self._inserts = {}      # prompt_id -> 行
+        self._deletes = set()
+        self._flush_handle = None
+        self.writes = 0         # 已执行的批量事务数
+
+    def open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(_SCHEMA)
+        self._conn = conn
+
+    @property
+    def is_open(self) -> bool:
+        return self._conn is not None
+
+    # ====== 记录 ======
+    def submitted(self, prompt_id: str, backend: str, output_id: str, target: str, platform: str = "",
+                  prompt: str = "", submitted_at: float = None):
+        if not self.is_open or not prompt_id or not target:
+            return
+        self._deletes.discard(prompt_id)
+        self._inserts[prompt_id] = (
+            prompt_id, backend, output_id, target, platform, prompt,
+            time.time() if submitted_at is None else submitted_at,
+        )
+        self._schedule_flush()
+
+    def finished(self, prompt_id: str):
+        if not self.is_open or not prompt_id:
+            return
+        if self._inserts.pop(prompt_id, None) is None:
+            self._deletes.add(prompt_id)
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        self._flush_handle = loop.call_later(self.flush_delay, self.flush)
+
+    def flush(self):
+        """把缓冲区里的操作在一个事务中写入"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self.is_open or not (self._inserts or self._deletes):
+            return
+        inserts, deletes = list(self._inserts.values()), [(pid,) for pid in self._deletes]
+        self._inserts, self._deletes = {}, set()
+        try:
+            with self._conn:   # 一个事务，出错自动回滚
+                if inserts:
+                    self._conn.executemany(
+                        f"INSERT OR REPLACE INTO jobs ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})",
+                        inserts,
+                    )
+                if deletes:
+                    self._conn.executemany("DELETE FROM jobs WHERE prompt_id = ?", deletes)
+            self.writes += 1
+        except sqlite3.Error as e:
+            logger.warning(f"[ComfyUI] 写入任务日志失败: {e}")
+
+    # ====== 启动恢复 ======
+    def pending(self) -> list:
+        """未完成的任务 [dict]，按提交时间排序"""
+        if not self.is_open:
+            return []
+        self.flush()
+        rows = self._conn.execute(f"SELECT {', '.join(_COLUMNS)} FROM jobs ORDER BY submitted_at").fetchall()
+        return [dict(zip(_COLUMNS, row)) for row in rows]
+
+    def expire(self, now: float = None) -> int:
+        """删除超过有效期的记录，返回删除条数"""
+        if not self.is_open:
+            return 0
+        self.flush()
+        cutoff = (time.time() if now is None else now) - self.max_age
+        try:
+            with self._conn:
+                cur = self._conn.execute("DELETE FROM jobs WHERE submitted_at < ?", (cutoff,))
+        except sqlite3.Error as e:
+            logger.warning(f"[ComfyUI] 清理任务日志失败: {e}")
+            return 0
+        return cur.rowcount
+
+    def close(self):
+        if not self.is_open:
+            return
+        self.flush()
+        try:
+            self._conn.close()
+        finally:
+            self._conn = None
+
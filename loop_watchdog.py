@@ -0,0 +1,150 @@
+import sys
+import time
+import asyncio
+import threading
+import traceback
+from pathlib import Path
+from astrbot.api import logger
+
+from .metrics import REGISTRY
+
+LOOP_STALLS_TOTAL = REGISTRY.counter(
+    "comfyui_loop_stalls_total", "Event loop stalls over the watchdog threshold by suspected handler",
+    ("handler",),
+)
+LOOP_STALL_SECONDS = REGISTRY.histogram(
+    "comfyui_loop_stall_seconds", "Event loop lag of detected stalls",
+    buckets=(0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30),
+)
+
+# 归因时跳过的包装层函数名（装饰器产生的 wrapper 不是真正的处理函数）
+_WRAPPER_NAMES = {"wrapper", "decorator"}
+# 堆栈样本最多保留的帧数
+_STACK_LIMIT = 12
+
+
+class _StallStats:
+    __slots__ = ("count", "total", "max", "last_stack", "last_at")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last_stack = ""
+        self.last_at = 0.0
+
+
+class LoopStallWatchdog:
+    """
+    事件循环卡顿检测
+    - 心跳协程每 interval 秒醒来一次，用实际睡眠时长减去预期时长得到循环延迟
+    - 守护线程监视心跳，延迟超过阈值时对事件循环线程做一次堆栈采样，
+      并把卡顿归因到当时正在执行的本插件处理函数（不在本插件内则记为外部代码）
+    """
+
+    def __init__(self, plugin_dir: Path, threshold_ms: float = 200, interval: float = 0.1):
+        # 插件可能通过软链接安装，原始路径和解析后的路径都算插件内
+        self._plugin_prefixes = tuple({str(Path(plugin_dir)), str(Path(plugin_dir).resolve())})
+        self.threshold = max(float(threshold_ms or 200), 10.0) / 1000
+        self.interval = max(float(interval), 0.01)
+        self.stats = {}
+        self._beat = 0.0
+        self._sample = None
+        self._loop_thread_id = None
+        self._task = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.perf_counter()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._monitor, name="comfyui-loop-watchdog", daemon=True)
+        self._thread.start()
+        logger.info(f"[ComfyUI] 🐕 事件循环卡顿检测已开启，阈值 {int(self.threshold * 1000)}ms")
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._thread = None
+
+    def reset(self):
+        self.stats.clear()
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            self._beat = now
+            lag = now - expected
+            if lag >= self.threshold:
+                self._record(lag)
+            else:
+                self._sample = None
+
+    def _monitor(self):
+        """守护线程：心跳停跳超过阈值时采样一次事件循环线程的堆栈"""
+        poll = min(self.interval, self.threshold / 2)
+        while not self._stop.wait(poll):
+            if self._sample is not None:
+                continue
+            if time.perf_counter() - self._beat - self.interval < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            try:
+                self._sample = self._attribute(frame)
+            finally:
+                del frame
+
+    def _attribute(self, frame) -> tuple:
+        """返回 (处理函数名, 堆栈文本)"""
+        stack = traceback.extract_stack(frame)
+        handler = None
+        for entry in stack:
+            if not entry.filename.startswith(self._plugin_prefixes):
+                continue
+            if entry.name in _WRAPPER_NAMES:
+                continue
+            # 取最外层的插件帧：即框架直接调用的处理函数
+            handler = entry.name
+            break
+        if handler is None:
+            inner = stack[-1] if stack else None
+            handler = f"(外部) {Path(inner.filename).name}:{inner.name}" if inner else "(未知)"
+        text = "".join(traceback.format_list(stack[-_STACK_LIMIT:]))
+        return handler, text
+
+    def _record(self, lag: float):
+        sample, self._sample = self._sample, None
+        handler, stack_text = sample if sample else ("(未采样)", "")
+        st = self.stats.get(handler)
+        if st is None:
+            st = self.stats[handler] = _StallStats()
+        st.count += 1
+        st.total += lag
+        st.max = max(st.max, lag)
+        st.last_at = time.time()
+        if stack_text:
+            st.last_stack = stack_text
+
+        LOOP_STALLS_TOTAL.inc(handler=handler)
+        LOOP_STALL_SECONDS.observe(lag)
+        logger.warning(f"[ComfyUI] 🐢 事件循环阻塞 {lag * 1000:.0f}ms，疑似来源: {handler}")
+        if stack_text:
+            logger.debug(f"[ComfyUI] 阻塞时堆栈采样:\n{stack_text}")
+
+    def worst_offenders(self, limit: int = 5) -> list:
+        """按最长单次阻塞排序，返回 [(处理函数名, _StallStats), ...]"""
+        return sorted(self.stats.items(), key=lambda kv: (kv[1].max, kv[1].total), reverse=True)[:limit]
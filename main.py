@@ -6,6 +6,10 @@ import traceback
 import json
 import shutil
 import asyncio
+import functools
+import hashlib
+import math
+import threading
 from pathlib import Path
 from astrbot.api.event import filter, AstrMessageEvent, MessageEventResult
 from astrbot.api.star import Context, Star, register
@@ -13,6 +17,23 @@ from astrbot.api.message_components import *
 from astrbot.api import llm_tool, logger
 from astrbot.api.provider import LLMResponse
 from astrbot.core.message.message_event_result import MessageChain
+from .metrics import (
+    ADMISSION_TOTAL, IMAGES_SENT_TOTAL, STAGE_SECONDS, MetricsExporter,
+    format_summary, observe_stage, time_stage,
+)
+from .tracing import NULL_TRACE, TraceExporter
+from .loop_watchdog import LoopStallWatchdog
+from .traffic import TrafficRecorder
+from .capacity import CapacityBenchmark, format_report
+from .profiling import PluginProfiler
+from .tag_parser import parse_reply, clean_prompt, is_placeholder, PicStreamDetector
+from .history_cleaner import HistoryWatermarks, strip_history
+from .prompt_sessions import PromptSessions
+from .rate_limit import QuotaLimiter
+from .job_journal import JobHandedOff, JobJournal
+from .workflow_compiler import WorkflowCompileError, compile_workflow, compiled_path, save_compiled
+from .workflow_index import SEEDS_SUFFIX, WorkflowIndex, describe_seed_policy, sidecar_name
+from .sensitive_matcher import SensitiveMatcher, diff_lexicon, lexicon_digest, load_matchers, save_matchers
 # 尝试导入 StarTools（兼容不同版本）
 try:
     from astrbot.api.star import StarTools
@@ -23,6 +44,64 @@ except ImportError:
 
 # 获取插件目录（用于读取默认文件）
 PLUGIN_DIR = Path(os.path.dirname(os.path.abspath(__file__)))
+# 插件注册名，也是数据目录名
+PLUGIN_NAME = "astrbot_plugin_comfyui_pro"
+# memory 模式下交给框架发送的临时图片保留时长（秒）
+TEMP_IMAGE_TTL = 300
+# /comfy_profile 的默认与最长剖析时长（秒）
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 600
+# 注入的系统提示词末尾的指纹标记前缀，用于判断本次请求是否已经注入过
+PROMPT_MARKER_PREFIX = "<!-- comfyui-prompt:"
+# 其他插件在注入块之后追加内容时，只在系统提示词末尾这么多字符内查找指纹
+PROMPT_MARKER_TAIL = 512
+# /comfy_prompt 可设置的会话模式
+PROMPT_MODES = ("auto", "full", "compact", "off")
+# 限流器刷新后端队列深度、单张耗时并保存快照的间隔（秒）
+QUOTA_POLL_SECONDS = 15
+# 回复结束后延迟多久把清理后的历史写回数据库（秒），期间同一对话的多次清理合并为一次写入
+HISTORY_CLEANUP_DELAY = 3.0
+# 流式提前提交的任务最长保留多久（秒）：回复始终没有进入出图流程时（事件被终止、回复被丢弃等）到期撤销并退还额度
+EARLY_JOB_TTL = 600
+# 重启后继续取回生成结果的时限（秒）：提交超过这么久的任务记录直接丢弃
+JOB_RESUME_MAX_AGE = 900
+
+
+def _admission_check(check: str):
+    """准入检查装饰器：记录检查耗时与通过/拒绝次数，被装饰方法需返回 (是否通过, ...)"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            result = func(self, *args, **kwargs)
+            ADMISSION_TOTAL.inc(check=check, result="pass" if result[0] else "reject")
+            observe_stage("admission", time.perf_counter() - start, **self._metric_labels())
+            return result
+        return wrapper
+    return decorator
+
+
+def _traced(span_name: str):
+    """把整个钩子记为 event 上请求追踪的一个 span（event 上没有追踪时原样调用）"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, event, *args, **kwargs):
+            trace = self._get_trace(event, create=False)
+            with trace.span(span_name):
+                return await func(self, event, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _fingerprint_prompt(prompt: str):
+    """在提示词末尾加上内容指纹，返回 (注入块, 指纹标记)；提示词为空时返回 None"""
+    prompt = (prompt or "").strip()
+    if not prompt:
+        return None
+    marker = f"{PROMPT_MARKER_PREFIX}{hashlib.sha1(prompt.encode('utf-8')).hexdigest()[:12]} -->"
+    return f"{prompt}\n{marker}", marker
+
+
 class _ComfyImageMarker:
     """多图模式的图片占位标记，存储 prompt 信息，在 chain 中占位"""
     def __init__(self, prompt: str, index: int):
@@ -30,7 +109,7 @@ class _ComfyImageMarker:
         self.index = index
 
 @register(
-    "astrbot_plugin_comfyui_pro",  
+    PLUGIN_NAME,  
     "lumingya",                    
     "ComfyUI Pro 连接器",           
     "1.2.0",
@@ -52,6 +131,9 @@ class ComfyUIPlugin(Star):
         self.workflow_dir = self.data_dir / "workflow"
         self.output_dir = self.data_dir / "output"
         self.sensitive_words_path = self.data_dir / "sensitive_words.json"
+        # 工作流目录索引：命令、UI 下拉列表与 API 客户端共用；_workflow_listing 为上次 /comfy_ls 展示的顺序
+        self.workflow_index = WorkflowIndex(self.workflow_dir)
+        self._workflow_listing = ()
         
         # ====== 4. 更新 UI 配置 ======
         self._auto_update_schema()
@@ -59,7 +141,19 @@ class ComfyUIPlugin(Star):
         # Control 配置
         control_conf = config.get("control", {})
         self.cooldown_seconds = control_conf.get("cooldown_seconds", 60)
-        self.user_cooldowns = {}
+        # 令牌桶限流：额度按预估 GPU 秒计费，cooldown_seconds 为用户额度从用完到恢复满的时长
+        self.quota = QuotaLimiter(
+            user_capacity=control_conf.get("user_quota_gpu_seconds", 0) or 0,
+            user_refill=self.cooldown_seconds or 0,
+            group_capacity=control_conf.get("group_quota_gpu_seconds", 0) or 0,
+            group_refill=control_conf.get("group_quota_refill_seconds", 600) or 600,
+            image_seconds=control_conf.get("image_gpu_seconds", 15) or 15,
+            slowdown_depth=control_conf.get("quota_slowdown_queue_depth", 4) or 0,
+        )
+        self._quota_path = self.data_dir / "rate_limit.json"
+        self.quota.load(self._quota_path)
+        self._quota_task = None
+        self._execute_seen = (0.0, 0)
         self.admin_user_ids = set(map(str, control_conf.get("admin_ids", [])))
         self.lockdown = bool(control_conf.get("lockdown", False))
         self.lockdown_command_enabled = bool(control_conf.get("lockdown_command_enabled", True))
@@ -71,7 +165,36 @@ class ComfyUIPlugin(Star):
         
         self.discard_prompt_from_history = llm_settings.get("discard_prompt_from_history", False)
         if self.discard_prompt_from_history:
-            logger.info("[ComfyUI] 🗑️ 绘图提示词历史丢弃: 开启")       
+            logger.info("[ComfyUI] 🗑️ 绘图提示词历史丢弃: 开启")
+        # 每个对话已清理到的位置，只处理新增的历史；待写回数据库的对话 {umo: 延迟写入任务}
+        self._history_marks = HistoryWatermarks()
+        self._history_flush_tasks = {}
+
+        self.streaming_early_dispatch = llm_settings.get("streaming_early_dispatch", False)
+        if self.streaming_early_dispatch:
+            logger.info("[ComfyUI] ⚡ 流式提前出图: 开启")
+
+        # 系统提示词：完整版 / 精简版各自带上指纹，连续多轮未画图的会话改用精简版
+        full_prompt = llm_settings.get("system_prompt", "")
+        self._prompt_variants = {
+            "full": _fingerprint_prompt(full_prompt),
+            "compact": _fingerprint_prompt(llm_settings.get("compact_system_prompt", "") or full_prompt),
+        }
+        self.compact_prompt_after_turns = max(int(llm_settings.get("compact_prompt_after_turns", 10) or 0), 0)
+        # 每个会话距上次出现 <pic> 的 LLM 请求数、/comfy_prompt 设置的模式（模式保存在数据目录，重载后仍生效）
+        self.prompt_sessions = PromptSessions(PROMPT_MODES)
+        self._prompt_sessions_path = self.data_dir / "prompt_modes.json"
+        self.prompt_sessions.load(self._prompt_sessions_path)
+
+        # 输出配置
+        output_conf = config.get("output_settings", {})
+        self.delivery_mode = str(output_conf.get("delivery_mode", "disk")).lower()
+        if self.delivery_mode not in ("disk", "memory"):
+            logger.warning(f"[ComfyUI] 未知的图片投递模式 {self.delivery_mode}，已回退为 disk")
+            self.delivery_mode = "disk"
+        self.path_required_platforms = set(map(str, output_conf.get("path_required_platforms", [])))
+        self.temp_dir = self.data_dir / "tmp"
+        logger.info(f"[ComfyUI] 📦 图片投递模式: {self.delivery_mode}")
         # 策略配置
         self.default_group_policy = str(control_conf.get("default_group_policy", "none")).lower()
         self.default_private_policy = str(control_conf.get("default_private_policy", "none")).lower()
@@ -99,33 +222,97 @@ class ComfyUIPlugin(Star):
             logger.warning("[ComfyUI]⚠️ 绘图功能全局锁定已启用，仅超级管理员可用")
         logger.info(f"[ComfyUI] 🔐 锁定命令开关: {'开启' if self.lockdown_command_enabled else '关闭'}")
 
-        # 加载敏感词
+        # 敏感词库与匹配器在 initialize 后的后台任务中加载；在那之前到来的检查会同步加载（_ensure_sensitive_words）
         self.lexicon = {}
-        try:
-            if self.sensitive_words_path.exists():
-                with open(self.sensitive_words_path, "r", encoding="utf-8") as f:
-                    self.lexicon = json.load(f)
-                word_count = sum(len(v) for v in self.lexicon.values() if isinstance(v, list))
-                logger.info(f"[ComfyUI] 🔒 敏感词库已加载: {word_count} 个词条")
-            else:
-                self.lexicon = {"legacy_lite": [], "full": []} 
-        except Exception:
-            self.lexicon = {"legacy_lite": [], "full": []}
-
-        self._policy_patterns = {}
-        self._build_policy_patterns()
+        self._lexicon_bytes = b""
+        self._lexicon_mtime = None
+        self._policy_matchers = {}
+        self._matcher_cache_path = self.data_dir / "cache" / "sensitive_matchers.bin"
+        self._sensitive_ready = False
+        self._sensitive_init_lock = threading.Lock()
+        self._warmup_task = None
+
+        # 敏感词库热重载：/comfy_reload_words 手动触发，或按间隔检查文件修改时间
+        self.sensitive_watch_interval = float(control_conf.get("sensitive_words_watch_interval", 0) or 0)
+        self._lexicon_lock = asyncio.Lock()
+        self._lexicon_watch_task = None
         
         # 初始化 ComfyUI API
         self.comfy_ui = None
         self.api = None
         try:
             from .comfyui_api import ComfyUI
-            self.api = ComfyUI(self.config, data_dir=self.data_dir)
+            self.api = ComfyUI(self.config, data_dir=self.data_dir, workflow_index=self.workflow_index)
             logger.info(f"[ComfyUI] ✅ ComfyUI API 初始化成功")
         except Exception as e:
             logger.error(f"[ComfyUI] ❌ ComfyUI API 初始化失败: {e}")
             logger.error(traceback.format_exc())
 
+        # 任务日志：记录已提交、未出结果的任务，重启后继续取回并发到原会话
+        self.job_journal = None
+        self._resume_task = None
+        if self.api is not None:
+            journal = JobJournal(self.data_dir / "jobs.db", max_age=JOB_RESUME_MAX_AGE)
+            try:
+                journal.open()
+                self.job_journal = self.api.journal = journal
+            except Exception as e:
+                logger.warning(f"[ComfyUI] 任务日志打开失败，重启后将无法继续取回图片: {e}")
+
+        # 请求追踪（跨钩子的耗时分解，JSON Lines 导出）
+        tracing_conf = config.get("tracing", {})
+        self.trace_exporter = None
+        if tracing_conf.get("enabled", False):
+            trace_file = str(tracing_conf.get("export_file", "traces.jsonl") or "traces.jsonl").strip()
+            self.trace_exporter = TraceExporter(
+                self.data_dir / trace_file,
+                slow_threshold_ms=tracing_conf.get("slow_threshold_ms", 0),
+                max_bytes=int(tracing_conf.get("max_file_mb", 20) or 0) * 1024 * 1024,
+            )
+            logger.info(f"[ComfyUI] 🧭 请求追踪已开启: {trace_file}")
+
+        # 匿名流量录制（默认关闭，供 bench/replay.py 回放）
+        traffic_conf = config.get("traffic_capture", {})
+        self.traffic_recorder = None
+        if traffic_conf.get("enabled", False):
+            traffic_file = str(traffic_conf.get("export_file", "traffic.jsonl") or "traffic.jsonl").strip()
+            self.traffic_recorder = TrafficRecorder(
+                self.data_dir / traffic_file,
+                self.data_dir / ".traffic_salt",
+                max_bytes=int(traffic_conf.get("max_file_mb", 50) or 0) * 1024 * 1024,
+            )
+            logger.info(f"[ComfyUI] 📼 流量录制已开启: {traffic_file}")
+
+        # 容量测试（/comfy_bench）
+        bench_conf = config.get("capacity_bench", {})
+        self.bench_max_runtime = float(bench_conf.get("max_runtime_seconds", 300) or 300)
+        self.bench_jobs_per_level = int(bench_conf.get("jobs_per_level", 3) or 3)
+        self.bench_levels = [int(c) for c in bench_conf.get("concurrency_levels", [1, 2, 4]) if str(c).strip()] or [1, 2, 4]
+        self._bench_running = False
+
+        # 按需性能剖析（/comfy_profile），只在运行期间存在采样线程
+        self.profiler = PluginProfiler(PLUGIN_DIR, self.data_dir / "profiles")
+
+        # 事件循环卡顿检测（默认关闭）
+        watchdog_conf = config.get("stall_watchdog", {})
+        self.stall_watchdog = None
+        if watchdog_conf.get("enabled", False):
+            self.stall_watchdog = LoopStallWatchdog(
+                PLUGIN_DIR, threshold_ms=watchdog_conf.get("threshold_ms", 200),
+            )
+
+        # 指标导出（统计本身始终开启，这里只控制导出）
+        metrics_conf = config.get("metrics", {})
+        self.metrics_exporter = None
+        if metrics_conf.get("enabled", False):
+            export_file = str(metrics_conf.get("export_file", "metrics.prom") or "").strip()
+            self.metrics_exporter = MetricsExporter(
+                file_path=self.data_dir / export_file if export_file else None,
+                http_host=str(metrics_conf.get("http_host", "127.0.0.1")),
+                http_port=int(metrics_conf.get("http_port", 0) or 0),
+                interval=metrics_conf.get("export_interval", 15),
+            )
+
     # ====== 获取持久化目录 ======
     def _get_persistent_dir(self) -> Path:
         """获取插件的持久化数据目录"""
@@ -133,7 +320,8 @@ class ComfyUIPlugin(Star):
         
         if HAS_STAR_TOOLS:
             try:
-                data_path = StarTools.get_data_dir(self)
+                # 显式传入插件名：不传时框架会遍历所有已加载模块查找调用方，首次调用要几百毫秒
+                data_path = StarTools.get_data_dir(PLUGIN_NAME)
             except Exception:
                 try:
                     data_path = StarTools.get_data_dir()
@@ -145,7 +333,7 @@ class ComfyUIPlugin(Star):
         
         if data_path is None:
             current = Path.cwd()
-            data_path = current / "data" / "plugin_data" / "astrbot_plugin_comfyui_pro"
+            data_path = current / "data" / "plugin_data" / PLUGIN_NAME
         
         if not isinstance(data_path, Path):
             data_path = Path(data_path)
@@ -161,6 +349,15 @@ class ComfyUIPlugin(Star):
         
         workflow_dir.mkdir(exist_ok=True)
         output_dir.mkdir(exist_ok=True)
+
+        # 清理上次运行残留的临时图片
+        temp_dir = self.data_dir / "tmp"
+        if temp_dir.exists():
+            for leftover in temp_dir.glob("*.png"):
+                try:
+                    leftover.unlink()
+                except Exception:
+                    pass
         
         # 复制默认工作流
         plugin_workflow_dir = PLUGIN_DIR / "workflow"
@@ -193,16 +390,12 @@ class ComfyUIPlugin(Star):
         """扫描持久化目录的工作流，更新 UI 下拉列表"""
         try:
             schema_path = PLUGIN_DIR / '_conf_schema.json'
-            workflow_dir = self.data_dir / 'workflow'
 
-            if not workflow_dir.exists():
+            if not self.workflow_dir.exists():
                 return
 
-            # 排除 .steps.json 文件
-            files = sorted([
-                f.name for f in workflow_dir.glob("*.json")
-                if not f.name.endswith(".steps.json")
-            ])
+            # 只需要文件名，不读取工作流内容
+            files = self.workflow_index.list_files()
         
             if not files:
                 files = ["workflow_api.json"]
@@ -211,6 +404,10 @@ class ComfyUIPlugin(Star):
                 data = json.load(f)
 
             target = data['workflow_settings']['items']['json_file']
+            if target.get('options') == files and target.get('enum') == files:
+                # 列表没变就不写：避免每次加载都改写文件
+                logger.debug(f"[ComfyUI] 工作流列表无变化: {len(files)} 个可用")
+                return
             target['options'] = files
             target['enum'] = files
         
@@ -223,6 +420,7 @@ class ComfyUIPlugin(Star):
             logger.error(f"[ComfyUI] 更新工作流列表失败: {e}")
 
     # ====== 权限检查（返回原因）======
+    @_admission_check("access")
     def _check_access(self, event: AstrMessageEvent) -> tuple:
         """
         统一的权限检查，返回 (是否通过, 拒绝原因)
@@ -250,9 +448,11 @@ class ComfyUIPlugin(Star):
         
         return True, ""
 
-    def _check_cooldown(self, event: AstrMessageEvent) -> tuple:
+    @_admission_check("cooldown")
+    def _check_cooldown(self, event: AstrMessageEvent, images: int = 1, force: bool = False) -> tuple:
         """
-        冷却检查，返回 (是否通过, 剩余秒数或0)
+        额度检查：按 images 张图从用户桶和群桶扣除预估 GPU 秒，返回 (是否通过, 需等待秒数或0)
+        扣费记录挂在 event 上，生成失败时用 _refund_quota 退还
         """
         user_id = str(event.get_sender_id())
         is_admin = user_id in self.admin_user_ids
@@ -260,18 +460,35 @@ class ComfyUIPlugin(Star):
         # 管理员绕过冷却
         if is_admin and self.admin_bypass_cooldown:
             return True, 0
-        
-        current_time = time.time()
-        last_time = self.user_cooldowns.get(user_id, 0)
-        elapsed = current_time - last_time
-
-        if elapsed < self.cooldown_seconds:
-            remain = int(self.cooldown_seconds - elapsed)
-            return False, remain
 
-        self.user_cooldowns[user_id] = current_time
+        ok, wait, charge = self.quota.try_acquire(user_id, self._get_group_id(event), images, force=force)
+        if not ok:
+            return False, max(math.ceil(wait), 1)
+        if charge is not None:
+            event._comfy_quota = getattr(event, "_comfy_quota", []) + [charge]
         return True, 0
 
+    def _admit_images(self, event: AstrMessageEvent, images: int) -> tuple:
+        """
+        回复共 images 张图：流式阶段已扣过的张数不再重复扣费
+        流式阶段已放行的回复，剩余张数直接记账（余额可以为负），不会在图片生成到一半时拒绝
+        """
+        charged = sum(c.images for c in getattr(event, "_comfy_quota", []))
+        if images <= charged:
+            return True, 0
+        return self._check_cooldown(event, images - charged, force=charged > 0)
+
+    def _refund_quota(self, event: AstrMessageEvent, images: int = None):
+        """生成失败或请求被拒绝时退还额度（默认退还本事件扣过的全部额度）"""
+        for charge in reversed(getattr(event, "_comfy_quota", [])):
+            if images is not None and images <= 0:
+                break
+            take = charge.images if images is None else min(images, charge.images)
+            self.quota.refund(charge, take)
+            if images is not None:
+                images -= take
+
+    @_admission_check("sensitive")
     def _check_sensitive(self, prompt: str, event: AstrMessageEvent) -> tuple:
         """
         敏感词检查，返回 (是否通过, 触发的敏感词列表)
@@ -295,16 +512,27 @@ class ComfyUIPlugin(Star):
     async def inject_system_prompt(self, event: AstrMessageEvent, req):
         """注入系统提示词 + 清理历史中的绘图提示词"""
         try:
-            llm_settings = self.config.get("llm_settings", {}) 
-            my_prompt = llm_settings.get("system_prompt", "")
-
-            if my_prompt:
+            variant = self._select_prompt_variant(event.unified_msg_origin)
+            injected = self._prompt_variants.get(variant) if variant else None
+            if injected:
+                block, marker = injected
                 current_prompt = getattr(req, "system_prompt", "") or ""
-                if my_prompt not in current_prompt:
+                # 同一个请求注入过就记在 req 上；否则指纹在注入块末尾，通常一次 endswith 即可判断，
+                # 其他插件在后面追加了内容时只在末尾一小段里查找短前缀，不扫描整段系统提示词
+                already = (
+                    getattr(req, "_comfy_prompt_marker", None) is not None
+                    or current_prompt.endswith(marker)
+                    or PROMPT_MARKER_PREFIX in current_prompt[-PROMPT_MARKER_TAIL:]
+                )
+                if not already:
                     if current_prompt:
-                        req.system_prompt = f"{current_prompt}\n\n{my_prompt}".strip()
+                        req.system_prompt = f"{current_prompt.rstrip()}\n\n{block}"
                     else:
-                        req.system_prompt = my_prompt.strip()
+                        req.system_prompt = block
+                    try:
+                        req._comfy_prompt_marker = marker
+                    except AttributeError:
+                        pass
 
         except Exception as e:
             logger.error(f"[ComfyUI] 注入提示词异常: {e}")
@@ -316,10 +544,23 @@ class ComfyUIPlugin(Star):
             except Exception as e:
                 logger.error(f"[ComfyUI] 清理提示词异常: {e}")
 
+        if self.streaming_early_dispatch:
+            self._install_stream_tap(event)
+
+    def _select_prompt_variant(self, unified_msg_origin: str):
+        """返回本次请求注入的提示词版本（full / compact），不注入时返回 None；同时累计该会话未画图的轮数"""
+        turns = self.prompt_sessions.tick(unified_msg_origin)
+        mode = self.prompt_sessions.mode(unified_msg_origin)
+        if mode == "off":
+            return None
+        if mode != "auto":
+            return mode
+        if self.compact_prompt_after_turns and turns >= self.compact_prompt_after_turns:
+            return "compact"
+        return "full"
+
     def _clean_pic_tags_from_req(self, req):
         """从请求的 conversation.history 中清理 <pic> 标签"""
-        pic_pattern = re.compile(r'<pic\s+prompt=".*?">', re.DOTALL)
-
         conversation = getattr(req, "conversation", None)
         if conversation is None:
             logger.warning("[ComfyUI] 🗑️ req.conversation 不存在，跳过清理")
@@ -329,34 +570,73 @@ class ComfyUIPlugin(Star):
         if not history_raw:
             return
 
-        try:
-            history = json.loads(history_raw) if isinstance(history_raw, str) else history_raw
-        except (json.JSONDecodeError, TypeError):
+        if isinstance(history_raw, list):
+            cleaned = strip_history(history_raw)
+            if cleaned:
+                logger.info(f"[ComfyUI] 🗑️ 已从 conversation.history 中清理 {cleaned} 条消息的绘图提示词")
             return
-
-        if not isinstance(history, list):
+        if not isinstance(history_raw, str):
             return
 
-        cleaned = 0
-        for entry in history:
-            if not isinstance(entry, dict):
-                continue
-            if entry.get("role") != "assistant":
-                continue
-            content = entry.get("content", "")
-            if isinstance(content, str) and pic_pattern.search(content):
-                entry["content"] = pic_pattern.sub("", content).strip()
-                cleaned += 1
-
+        # 水位之后没有新的 <pic 时直接返回，不解析整段历史；
+        # 数据库还没写回时沿用上次的清理结果，只拼接新增的条目
+        conv_id = getattr(conversation, "cid", None)
+        history, cleaned = self._history_marks.clean(conv_id, history_raw)
+        if history is not None:
+            conversation.history = history
         if cleaned:
-            # 写回 conversation.history
-            conversation.history = json.dumps(history, ensure_ascii=False)
             logger.info(f"[ComfyUI] 🗑️ 已从 conversation.history 中清理 {cleaned} 条消息的绘图提示词")
 
     async def initialize(self):
         self.context.activate_llm_tool("comfyui_txt2img")
+        self._warmup_task = asyncio.create_task(self._warm_up())
+        if self.stall_watchdog:
+            self.stall_watchdog.start()
+        if self.sensitive_watch_interval > 0:
+            self._lexicon_watch_task = asyncio.create_task(self._watch_sensitive_words())
+            logger.info(f"[ComfyUI] 👀 敏感词库热重载已开启，每 {self.sensitive_watch_interval:g}s 检查一次")
+        if self.quota.enabled:
+            self._quota_task = asyncio.create_task(self._watch_backend_load())
+        if self.job_journal:
+            self._resume_task = asyncio.create_task(self._resume_journal_jobs())
+        if self.api is not None and self.api.residency is not None:
+            self.api.residency.start()
+        if self.metrics_exporter:
+            try:
+                await self.metrics_exporter.start()
+            except Exception as e:
+                logger.error(f"[ComfyUI] 指标导出启动失败: {e}")
         logger.info("[ComfyUI] 🎨 插件初始化完成，LLM 工具已激活")
 
+    async def terminate(self):
+        if self._warmup_task:
+            self._warmup_task.cancel()
+            self._warmup_task = None
+        if self.stall_watchdog:
+            self.stall_watchdog.stop()
+        if self._lexicon_watch_task:
+            self._lexicon_watch_task.cancel()
+            self._lexicon_watch_task = None
+        if self.metrics_exporter:
+            await self.metrics_exporter.stop()
+        if self.profiler.running:
+            self.profiler.stop()
+        if self._quota_task:
+            self._quota_task.cancel()
+            self._quota_task = None
+        self._save_quota()
+        await self._flush_history_cleanups()
+        # 等待中的生成任务交给重载后的实例继续取回
+        if self.api is not None:
+            self.api.closing = True
+            if self.api.residency is not None:
+                self.api.residency.stop()
+        if self._resume_task:
+            self._resume_task.cancel()
+            self._resume_task = None
+        if self.job_journal:
+            self.job_journal.close()
+
     # ====== 核心绘图逻辑 ======
     async def _handle_paint_logic(self, event: AstrMessageEvent, direct_send: bool):
         """处理画图的核心逻辑"""
@@ -375,6 +655,9 @@ class ComfyUIPlugin(Star):
                 yield event.plain_result("❌ 请输入提示词，例如：/画图 1girl, smile")
                 return
 
+            self._record_traffic(event, "command", prompt_lengths=[len(prompt)], pic_count=1,
+                                 direct_send=direct_send)
+
             # 敏感词检查
             passed, sensitive = self._check_sensitive(prompt, event)
             if not passed:
@@ -432,6 +715,7 @@ class ComfyUIPlugin(Star):
             "  /画图 <提示词>     生成图片（转发模式）",
             "  /画图no <提示词>   生成图片（直发模式）",
             "  /comfy帮助         显示此帮助",
+            "  /comfy_prompt      查看/设置本会话的绘图提示词（auto|full|compact|off）",
             "",
             "【LLM 模式】",
             "  直接对话：'帮我画一个可爱的猫娘'",
@@ -445,7 +729,13 @@ class ComfyUIPlugin(Star):
                 "  /comfy_use <序号>      切换工作流",
                 "  /comfy_save            导入新工作流",
                 "  /comfy_add             步数覆盖（按节点ID）",
+                "  /comfy_seed            设置随机哪些种子",
                 "  /comfy_lock on|off     切换全局锁定",
+                "  /comfy_stats           查看运行指标",
+                "  /comfy_bench [cold]    后端容量测试",
+                "  /comfy_profile [秒数]  CPU/内存性能剖析",
+                "  /comfy_stalls          查看事件循环卡顿排行",
+                "  /comfy_reload_words    重载敏感词库",
                 "  /违禁级别              设置群敏感度",
                 ""
             ])
@@ -454,7 +744,9 @@ class ComfyUIPlugin(Star):
         tips.append("━━━━━━━━━━━━━━━━━━")
         tips.append(f"📍 当前位置：{'群聊 ' + gid if gid else '私聊'}")
         tips.append(f"🔒 违禁级别：{policy}")
-        tips.append(f"⏱️ 冷却时间：{self.cooldown_seconds} 秒")
+        tips.append(f"⏱️ 冷却时间：{self.cooldown_seconds} 秒（每张图约 {self.quota.image_seconds:.0f} GPU 秒）")
+        for kind, tokens, cap in self.quota.level(user_id, gid):
+            tips.append(f"🎟️ {'个人' if kind == 'u' else '本群'}额度：{max(tokens, 0):.0f}/{cap:.0f} GPU 秒")
         tips.append(f"🔐 全局锁定：{'开启' if self.lockdown else '关闭'}")
         if is_admin:
             tips.append(f"👑 身份：管理员")
@@ -793,6 +1085,246 @@ class ComfyUIPlugin(Star):
 
         yield event.plain_result("❌ 参数无效，用法：/comfy_lock on|off|status")
 
+    @filter.command("comfy_prompt", aliases=["绘图提示词"])
+    async def cmd_comfy_prompt(self, event: AstrMessageEvent):
+        """按会话设置注入哪一版绘图系统提示词：auto / full / compact / off"""
+        allowed, reason = self._check_access(event)
+        if not allowed:
+            yield event.plain_result(reason)
+            return
+
+        umo = event.unified_msg_origin
+        args = event.message_str.split()
+        action = args[1].lower() if len(args) > 1 else "status"
+
+        if action in ("status", "状态", "查询"):
+            mode = self.prompt_sessions.mode(umo)
+            full = self._prompt_variants.get("full")
+            compact = self._prompt_variants.get("compact")
+            lines = [
+                "🧾 绘图提示词（当前会话）",
+                "━━━━━━━━━━━━━━━━━━",
+                f"模式: {mode}",
+                f"距上次画图: {self.prompt_sessions.turns(umo)} 轮",
+                f"完整版: {len(full[0]) if full else 0} 字符 | 精简版: {len(compact[0]) if compact else 0} 字符",
+            ]
+            if mode == "auto":
+                if self.compact_prompt_after_turns:
+                    lines.append(f"auto: 连续 {self.compact_prompt_after_turns} 轮未画图后改用精简版")
+                else:
+                    lines.append("auto: 始终使用完整版（compact_prompt_after_turns = 0）")
+            lines.append("用法: /comfy_prompt auto|full|compact|off")
+            yield event.plain_result("\n".join(lines))
+            return
+
+        if action not in PROMPT_MODES:
+            yield event.plain_result("❌ 参数无效，用法：/comfy_prompt auto|full|compact|off|status")
+            return
+
+        # 群聊里的设置影响所有人，仅管理员可改
+        user_id = str(event.get_sender_id())
+        if self._is_group_message(event) and user_id not in self.admin_user_ids:
+            yield event.plain_result("🚫 权限不足，群聊中仅管理员可修改绘图提示词模式")
+            return
+
+        self.prompt_sessions.set_mode(umo, action)
+        self._save_prompt_sessions()
+        logger.info(f"[ComfyUI] 🧾 会话 {umo} 绘图提示词模式设为 {action}（操作者：{user_id}）")
+        tips = {
+            "auto": "✅ 已恢复自动：默认完整版，长时间未画图时改用精简版",
+            "full": "✅ 本会话始终注入完整版绘图提示词",
+            "compact": "✅ 本会话始终注入精简版绘图提示词",
+            "off": "✅ 本会话不再注入绘图提示词，LLM 不会主动插图（/画图 指令不受影响）",
+        }
+        yield event.plain_result(tips[action])
+
+    @filter.command("comfy_stats")
+    async def cmd_comfy_stats(self, event: AstrMessageEvent):
+        """查看生成流水线指标摘要"""
+        user_id = str(event.get_sender_id())
+        if user_id not in self.admin_user_ids:
+            yield event.plain_result("🚫 权限不足，仅管理员可查看运行指标")
+            return
+
+        lines = ["📈 ComfyUI 运行指标", "━━━━━━━━━━━━━━━━━━"]
+        lines.extend(format_summary())
+        lines.append("━━━━━━━━━━━━━━━━━━")
+        if self.api is not None and self.api.residency is not None:
+            lines.extend(self.api.residency.describe())
+        if self.metrics_exporter:
+            targets = []
+            if self.metrics_exporter.file_path:
+                targets.append(f"文件 {self.metrics_exporter.file_path.name}")
+            if self.metrics_exporter.http_port:
+                targets.append(f"HTTP :{self.metrics_exporter.http_port}/metrics")
+            lines.append(f"📤 导出: {'、'.join(targets) or '未配置目标'}")
+        else:
+            lines.append("📤 导出: 关闭（metrics.enabled）")
+        yield event.plain_result("\n".join(lines))
+
+    @filter.command("comfy_bench")
+    async def cmd_comfy_bench(self, event: AstrMessageEvent):
+        """对当前后端和工作流做容量测试：/comfy_bench [cold]"""
+        user_id = str(event.get_sender_id())
+        if user_id not in self.admin_user_ids:
+            yield event.plain_result("🚫 权限不足，仅管理员可运行容量测试")
+            return
+
+        if not getattr(self, "api", None):
+            yield event.plain_result("❌ ComfyUI 服务未连接，请检查配置")
+            return
+
+        if self._bench_running:
+            yield event.plain_result("⏳ 已有容量测试在运行，请等待其结束")
+            return
+
+        args = event.message_str.split()
+        cold = len(args) > 1 and args[1].lower() in ("cold", "冷启动")
+
+        # 在第一次 await 之前占位，同时发起的两次测试不会都通过上面的检查
+        self._bench_running = True
+        try:
+            bench = CapacityBenchmark(
+                self.api,
+                levels=self.bench_levels,
+                jobs_per_level=self.bench_jobs_per_level,
+                max_runtime=self.bench_max_runtime,
+            )
+            reason = await bench.preflight()
+            if reason:
+                yield event.plain_result(f"🚫 {reason}，请在空闲时再运行容量测试")
+                return
+
+            levels_text = "/".join(map(str, bench.levels))
+            await event.send(event.plain_result(
+                f"🏁 容量测试开始：并发 {levels_text}，每个并发槽位 {bench.jobs_per_level} 张，"
+                f"最长 {self.bench_max_runtime:.0f}s{'，先释放模型' if cold else ''}"
+            ))
+            logger.info(f"[ComfyUI] 🏁 管理员 {user_id} 开始容量测试 | 工作流: {self.api.wf_filename}")
+            report = await bench.run(cold=cold)
+        except Exception as e:
+            logger.error(f"[ComfyUI] 容量测试异常: {e}")
+            logger.error(traceback.format_exc())
+            yield event.plain_result(f"❌ 容量测试出错：{str(e)[:50]}")
+            return
+        finally:
+            self._bench_running = False
+
+        lines = format_report(report, self.api.wf_filename, self.api.url, self.bench_max_runtime, bench.knee_gain)
+        yield event.plain_result("\n".join(lines))
+
+    @filter.command("comfy_profile")
+    async def cmd_comfy_profile(self, event: AstrMessageEvent):
+        """CPU 采样 + 内存分配剖析：/comfy_profile [秒数] [nomem]"""
+        user_id = str(event.get_sender_id())
+        if user_id not in self.admin_user_ids:
+            yield event.plain_result("🚫 权限不足，仅管理员可运行性能剖析")
+            return
+
+        if self.profiler.running:
+            yield event.plain_result("⏳ 已有性能剖析在进行中，请等待其结束")
+            return
+
+        args = event.message_str.split()[1:]
+        seconds = PROFILE_DEFAULT_SECONDS
+        memory = True
+        for arg in args:
+            if arg.isdigit():
+                seconds = int(arg)
+            elif arg.lower() in ("nomem", "cpu"):
+                memory = False
+            else:
+                yield event.plain_result("❌ 用法：/comfy_profile [秒数] [nomem]")
+                return
+        seconds = min(max(seconds, 1), PROFILE_MAX_SECONDS)
+
+        await event.send(event.plain_result(
+            f"🔬 开始剖析 {seconds} 秒（CPU 采样{' + 内存分配' if memory else ''}），期间请正常使用机器人"
+        ))
+        logger.info(f"[ComfyUI] 🔬 管理员 {user_id} 开始性能剖析 {seconds}s")
+        try:
+            summary = await self.profiler.run_for(seconds, memory=memory)
+        except Exception as e:
+            logger.error(f"[ComfyUI] 性能剖析异常: {e}")
+            logger.error(traceback.format_exc())
+            yield event.plain_result(f"❌ 性能剖析出错：{str(e)[:50]}")
+            return
+
+        lines = [
+            "🔬 性能剖析完成",
+            "━━━━━━━━━━━━━━━━━━",
+            f"⏱️ {summary['duration']:.1f}s | 样本 {summary['samples']} | 经过插件代码 {summary['plugin_samples']}",
+        ]
+        if summary["top"]:
+            lines.append("🔥 自身耗时最高:")
+            lines.extend(f"  • {label}: {secs:.3f}s" for label, secs in summary["top"])
+        if summary["memory_top"]:
+            lines.append("🧠 内存增长最多:")
+            lines.extend(f"  • {site}: {size / 1024:+.1f} KiB" for site, size in summary["memory_top"])
+        lines.append(f"📁 详细结果: {summary['dir']}")
+        yield event.plain_result("\n".join(lines))
+
+    @filter.command("comfy_reload_words")
+    async def cmd_comfy_reload_words(self, event: AstrMessageEvent):
+        """重新加载敏感词库，只重建有变化的策略"""
+        user_id = str(event.get_sender_id())
+        if user_id not in self.admin_user_ids:
+            yield event.plain_result("🚫 权限不足，仅管理员可重载敏感词库")
+            return
+
+        try:
+            report = await self._reload_sensitive_words()
+        except Exception as e:
+            logger.error(f"[ComfyUI] 重载敏感词库失败: {e}")
+            yield event.plain_result(f"❌ 重载失败，继续使用旧词库：{str(e)[:80]}")
+            return
+
+        logger.info(f"[ComfyUI] 🔄 管理员 {user_id} 重载敏感词库 | {self._format_lexicon_report(report)[0]}")
+        word_count = sum(len(v) for v in self.lexicon.values() if isinstance(v, list))
+        lines = ["🔄 敏感词库已重载", "━━━━━━━━━━━━━━━━━━"]
+        lines.extend(self._format_lexicon_report(report))
+        lines.append(f"📚 当前共 {word_count} 个词条")
+        yield event.plain_result("\n".join(lines))
+
+    @filter.command("comfy_stalls")
+    async def cmd_comfy_stalls(self, event: AstrMessageEvent):
+        """查看事件循环卡顿排行"""
+        user_id = str(event.get_sender_id())
+        if user_id not in self.admin_user_ids:
+            yield event.plain_result("🚫 权限不足，仅管理员可查看卡顿统计")
+            return
+
+        if not self.stall_watchdog:
+            yield event.plain_result("ℹ️ 卡顿检测未开启，请在插件配置中启用 stall_watchdog.enabled")
+            return
+
+        args = event.message_str.split()
+        if len(args) > 1 and args[1].lower() == "reset":
+            self.stall_watchdog.reset()
+            yield event.plain_result("✅ 卡顿统计已清空")
+            return
+
+        offenders = self.stall_watchdog.worst_offenders()
+        threshold_ms = int(self.stall_watchdog.threshold * 1000)
+        if not offenders:
+            yield event.plain_result(f"✅ 暂未检测到超过 {threshold_ms}ms 的事件循环阻塞")
+            return
+
+        lines = [f"🐢 事件循环阻塞排行（阈值 {threshold_ms}ms）", "━━━━━━━━━━━━━━━━━━"]
+        for i, (handler, st) in enumerate(offenders, 1):
+            lines.append(
+                f"{i}. {handler}: {st.count} 次 | 最长 {st.max * 1000:.0f}ms | "
+                f"累计 {st.total * 1000:.0f}ms"
+            )
+        worst_handler, worst = offenders[0]
+        if worst.last_stack:
+            lines.append("")
+            lines.append(f"📌 {worst_handler} 最近一次堆栈采样（末尾几帧）：")
+            lines.extend(worst.last_stack.rstrip().splitlines()[-6:])
+        lines.append("━━━━━━━━━━━━━━━━━━")
+        lines.append("清空：/comfy_stalls reset")
+        yield event.plain_result("\n".join(lines))
+
     @filter.command("comfy_ls")
     async def cmd_comfy_list(self, event: AstrMessageEvent):
         """列出当前所有可用工作流"""
@@ -805,40 +1337,25 @@ class ComfyUIPlugin(Star):
             yield event.plain_result("❌ 工作流目录不存在")
             return
 
-        # 排除 .steps.json 文件
-        files = sorted([
-            f.name for f in self.workflow_dir.glob("*.json") 
-            if not f.name.endswith(".steps.json")
-        ])
+        entries = self.workflow_index.entries()
     
-        if not files:
+        if not entries:
             yield event.plain_result("📂 目录中没有工作流文件")
             return
 
         current_file = self.api.wf_filename if self.api else "未知"
+        # /comfy_use 的序号按这次展示的顺序解析，期间目录变化也不会选错
+        self._workflow_listing = tuple(entry.name for entry in entries)
     
         msg = ["📂 可用工作流列表", "━━━━━━━━━━━━━━━━━━"]
     
-        for i, f in enumerate(files, 1):
-            stem = Path(f).stem
-            sidecar = self.workflow_dir / f"{stem}.steps.json"
-        
-            # 检查是否有步数覆盖（新格式：按节点ID存储）
-            steps_info = ""
-            if sidecar.exists():
-                try:
-                    with open(sidecar, "r", encoding="utf-8") as sf:
-                        data = json.load(sf)
-                        if data and isinstance(data, dict):
-                            count = len(data)
-                            steps_info = f" [覆盖:{count}项]"
-                except:
-                    pass
-        
-            if f == current_file:
-                msg.append(f"✅ {i}. {f}{steps_info} (当前)")
+        for i, entry in enumerate(entries, 1):
+            steps_info = f" [覆盖:{entry.override_count}项]" if entry.override_count else ""
+            if entry.name == current_file:
+                msg.append(f"✅ {i}. {entry.name}{steps_info} (当前)")
             else:
-                msg.append(f"   {i}. {f}{steps_info}")
+                msg.append(f"   {i}. {entry.name}{steps_info}")
+            msg.append(f"      {self._describe_workflow(entry)}")
     
         msg.append("")
         msg.append("━━━━━━━━━━━━━━━━━━")
@@ -866,11 +1383,8 @@ class ComfyUIPlugin(Star):
             return
 
         try:
-            # 排除 .steps.json 文件
-            files = sorted([
-                f.name for f in self.workflow_dir.glob("*.json")
-                if not f.name.endswith(".steps.json")
-            ])
+            # 序号对应上次 /comfy_ls 展示的列表；还没有列过时按当前目录顺序
+            files = self._workflow_listing or self.workflow_index.names()
         
             index = int(args[1])
             if not (1 <= index <= len(files)):
@@ -884,6 +1398,11 @@ class ComfyUIPlugin(Star):
             yield event.plain_result(f"❌ 查找工作流失败: {e}")
             return
 
+        entry = self.workflow_index.get(filename)
+        if entry is None:
+            yield event.plain_result(f"❌ {filename} 已被删除或改名，请先 /comfy_ls 刷新列表")
+            return
+
         inp_id = args[2] if len(args) > 2 else None
         neg_id = args[3] if len(args) > 3 else None
         out_id = args[4] if len(args) > 4 else None
@@ -900,8 +1419,32 @@ class ComfyUIPlugin(Star):
         )
         
         status = "✅" if exists else "⚠️"
+        lines = [f"{status} {msg}", self._describe_workflow(entry)]
+        if entry.prompt_nodes and self.api.input_id not in entry.prompt_nodes:
+            lines.append(f"⚠️ 正面节点 {self.api.input_id} 不在识别出的提示词节点中: {', '.join(entry.prompt_nodes)}")
+        if self.api.prune_unreachable:
+            pruned = self.api.pruned_nodes()
+            if pruned:
+                lines.append(f"✂️ 提交时裁剪 {len(pruned)} 个与输出无关的节点: {', '.join(pruned[:6])}{' …' if len(pruned) > 6 else ''}")
+        if self.api.residency is not None and self.api.residency.warming:
+            lines.append("🔥 已在后台提交预热任务，模型加载完成后出图不再需要等待")
         logger.info(f"[ComfyUI] 管理员 {user_id} 切换工作流: {filename}")
-        yield event.plain_result(f"{status} {msg}")
+        yield event.plain_result("\n".join(lines))
+
+    @staticmethod
+    def _describe_workflow(entry) -> str:
+        """一行工作流元数据：节点数、模型、提示词/输出节点、大小"""
+        if entry.error:
+            return f"❌ {entry.error}"
+        parts = [f"{entry.node_count} 节点"]
+        if entry.checkpoints:
+            parts.append(f"模型 {', '.join(entry.checkpoints[:2])}{' 等' if len(entry.checkpoints) > 2 else ''}")
+        if entry.prompt_nodes:
+            parts.append(f"提示词 {','.join(entry.prompt_nodes[:4])}")
+        if entry.output_nodes:
+            parts.append(f"输出 {','.join(entry.output_nodes[:2])}")
+        parts.append(f"{entry.size / 1024:.1f}KB")
+        return " · ".join(parts)
 
     @filter.command("comfy_save")
     async def cmd_comfy_save(self, event: AstrMessageEvent):
@@ -935,22 +1478,52 @@ class ComfyUIPlugin(Star):
             yield event.plain_result(f"❌ JSON 解析失败：{str(e)[:50]}")
             return
 
+        # 导入时编译一次：校验连线、规范化、识别注入位置，生成时直接使用
+        try:
+            text, meta = compile_workflow(json_data)
+        except WorkflowCompileError as e:
+            problems = "\n".join(f"  • {p}" for p in e.problems[:5])
+            more = f"\n  …… 共 {len(e.problems)} 处" if len(e.problems) > 5 else ""
+            yield event.plain_result(f"❌ 工作流校验失败，未保存：\n{problems}{more}")
+            return
+
         save_path = self.workflow_dir / filename
 
         try:
             with open(save_path, 'w', encoding='utf-8') as f:
-                json.dump(json_data, f, indent=2, ensure_ascii=False)
+                f.write(text)
+            save_compiled(compiled_path(save_path), meta)
             
+            self.workflow_index.invalidate(filename)
             self._auto_update_schema()
             
-            logger.info(f"[ComfyUI] 管理员 {user_id} 导入工作流: {filename}")
+            logger.info(f"[ComfyUI] 管理员 {user_id} 导入工作流: {filename}（{meta['node_count']} 节点）")
             yield event.plain_result(
                 f"✅ 保存成功！\n"
                 f"文件：{filename}\n"
+                f"{self._describe_compiled(meta)}\n"
                 f"使用 /comfy_ls 查看列表"
             )
         except Exception as e:
             yield event.plain_result(f"❌ 保存失败: {e}")
+
+    @staticmethod
+    def _describe_compiled(meta: dict) -> str:
+        """导入时识别出的注入位置，以及对应的 /comfy_use 参数"""
+        positive, negative, latent = meta["positive"], meta["negative"], meta["latent"]
+        lines = [
+            f"🔎 识别结果（{meta['node_count']} 节点）：",
+            f"  正面提示词：{positive['node']}.{positive['key']}" if positive else "  正面提示词：未识别",
+            f"  负面提示词：{negative['node']}.{negative['key']}" if negative else "  负面提示词：未识别",
+            f"  输出节点：{meta['output'] or '未识别'}",
+            f"  每次随机的种子：{', '.join(f'{nid}.{key}' for nid, key in meta['primary_seeds']) or '无'}",
+        ]
+        if latent:
+            lines.append(f"  画布尺寸：节点 {latent['node']}")
+        if positive and meta["output"]:
+            neg = negative["node"] if negative else "0"
+            lines.append(f"切换时可用：/comfy_use <序号> {positive['node']} {neg} {meta['output']}")
+        return "\n".join(lines)
     @filter.command("comfy_add")
     async def cmd_comfy_add(self, event: AstrMessageEvent):
         """给当前工作流的指定节点绑定步数覆盖"""
@@ -1012,8 +1585,7 @@ class ComfyUIPlugin(Star):
     
         # 获取当前工作流的 sidecar 路径
         current_file = self.api.wf_filename
-        stem = Path(current_file).stem
-        sidecar_path = self.workflow_dir / f"{stem}.steps.json"
+        sidecar_path = self.workflow_dir / sidecar_name(current_file)
     
         # 读取现有配置
         existing = {}
@@ -1059,6 +1631,7 @@ class ComfyUIPlugin(Star):
                 # 如果清空了，删除文件
                 if sidecar_path.exists():
                     sidecar_path.unlink()
+            self.workflow_index.invalidate(current_file)
         
             # 构建反馈消息
             msg_parts = []
@@ -1079,8 +1652,7 @@ class ComfyUIPlugin(Star):
         """列出当前工作流的步数覆盖"""
     
         current_file = self.api.wf_filename
-        stem = Path(current_file).stem
-        sidecar_path = self.workflow_dir / f"{stem}.steps.json"
+        sidecar_path = self.workflow_dir / sidecar_name(current_file)
     
         lines = [
             f"📊 当前工作流步数覆盖",
@@ -1119,8 +1691,7 @@ class ComfyUIPlugin(Star):
         """清空当前工作流的所有步数覆盖"""
     
         current_file = self.api.wf_filename
-        stem = Path(current_file).stem
-        sidecar_path = self.workflow_dir / f"{stem}.steps.json"
+        sidecar_path = self.workflow_dir / sidecar_name(current_file)
     
         if not sidecar_path.exists():
             yield event.plain_result(f"ℹ️ {current_file} 本来就没有步数覆盖")
@@ -1128,12 +1699,73 @@ class ComfyUIPlugin(Star):
     
         try:
             sidecar_path.unlink()
+            self.workflow_index.invalidate(current_file)
             user_id = str(event.get_sender_id())
             logger.info(f"[ComfyUI] 管理员 {user_id} 清空步数覆盖: {current_file}")
             yield event.plain_result(f"✅ 已清空 {current_file} 的所有步数覆盖")
         except Exception as e:
             yield event.plain_result(f"❌ 清空失败: {e}")
 
+    @filter.command("comfy_seed")
+    async def cmd_comfy_seed(self, event: AstrMessageEvent):
+        """设置当前工作流每次生成时重新随机哪些种子"""
+        user_id = str(event.get_sender_id())
+        if user_id not in self.admin_user_ids:
+            yield event.plain_result("🚫 权限不足，仅管理员可设置种子")
+            return
+        if not self.api:
+            yield event.plain_result("❌ ComfyUI API 未初始化")
+            return
+
+        args = event.message_str.split()[1:]
+        current_file = self.api.wf_filename
+        sidecar_path = self.workflow_dir / sidecar_name(current_file, SEEDS_SUFFIX)
+
+        if args:
+            mode = args[0].lower()
+            try:
+                if mode == "auto":
+                    if sidecar_path.exists():
+                        sidecar_path.unlink()
+                else:
+                    data = {"mode": "all"} if mode == "all" else {"nodes": args}
+                    with open(sidecar_path, "w", encoding="utf-8") as f:
+                        json.dump(data, f, ensure_ascii=False, indent=2)
+                self.workflow_index.invalidate(current_file)
+            except Exception as e:
+                yield event.plain_result(f"❌ 保存失败: {e}")
+                return
+            logger.info(f"[ComfyUI] 管理员 {user_id} 修改种子配置: {current_file} -> {' '.join(args)}")
+
+        try:
+            slots = self.api.seed_slots()
+        except Exception as e:
+            yield event.plain_result(f"❌ 读取工作流失败: {e}")
+            return
+        entry = self.workflow_index.get(current_file)
+        policy = entry.seed_policy if entry else None
+        lines = [
+            "🎲 种子随机设置",
+            "━━━━━━━━━━━━━━━━━━",
+            f"📍 工作流: {current_file}",
+            f"模式: {describe_seed_policy(policy)}",
+            f"每次生成重新随机: {', '.join(f'{nid}.{key}' for nid, key in slots) or '无'}",
+        ]
+        if entry is not None and entry.compiled:
+            stable = [f"{nid}.{key}" for nid, key in entry.compiled["seeds"] if (nid, key) not in slots]
+            if stable:
+                lines.append(f"保持不变: {', '.join(stable)}")
+        if not args:
+            lines.extend([
+                "━━━━━━━━━━━━━━━━━━",
+                "用法：",
+                "  /comfy_seed auto            只随机主采样器（默认）",
+                "  /comfy_seed all             随机所有 seed/noise_seed",
+                "  /comfy_seed <ID1> [ID2...]  只随机指定节点",
+                "💡 其余节点的种子不变时，重绘同一提示词可以复用 ComfyUI 缓存，跳过采样器之前的节点",
+            ])
+        yield event.plain_result("\n".join(lines))
+
     @filter.command("当前工作流", aliases=["comfy_current", "当前wf"])
     async def cmd_comfy_current(self, event: AstrMessageEvent):
         current_file = self.config.get("json_file") or self.config.get("workflow_json") or "未配置"
@@ -1217,33 +1849,335 @@ class ComfyUIPlugin(Star):
                 continue
         return None
 
-    def _is_ascii_term(self, s: str) -> bool:
-        return all(ord(ch) < 128 for ch in s)
+    def _get_trace(self, event: AstrMessageEvent, create: bool = True):
+        """取出挂在 event 上的请求追踪，create=True 时不存在则新建；未开启追踪时返回空对象"""
+        if self.trace_exporter is None:
+            return NULL_TRACE
+        trace = event.get_extra("comfy_trace")
+        if trace is None and create:
+            trace = self.trace_exporter.new_trace(
+                user=str(event.get_sender_id()),
+                origin=str(getattr(event, "unified_msg_origin", "")),
+            )
+            event.set_extra("comfy_trace", trace)
+            logger.debug(f"[ComfyUI] 🧭 请求 {trace.request_id} 开始追踪")
+        return trace or NULL_TRACE
+
+    def _finish_trace(self, event: AstrMessageEvent, status: str = "ok"):
+        """结束并导出请求追踪；延迟到本轮事件循环之后，让外层钩子的 span 先记录完"""
+        if self.trace_exporter is None:
+            return
+        trace = event.get_extra("comfy_trace")
+        if trace is None:
+            return
+        asyncio.get_running_loop().call_soon(self.trace_exporter.export, trace, status)
+
+    def _record_traffic(self, event: AstrMessageEvent, kind: str, **fields):
+        """录制一条匿名流量记录（未开启时为空操作），同一 event 只记录一次"""
+        if self.traffic_recorder is None or event.get_extra("comfy_traffic_logged"):
+            return
+        event.set_extra("comfy_traffic_logged", True)
+        api = getattr(self, "api", None)
+        self.traffic_recorder.record(
+            kind,
+            user_id=event.get_sender_id(),
+            group_id=self._get_group_id(event),
+            workflow=api.wf_filename if api else "",
+            **fields,
+        )
+
+    def _metric_labels(self) -> dict:
+        api = getattr(self, "api", None)
+        if api is None:
+            return {"workflow": "", "backend": ""}
+        return api.metric_labels()
+
+    def _get_platform_name(self, event: AstrMessageEvent) -> str:
+        try:
+            return str(event.get_platform_name() or "")
+        except Exception:
+            return ""
+
+    def _build_image_component(self, event: AstrMessageEvent, img_data: bytes, platform: str = None) -> tuple:
+        """
+        按投递模式构建图片组件，返回 (图片组件, 临时文件路径或 None)
+        临时文件需在发送完成后交给 _release_temp_image 删除
+        没有 event 时（重启后取回的任务）按 platform 判断投递方式
+        """
+        labels = self._metric_labels()
+        trace = self._get_trace(event, create=False) if event is not None else NULL_TRACE
+        if platform is None:
+            platform = self._get_platform_name(event)
+        if self.delivery_mode == "memory":
+            if platform not in self.path_required_platforms:
+                with time_stage("transcode", **labels), trace.span("transcode"):
+                    return Image.fromBytes(img_data), None
+
+            # 该平台适配器只认本地路径：写临时文件，发送后删除
+            self.temp_dir.mkdir(exist_ok=True)
+            tmp_path = self.temp_dir / f"{uuid.uuid4()}.png"
+            with time_stage("disk_write", **labels), trace.span("disk_write"):
+                with open(tmp_path, 'wb') as fp:
+                    fp.write(img_data)
+            return Image.fromFileSystem(str(tmp_path)), tmp_path
+
+        img_filename = f"{uuid.uuid4()}.png"
+        img_path = self.output_dir / img_filename
+        with time_stage("disk_write", **labels), trace.span("disk_write"):
+            with open(img_path, 'wb') as fp:
+                fp.write(img_data)
+        logger.info(f"[ComfyUI] ✅ 图片已保存: {img_filename}")
+        return Image.fromFileSystem(str(img_path)), None
+
+    async def _send_image(self, event: AstrMessageEvent, image_component, tmp_path=None):
+        """通过 event.send 发送单张图片，记录 send 阶段耗时，发送后删除临时文件"""
+        trace = self._get_trace(event, create=False)
+        try:
+            with time_stage("send", **self._metric_labels()), trace.span("send"):
+                await event.send(event.chain_result([image_component]))
+        finally:
+            self._release_temp_image(tmp_path)
+        IMAGES_SENT_TOTAL.inc(mode=self.delivery_mode)
+
+    def _release_temp_image(self, tmp_path, delay: float = 0):
+        """删除临时图片文件，delay > 0 时延迟删除"""
+        if tmp_path is None:
+            return
+
+        def _unlink():
+            try:
+                Path(tmp_path).unlink(missing_ok=True)
+            except Exception as e:
+                logger.warning(f"[ComfyUI] 删除临时图片失败: {e}")
+
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, _unlink)
+        else:
+            _unlink()
+
+    def _compile_policy(self, policy: str, lexicon: dict):
+        terms = []
+        for cat in self.policies[policy]:
+            terms.extend(lexicon.get(cat, []))
+        return SensitiveMatcher(terms) if terms else None
 
     def _build_policy_patterns(self):
-        for policy, cats in self.policies.items():
-            word_terms = []
-            phrase_terms = []
-            for cat in cats:
-                for t in self.lexicon.get(cat, []):
-                    if not t:
-                        continue
-                    if self._is_ascii_term(t):
-                        if " " in t: 
-                            phrase_terms.append(re.escape(t))
-                        else:         
-                            word_terms.append(re.escape(t))
-            word_terms = list(dict.fromkeys(word_terms))
-            phrase_terms = list(dict.fromkeys(phrase_terms))
-
-            parts = []
-            if word_terms:
-                parts.append(r'(?<![A-Za-z0-9_])(?:' + '|'.join(word_terms) + r')(?![A-Za-z0-9_])')
-            if phrase_terms:
-                parts.append('|'.join(phrase_terms))
-
-            ascii_pat = re.compile('|'.join(parts), re.IGNORECASE) if parts else None
-            self._policy_patterns[policy] = ascii_pat
+        """为每个策略编译一个 Aho-Corasick 匹配器（覆盖 ASCII 整词、短语和中文等非 ASCII 词条）"""
+        self._policy_matchers = {policy: self._compile_policy(policy, self.lexicon) for policy in self.policies}
+
+    def _load_lexicon(self):
+        self.lexicon = {"legacy_lite": [], "full": []}
+        try:
+            if self.sensitive_words_path.exists():
+                self._lexicon_mtime = self.sensitive_words_path.stat().st_mtime_ns
+                self._lexicon_bytes = self.sensitive_words_path.read_bytes()
+                self.lexicon = json.loads(self._lexicon_bytes.decode("utf-8"))
+                word_count = sum(len(v) for v in self.lexicon.values() if isinstance(v, list))
+                logger.info(f"[ComfyUI] 🔒 敏感词库已加载: {word_count} 个词条")
+        except Exception:
+            self.lexicon = {"legacy_lite": [], "full": []}
+
+    def _ensure_sensitive_words(self):
+        """读取词库并加载匹配器（只执行一次）；后台预热和请求路径都可能调用，用锁保证不重复构建"""
+        if self._sensitive_ready:
+            return
+        with self._sensitive_init_lock:
+            if self._sensitive_ready:
+                return
+            self._load_lexicon()
+            self._load_policy_matchers()
+            self._sensitive_ready = True
+
+    def _load_policy_matchers(self):
+        """优先加载缓存的编译结果；词库文件或策略定义变化（哈希不一致）时重新构建并写回缓存"""
+        digest = lexicon_digest(self._lexicon_bytes, self.policies)
+        start = time.perf_counter()
+        cached = load_matchers(self._matcher_cache_path, digest)
+        if cached is not None and set(cached) == set(self.policies):
+            self._policy_matchers = cached
+            logger.info(f"[ComfyUI] 🔒 已加载敏感词匹配器缓存 ({(time.perf_counter() - start) * 1000:.1f}ms)")
+            return
+
+        self._build_policy_patterns()
+        logger.info(f"[ComfyUI] 🔒 敏感词匹配器已重新编译 ({(time.perf_counter() - start) * 1000:.1f}ms)")
+        try:
+            save_matchers(self._matcher_cache_path, digest, self._policy_matchers)
+        except Exception as e:
+            logger.warning(f"[ComfyUI] 写入敏感词匹配器缓存失败: {e}")
+
+    def _reload_lexicon(self) -> dict:
+        """
+        重新读取敏感词库，只重建分类有变化的策略
+        新匹配器全部构建完成后才整体替换 _policy_matchers，正在进行的检查只会看到旧的或新的完整状态
+        返回 {"changed": {分类: (新增, 删除)}, "policies": [重建的策略]}；文件读取或解析失败时抛出异常并保留旧词库
+        """
+        self._ensure_sensitive_words()
+        mtime = self.sensitive_words_path.stat().st_mtime_ns
+        raw = self.sensitive_words_path.read_bytes()
+        if raw == self._lexicon_bytes:
+            self._lexicon_mtime = mtime
+            return {"changed": {}, "policies": []}
+
+        lexicon = json.loads(raw.decode("utf-8"))
+        if not isinstance(lexicon, dict):
+            raise ValueError("词库顶层必须是 {分类: [词条]} 对象")
+
+        changed = diff_lexicon(self.lexicon, lexicon)
+        affected = [policy for policy, cats in self.policies.items() if cats & changed.keys()]
+        matchers = dict(self._policy_matchers)
+        for policy in affected:
+            matchers[policy] = self._compile_policy(policy, lexicon)
+
+        self._policy_matchers = matchers
+        self.lexicon = lexicon
+        self._lexicon_bytes = raw
+        self._lexicon_mtime = mtime
+        try:
+            save_matchers(self._matcher_cache_path, lexicon_digest(raw, self.policies), matchers)
+        except Exception as e:
+            logger.warning(f"[ComfyUI] 写入敏感词匹配器缓存失败: {e}")
+        return {"changed": changed, "policies": affected}
+
+    async def _reload_sensitive_words(self) -> dict:
+        """在线程池中重载词库，避免大词库编译时阻塞事件循环；同一时间只允许一次重载"""
+        async with self._lexicon_lock:
+            return await asyncio.get_running_loop().run_in_executor(None, self._reload_lexicon)
+
+    async def _watch_sensitive_words(self):
+        while True:
+            await asyncio.sleep(self.sensitive_watch_interval)
+            try:
+                mtime = self.sensitive_words_path.stat().st_mtime_ns
+            except OSError:
+                continue
+            if mtime == self._lexicon_mtime:
+                continue
+            try:
+                report = await self._reload_sensitive_words()
+            except Exception as e:
+                # 记下这次的修改时间，文件再次修改前不重复报错
+                self._lexicon_mtime = mtime
+                logger.warning(f"[ComfyUI] 敏感词库自动重载失败，继续使用旧词库: {e}")
+                continue
+            if report["changed"]:
+                logger.info(f"[ComfyUI] 🔄 敏感词库已自动重载 | {self._format_lexicon_report(report)[0]}")
+
+    def _format_lexicon_report(self, report: dict) -> list:
+        changed = report["changed"]
+        if not changed:
+            return ["词库内容没有变化"]
+        added = sum(a for a, _ in changed.values())
+        removed = sum(r for _, r in changed.values())
+        lines = [f"➕ 新增 {added} 个 | ➖ 删除 {removed} 个 | 重建策略: {', '.join(report['policies']) or '无'}"]
+        for cat, (a, r) in sorted(changed.items()):
+            lines.append(f"  • {cat}: +{a} / -{r}")
+        return lines
+
+    # ====== 后台预热 ======
+    async def _warm_up(self):
+        """启动后在后台完成的初始化：敏感词匹配器、工作流索引、后端连接检查"""
+        start = time.perf_counter()
+        try:
+            await asyncio.to_thread(self._ensure_sensitive_words)
+        except Exception as e:
+            logger.error(f"[ComfyUI] 加载敏感词库失败，将在首次检查时重试: {e}")
+        self.workflow_index.refresh(force=True)
+        if self.api is not None:
+            try:
+                depth = await self.api.get_queue_size()
+                logger.info(f"[ComfyUI] 🔗 后端连接正常: {self.api.url} | 队列中 {depth} 个任务")
+            except Exception as e:
+                logger.warning(f"[ComfyUI] ⚠️ 暂时无法连接后端 {self.api.url}: {e}")
+        logger.info(f"[ComfyUI] ✅ 后台初始化完成 ({(time.perf_counter() - start) * 1000:.0f}ms)")
+
+    # ====== 任务日志 ======
+    def _journal_job(self, event: AstrMessageEvent) -> dict:
+        """任务日志中记录的结果去向"""
+        return {"target": event.unified_msg_origin, "platform": self._get_platform_name(event)}
+
+    async def _resume_journal_jobs(self):
+        """启动时丢弃过期记录，继续取回重启前未完成的任务"""
+        journal = self.job_journal
+        expired = journal.expire()
+        jobs = journal.pending()
+        if expired:
+            logger.info(f"[ComfyUI] 🗂️ 已丢弃 {expired} 条过期的任务记录")
+        if not jobs:
+            return
+        logger.info(f"[ComfyUI] 🗂️ 继续取回重启前提交的 {len(jobs)} 个任务")
+        await asyncio.gather(*(self._resume_job(job) for job in jobs))
+
+    async def _resume_job(self, job: dict):
+        prompt_id = job["prompt_id"]
+        remaining = job["submitted_at"] + JOB_RESUME_MAX_AGE - time.time()
+        try:
+            img_data, error_msg = await self.api.resume(
+                prompt_id, job["backend"], job["output_id"], job["submitted_at"], remaining
+            )
+        except Exception as e:
+            img_data, error_msg = None, str(e)
+        if self.api.closing:
+            # 又一次重载：记录留给下一个实例
+            return
+        self.job_journal.finished(prompt_id)
+        if not img_data:
+            logger.warning(f"[ComfyUI] 重启前的任务 {prompt_id} 未能取回: {error_msg}")
+            return
+
+        tmp_path = None
+        try:
+            image_component, tmp_path = self._build_image_component(None, img_data, platform=job["platform"])
+            chain = MessageChain(chain=[Plain("🎨 重启前提交的图片已生成："), image_component])
+            with time_stage("send", **self._metric_labels()):
+                await self.context.send_message(job["target"], chain)
+            IMAGES_SENT_TOTAL.inc(mode=self.delivery_mode)
+            logger.info(f"[ComfyUI] 🗂️ 已补发重启前的任务 {prompt_id} -> {job['target']}")
+        except Exception as e:
+            logger.warning(f"[ComfyUI] 补发重启前的任务 {prompt_id} 失败: {e}")
+        finally:
+            self._release_temp_image(tmp_path)
+
+    # ====== 限流额度 ======
+    async def _watch_backend_load(self):
+        """定期刷新后端队列深度（队列积压时放慢额度恢复）、实测单张耗时，并保存额度快照"""
+        while True:
+            await asyncio.sleep(QUOTA_POLL_SECONDS)
+            api = getattr(self, "api", None)
+            if api is not None:
+                try:
+                    self.quota.set_queue_depth(await api.get_queue_size())
+                except Exception as e:
+                    logger.debug(f"[ComfyUI] 查询后端队列失败: {e}")
+            self._observe_execute_seconds()
+            self._save_quota()
+
+    def _observe_execute_seconds(self):
+        """用上次刷新以来 execute 阶段的平均耗时更新单张图的预估 GPU 秒"""
+        total, count = 0.0, 0
+        for key, state in STAGE_SECONDS.items():
+            if key[0] == "execute":
+                total += state.sum
+                count += state.count
+        seen_total, seen_count = self._execute_seen
+        self._execute_seen = (total, count)
+        if count > seen_count:
+            self.quota.observe_image_seconds((total - seen_total) / (count - seen_count))
+
+    def _save_prompt_sessions(self):
+        if not self.prompt_sessions.dirty:
+            return
+        try:
+            self.prompt_sessions.save(self._prompt_sessions_path)
+        except OSError as e:
+            logger.warning(f"[ComfyUI] 保存绘图提示词模式失败: {e}")
+
+    def _save_quota(self):
+        if not self.quota.dirty:
+            return
+        try:
+            self.quota.save(self._quota_path)
+        except OSError as e:
+            logger.warning(f"[ComfyUI] 保存限流额度快照失败: {e}")
 
     def _get_policy_for_event(self, event: AstrMessageEvent) -> str:
         if self._is_group_message(event):
@@ -1263,19 +2197,12 @@ class ComfyUIPlugin(Star):
         if policy == "none":
             return []
 
-        ascii_pat = self._policy_patterns.get(str(policy).lower())
-        if not ascii_pat:
+        if not self._sensitive_ready:
+            self._ensure_sensitive_words()
+        matcher = self._policy_matchers.get(str(policy).lower())
+        if not matcher:
             return []
-
-        seen = set()
-        result = []
-        for m in ascii_pat.finditer(text):
-            w = m.group(0)
-            key = w.lower()
-            if key not in seen:
-                seen.add(key)
-                result.append(w)
-        return result
+        return matcher.find(text)
 
     # ====== 修改提取逻辑 ======
     @filter.on_llm_response(priority=70)
@@ -1283,45 +2210,39 @@ class ComfyUIPlugin(Star):
         """提取 LLM 回复中的提示词（使用 <pic prompt="..."> 格式）"""
         if not resp or not resp.completion_text:
             return
+
+        extract_start = time.time()
+        extract_perf = time.perf_counter()
     
         full_text = resp.completion_text
     
-        # 提取所有 <pic prompt="...">
-        prompts = re.findall(r'<pic\s+prompt="(.*?)">', full_text, flags=re.DOTALL)
+        # 一次扫描提取所有 <pic prompt="...">，同时得到去掉 <pic>、<think>、<ctx> 的文本和分段
+        # 绝大多数回复不含 <pic>，先用子串判断跳过完整解析
+        parsed = parse_reply(full_text) if "<pic" in full_text else None
+        prompts = parsed.prompts if parsed else []
+        self._record_traffic(event, "llm", prompt_lengths=[len(p) for p in prompts],
+                             pic_count=len(prompts), reply_length=len(full_text))
     
         if not prompts:
             return
+        # 会话仍在画图，下次请求恢复完整版提示词
+        self.prompt_sessions.reset(event.unified_msg_origin)
 
-        # 清理文本供其他插件使用（移除 <pic>、<think>、<ctx> 标签）
-        cleaned_text = re.sub(r'<pic\s+prompt=".*?">', '', full_text, flags=re.DOTALL)
-        cleaned_text = re.sub(r'<think>.*?</think>', '', cleaned_text, flags=re.DOTALL)
-        cleaned_text = re.sub(r'</?ctx>', '', cleaned_text)
-        cleaned_text = cleaned_text.strip()
+        # 清理后的文本供其他插件使用
+        cleaned_text = parsed.cleaned_text
         event.set_extra("comfy_cleaned_text", cleaned_text)
     
         # 清理提示词内容
         cleaned_prompts = []
         
-        placeholder_patterns = [
-            r'^\.{2,}$',
-            r'^…+$',
-            r'^[.。]+$',
-            r'^[xX]{2,}$',
-            r'^[-_=]{2,}$',
-            r'^\[.*?\]$',
-            r'^\{.*?\}$',
-        ]
-        
         for p in prompts:
-            p = re.sub(r'^提示词是\s*[:：]?\s*', '', p).strip()
-            p = p.strip('`"\'""''').strip()
+            p = clean_prompt(p)
             if not p:
                 continue
             if len(p) < 3:
                 logger.debug(f"[ComfyUI] 跳过过短提示词: '{p}'")
                 continue
-            is_placeholder = any(re.match(pat, p) for pat in placeholder_patterns)
-            if is_placeholder:
+            if is_placeholder(p):
                 logger.debug(f"[ComfyUI] 跳过占位符提示词: '{p}'")
                 continue
             cleaned_prompts.append(p)
@@ -1332,6 +2253,7 @@ class ComfyUIPlugin(Star):
         # 单图模式
         if len(cleaned_prompts) == 1:
             event._comfy_extracted_prompt = cleaned_prompts[0]
+            self._get_trace(event).add_span("extract_prompts", extract_start, time.perf_counter() - extract_perf, images=1)
             logger.info(f"[ComfyUI] 📝 检测到单图模式: {cleaned_prompts[0][:50]}...")
             # 丢弃绘图提示词，避免污染历史记录上下文
             if self.discard_prompt_from_history:
@@ -1342,25 +2264,20 @@ class ComfyUIPlugin(Star):
     
         # 多图模式
         if self.multi_image_mode:
-            parts = re.split(r'<pic\s+prompt=".*?">', full_text, flags=re.DOTALL)
-        
             # 检测原始文本中的 <render> 标签信息，用于补全被切割的段落
-            render_match = re.search(r'<render\b[^>]*>', full_text)
-            render_open_tag = render_match.group(0) if render_match else None
+            render_open_tag = parsed.render_open_tag
             render_close_tag = "</render>" if render_open_tag else None
 
             segments = []
             prompt_idx = 0
         
-            for i, text in enumerate(parts):
-                text = re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL)
-                text = re.sub(r'</?ctx>', '', text)
-                text = text.strip()
+            for part in parsed.parts:
+                text = part.text
                 if text:
                     # 如果原文使用了 <render> 标签，确保每个文本段都有完整的标签对
                     if render_open_tag:
-                        has_open = bool(re.search(r'<render\b', text))
-                        has_close = '</render>' in text
+                        has_open = part.render_open
+                        has_close = part.render_close
                         if has_open and not has_close:
                             text = text + render_close_tag
                         elif has_close and not has_open:
@@ -1374,6 +2291,10 @@ class ComfyUIPlugin(Star):
         
             if segments:
                 event._comfy_segments = segments
+                self._get_trace(event).add_span(
+                    "extract_prompts", extract_start, time.perf_counter() - extract_perf,
+                    images=len(cleaned_prompts),
+                )
                 logger.info(f"[ComfyUI] 📝 检测到多图模式，共 {len(cleaned_prompts)} 张图片")
                 # 丢弃绘图提示词，避免污染历史记录上下文
                 if self.discard_prompt_from_history:
@@ -1381,8 +2302,125 @@ class ComfyUIPlugin(Star):
                     resp.result_chain = MessageChain().message(cleaned_text)
                     logger.info("[ComfyUI] 🗑️ 已从历史记录中移除绘图提示词（多图模式）")            
 
+    # ====== 流式提前出图 ======
+    def _install_stream_tap(self, event: AstrMessageEvent):
+        """
+        包装本事件的 send_streaming：流式分片照常发给平台，同时喂给 <pic> 检测器
+        框架在流式输出期间不触发任何插件钩子，这是唯一能看到分片的位置；非流式回复不会调用它
+        """
+        if getattr(event, "_comfy_stream_tapped", False):
+            return
+        event._comfy_stream_tapped = True
+        original = event.send_streaming
+
+        async def send_streaming(generator, use_fallback: bool = False):
+            return await original(self._tap_stream(event, generator), use_fallback)
+
+        event.send_streaming = send_streaming
+
+    async def _tap_stream(self, event: AstrMessageEvent, generator):
+        detector = PicStreamDetector()
+        async for chain in generator:
+            if chain is not None and chain.type not in ("reasoning", "break"):
+                try:
+                    text = "".join(c.text for c in chain.chain if isinstance(c, Plain))
+                    for raw in detector.feed(text) if text else ():
+                        self._early_dispatch(event, raw)
+                except Exception as e:
+                    logger.error(f"[ComfyUI] 流式提前出图异常: {e}")
+            yield chain
+
+    def _early_dispatch(self, event: AstrMessageEvent, raw_prompt: str):
+        """
+        <pic> 在流式输出中途闭合：立即做准入检查并提交 ComfyUI，任务挂在 event 上，
+        回复结束后的钩子按提示词取用；检查未通过时停止提前提交，交给原有流程照常拒绝并提示
+        """
+        if getattr(event, "_comfy_early_stopped", False) or not getattr(self, "api", None):
+            return
+        prompt = clean_prompt(raw_prompt)
+        if len(prompt) < 3 or is_placeholder(prompt):
+            return
+
+        jobs = getattr(event, "_comfy_early_jobs", None)
+        if jobs is None:
+            # 权限按整条回复检查一次，额度先扣第一张，其余张数在回复结束后补扣
+            if not self._check_access(event)[0] or not self._check_cooldown(event)[0]:
+                event._comfy_early_stopped = True
+                return
+            jobs = event._comfy_early_jobs = []
+            event._comfy_early_admitted = True
+            event._comfy_early_timer = asyncio.get_running_loop().call_later(
+                EARLY_JOB_TTL, self._release_early_jobs, event
+            )
+        elif not self.multi_image_mode:
+            # 未开启多图模式时，多个 <pic> 的回复不会出图
+            self._stop_early_dispatch(event)
+            return
+
+        passed, _ = self._check_sensitive(prompt, event)
+        if not passed:
+            # 任一提示词触发敏感词，整条回复都会被拒绝
+            self._stop_early_dispatch(event)
+            return
+
+        trace = self._get_trace(event)
+        jobs.append((prompt, asyncio.create_task(self.api.generate(prompt, trace=trace, job=self._journal_job(event)))))
+        logger.info(f"[ComfyUI] ⚡ 流式提前提交第 {len(jobs)} 张: {prompt[:50]}...")
+
+    def _stop_early_dispatch(self, event: AstrMessageEvent):
+        """
+        停止提前提交：取消已提交的任务（后端任务一并撤销）并退还流式阶段扣的额度
+        回复结束后的钩子若仍会出图，会按张数重新扣费；退还是幂等的，钩子再次退还不会多退
+        """
+        event._comfy_early_stopped = True
+        self._cancel_early_jobs(event)
+        self._refund_quota(event)
+
+    def _release_early_jobs(self, event: AstrMessageEvent):
+        """
+        出图流程没有取用的提前任务：撤销并按剩余张数退还额度
+        出图流程已接手（单图异步任务、多图分组发送）时由它自己收尾，这里不处理
+        """
+        timer = getattr(event, "_comfy_early_timer", None)
+        if timer is not None:
+            timer.cancel()
+            event._comfy_early_timer = None
+        if getattr(event, "_comfy_early_claimed", False):
+            return
+        jobs = getattr(event, "_comfy_early_jobs", None)
+        if not jobs:
+            return
+        count = len(jobs)
+        self._cancel_early_jobs(event)
+        self._refund_quota(event, count)
+
+    @filter.on_decorating_result(priority=1)
+    async def _finalize_early_jobs(self, event: AstrMessageEvent):
+        """回复处理的最后一步：清理没有被取用的提前任务"""
+        self._release_early_jobs(event)
+
+    def _cancel_early_jobs(self, event: AstrMessageEvent):
+        """取消未被取用的提前任务；已提交到 ComfyUI 的由客户端从队列删除或中断"""
+        jobs = getattr(event, "_comfy_early_jobs", None)
+        if not jobs:
+            return
+        for _, task in jobs:
+            task.cancel()
+        logger.info(f"[ComfyUI] ⚡ 已取消 {len(jobs)} 个未使用的提前任务")
+        jobs.clear()
+
+    async def _generate_for_event(self, event: AstrMessageEvent, prompt: str, trace=None) -> tuple:
+        """优先等待流式阶段已提交的同一提示词任务，没有时正常生成"""
+        jobs = getattr(event, "_comfy_early_jobs", None) or []
+        for i, (early_prompt, task) in enumerate(jobs):
+            if early_prompt == prompt:
+                del jobs[i]
+                return await task
+        return await self.api.generate(prompt, trace=trace, job=self._journal_job(event))
+
     # ====== 自动绘图逻辑保持不变 ======
     @filter.on_decorating_result(priority=99)
+    @_traced("auto_paint")
     async def _auto_paint_from_llm(self, event: AstrMessageEvent):
         """自动绘图 - 阶段1：构建 chain（多图）或启动异步任务（单图）"""
         if getattr(event, "_comfy_auto_painted", False):
@@ -1394,25 +2432,32 @@ class ComfyUIPlugin(Star):
         # === 多图分段模式：构建带标记的 chain，交给 HtmlRender 渲染后由 priority=10 发送 ===
         if segments and self.multi_image_mode:
             event._comfy_auto_painted = True
+            # 流式阶段已通过权限检查，不再重复检查；已扣的额度记录在 event 上
+            early_admitted = getattr(event, "_comfy_early_admitted", False)
 
             # 权限检查
-            allowed, reason = self._check_access(event)
+            allowed, reason = (True, "") if early_admitted else self._check_access(event)
             if not allowed:
                 logger.warning(f"[ComfyUI] 多图请求被拒绝: {reason}")
                 try:
                     await event.send(event.plain_result(reason))
                 except Exception as e:
                     logger.error(f"[ComfyUI] 发送权限拒绝提示失败: {e}")
+                self._finish_trace(event, "rejected")
                 return
 
-            # 冷却检查
-            ok, remain = self._check_cooldown(event)
+            # 额度检查：按图片张数计费，流式阶段已扣过的部分不重复扣
+            image_count = sum(1 for s in segments if s["type"] == "prompt")
+            ok, remain = self._admit_images(event, image_count)
             if not ok:
                 logger.info(f"[ComfyUI] 用户 {event.get_sender_id()} 冷却中")
+                self._cancel_early_jobs(event)
+                self._refund_quota(event)
                 try:
                     await event.send(event.plain_result(f"⏱️ 冷却中，请在 {remain} 秒后重试"))
                 except Exception as e:
                     logger.error(f"[ComfyUI] 发送冷却提示失败: {e}")
+                self._finish_trace(event, "rejected")
                 return
 
             # 敏感词预检所有 prompt
@@ -1420,12 +2465,15 @@ class ComfyUIPlugin(Star):
                 if s["type"] == "prompt":
                     passed, sensitive = self._check_sensitive(s["content"], event)
                     if not passed:
+                        self._cancel_early_jobs(event)
+                        self._refund_quota(event)
                         tip = "、".join(sensitive[:3])
                         logger.warning(f"[ComfyUI] 多图模式触发敏感词: {tip}")
                         try:
                             await event.send(event.plain_result(f"🚫 检测到敏感词：{tip}，无法生成图片"))
                         except Exception as e:
                             logger.error(f"[ComfyUI] 发送敏感词提示失败: {e}")
+                        self._finish_trace(event, "rejected")
                         return
 
             # 构建新的 chain：文字段 + 图片标记交替
@@ -1455,74 +2503,89 @@ class ComfyUIPlugin(Star):
             return
 
         event._comfy_auto_painted = True
+        early_admitted = getattr(event, "_comfy_early_admitted", False)
 
         # 权限检查
-        allowed, reason = self._check_access(event)
+        allowed, reason = (True, "") if early_admitted else self._check_access(event)
         if not allowed:
             logger.warning(f"[ComfyUI] 单图请求被拒绝: {reason}")
             try:
                 await event.send(event.plain_result(reason))
             except Exception as e:
                 logger.error(f"[ComfyUI] 发送权限拒绝提示失败: {e}")
+            self._finish_trace(event, "rejected")
             return
 
         # 敏感词检查
         passed, sensitive = self._check_sensitive(prompt, event)
         if not passed:
+            self._cancel_early_jobs(event)
+            self._refund_quota(event)
             tip = "、".join(sensitive[:5])
             logger.warning(f"[ComfyUI] 用户 {event.get_sender_id()} 触发敏感词: {tip}")
             try:
                 await event.send(event.plain_result(f"🚫 检测到敏感词：{tip}，无法生成图片"))
             except Exception as e:
                 logger.error(f"[ComfyUI] 发送敏感词提示失败: {e}")
+            self._finish_trace(event, "rejected")
             return
 
-        # 冷却检查
-        ok, remain = self._check_cooldown(event)
+        # 额度检查（流式阶段已扣费时直接通过）
+        ok, remain = self._admit_images(event, 1)
         if not ok:
             logger.info(f"[ComfyUI] 用户 {event.get_sender_id()} 冷却中，图片跳过")
             try:
                 await event.send(event.plain_result(f"⏱️ 冷却中，请在 {remain} 秒后重试"))
             except Exception as e:
                 logger.error(f"[ComfyUI] 发送冷却提示失败: {e}")
+            self._finish_trace(event, "rejected")
             return
 
         # 不修改 result.chain → 文字由框架/HtmlRender 正常发送
-        # 图片异步生成后单独发送
+        # 图片异步生成后单独发送；提前任务由异步任务取用并收尾
+        event._comfy_early_claimed = True
         asyncio.create_task(self._send_image_async(event, prompt))
     
+    @_traced("send_image_async")
     async def _send_image_async(self, event: AstrMessageEvent, prompt: str):
         """异步生成并发送图片（不阻塞文字消息发送）"""
+        status = "error"
         try:
             if not getattr(self, 'api', None):
                 logger.error("[ComfyUI] API 未初始化，无法生成图片")
                 return
 
             logger.info(f"[ComfyUI] 🎨 异步生成开始 | Prompt: {prompt[:50]}...")
-            img_data, error_msg = await self.api.generate(prompt)
+            img_data, error_msg = await self._generate_for_event(
+                event, prompt, trace=self._get_trace(event, create=False)
+            )
 
             if not img_data:
                 logger.error(f"[ComfyUI] 异步生成失败: {error_msg}")
+                self._refund_quota(event, 1)
                 try:
                     await event.send(event.plain_result(f"❌ 图片生成失败：{error_msg}"))
                 except Exception as e:
                     logger.error(f"[ComfyUI] 发送失败消息异常: {e}")
                 return
 
-            img_filename = f"{uuid.uuid4()}.png"
-            img_path = self.output_dir / img_filename
-            with open(img_path, 'wb') as fp:
-                fp.write(img_data)
-
-            logger.info(f"[ComfyUI] ✅ 异步图片已保存: {img_filename}")
-
-            image_component = Image.fromFileSystem(str(img_path))
-            await event.send(event.chain_result([image_component]))
-            logger.info(f"[ComfyUI] 📤 异步图片已发送: {img_filename}")
+            image_component, tmp_path = self._build_image_component(event, img_data)
+            await self._send_image(event, image_component, tmp_path)
+            status = "ok"
+            logger.info("[ComfyUI] 📤 异步图片已发送")
 
+        except JobHandedOff:
+            # 重载后的实例会取回并发送这张图，额度照常扣除，不提示失败
+            status = "handoff"
+            logger.info("[ComfyUI] 🗂️ 插件正在重载，图片将由重载后的实例发送")
         except Exception as e:
             logger.error(f"[ComfyUI] 异步绘图异常: {e}")
             logger.error(traceback.format_exc())
+            # 生成或发送出错，图片没有送达，退还额度
+            self._refund_quota(event, 1)
+        finally:
+            self._cancel_early_jobs(event)
+            self._finish_trace(event, status)
     @filter.on_decorating_result(priority=5)
     async def _cleanup_history_prompts(self, event: AstrMessageEvent):
         """在所有处理完成后，直接从对话历史中移除绘图提示词"""
@@ -1534,44 +2597,60 @@ class ComfyUIPlugin(Star):
         if not has_prompt:
             return
 
+        # 不立即读写整段历史：延迟一小段时间后统一处理，期间同一对话的多次回复合并为一次写入
+        # 写回之前的请求仍由 inject_system_prompt 在发给 LLM 前清理，不会把提示词带进上下文
+        self._schedule_history_cleanup(event.unified_msg_origin)
+
+    def _schedule_history_cleanup(self, unified_msg_origin: str, delay: float = HISTORY_CLEANUP_DELAY):
+        if unified_msg_origin in self._history_flush_tasks:
+            return
+        self._history_flush_tasks[unified_msg_origin] = asyncio.create_task(
+            self._delayed_history_cleanup(unified_msg_origin, delay)
+        )
+
+    async def _delayed_history_cleanup(self, unified_msg_origin: str, delay: float):
+        await asyncio.sleep(delay)
+        # 先移出等待表：写入期间的新回复会重新排队，不会丢
+        self._history_flush_tasks.pop(unified_msg_origin, None)
+        await self._cleanup_conversation_history(unified_msg_origin)
+
+    async def _flush_history_cleanups(self):
+        """立即执行所有等待中的历史清理（插件停用时调用）"""
+        pending = list(self._history_flush_tasks.items())
+        self._history_flush_tasks.clear()
+        for unified_msg_origin, task in pending:
+            task.cancel()
+            await self._cleanup_conversation_history(unified_msg_origin)
+
+    async def _cleanup_conversation_history(self, unified_msg_origin: str):
+        """读取当前对话，只清理水位之后的新消息，有修改时写回"""
         try:
             conv_mgr = self.context.conversation_manager
-            unified_msg_origin = event.unified_msg_origin
             conv_id = await conv_mgr.get_curr_conversation_id(unified_msg_origin)
-
             if not conv_id:
                 return
 
             conversation = await conv_mgr.get_conversation(unified_msg_origin, conv_id)
-            if not conversation:
+            if not conversation or not conversation.history:
                 return
 
-            try:
-                history = json.loads(conversation.history) if conversation.history else []
-            except json.JSONDecodeError:
+            history, cleaned = self._history_marks.clean(conv_id, conversation.history)
+            if history is None:
                 return
 
-            modified = False
-            for entry in history:
-                if entry.get("role") != "assistant":
-                    continue
-                content = str(entry.get("content", ""))
-                cleaned = re.sub(r'<pic\s+prompt=".*?">', '', content, flags=re.DOTALL)
-                if cleaned != content:
-                    entry["content"] = cleaned.strip()
-                    modified = True
-
-            if modified:
-                await conv_mgr.update_conversation(
-                    unified_msg_origin=unified_msg_origin,
-                    conversation_id=conv_id,
-                    history=history,
-                )
-                logger.info("[ComfyUI] 🗑️ 已从对话历史中清理绘图提示词")
+            await conv_mgr.update_conversation(
+                unified_msg_origin=unified_msg_origin,
+                conversation_id=conv_id,
+                history=json.loads(history),
+            )
+            # 写回后的字符串由框架生成，下次读取时从头确认一次
+            self._history_marks.mark(conv_id, None)
+            logger.info(f"[ComfyUI] 🗑️ 已将对话历史的清理结果写回（本次新清理 {cleaned} 条）")
 
         except Exception as e:
-            logger.error(f"[ComfyUI] 清理历史记录失败: {e}")            
+            logger.error(f"[ComfyUI] 清理历史记录失败: {e}")
     @filter.on_decorating_result(priority=10)
+    @_traced("send_multi_image")
     async def _send_multi_image_results(self, event: AstrMessageEvent):
         """多图模式 - 阶段2：在 HtmlRender 渲染完成后，分组发送"""
         if not event.get_extra("comfy_multi_image_mode"):
@@ -1581,6 +2660,7 @@ class ComfyUIPlugin(Star):
         if not result or not result.chain:
             return
 
+        event._comfy_early_claimed = True
         prompt_count = event.get_extra("comfy_multi_prompt_count") or 0
         logger.info(f"[ComfyUI] 📤 多图发送阶段开始，chain 共 {len(result.chain)} 个元素")
 
@@ -1600,6 +2680,8 @@ class ComfyUIPlugin(Star):
             groups.append({"items": current_group, "marker": None})
 
         # 逐组发送
+        trace = self._get_trace(event, create=False)
+        failed = handed_off = 0
         for group in groups:
             items = group["items"]
             marker = group["marker"]
@@ -1610,7 +2692,8 @@ class ComfyUIPlugin(Star):
                 filtered = [it for it in items if not (isinstance(it, Plain) and not it.text.strip())]
                 if filtered:
                     try:
-                        await event.send(event.chain_result(filtered))
+                        with trace.span("send_text"):
+                            await event.send(event.chain_result(filtered))
                         logger.info(f"[ComfyUI] 📤 文字段已发送 ({len(filtered)} 个元素)")
                     except Exception as e:
                         logger.error(f"[ComfyUI] 发送文字段失败: {e}")
@@ -1619,30 +2702,36 @@ class ComfyUIPlugin(Star):
             if marker:
                 try:
                     logger.info(f"[ComfyUI] 🎨 [{marker.index}/{prompt_count}] 开始生成: {marker.prompt[:50]}...")
-                    img_data, error_msg = await self.api.generate(marker.prompt)
-
-                    if not img_data:
-                        logger.error(f"[ComfyUI] 图片 {marker.index} 生成失败: {error_msg}")
-                        try:
-                            await event.send(event.plain_result(f"❌ [图片{marker.index}] 生成失败：{error_msg}"))
-                        except:
-                            pass
-                        continue
-
-                    img_filename = f"{uuid.uuid4()}.png"
-                    img_path = self.output_dir / img_filename
-                    with open(img_path, 'wb') as fp:
-                        fp.write(img_data)
-
-                    await event.send(event.chain_result([Image.fromFileSystem(str(img_path))]))
-                    logger.info(f"[ComfyUI] ✅ [{marker.index}/{prompt_count}] 图片已发送: {img_filename}")
-
+                    with trace.span(f"image_{marker.index}"):
+                        img_data, error_msg = await self._generate_for_event(event, marker.prompt, trace=trace)
+
+                        if not img_data:
+                            failed += 1
+                            self._refund_quota(event, 1)
+                            logger.error(f"[ComfyUI] 图片 {marker.index} 生成失败: {error_msg}")
+                            try:
+                                await event.send(event.plain_result(f"❌ [图片{marker.index}] 生成失败：{error_msg}"))
+                            except:
+                                pass
+                            continue
+
+                        image_component, tmp_path = self._build_image_component(event, img_data)
+                        await self._send_image(event, image_component, tmp_path)
+                    logger.info(f"[ComfyUI] ✅ [{marker.index}/{prompt_count}] 图片已发送")
+
+                except JobHandedOff:
+                    handed_off += 1
+                    logger.info(f"[ComfyUI] 🗂️ 图片 {marker.index} 将由重载后的实例发送")
                 except Exception as e:
+                    failed += 1
+                    self._refund_quota(event, 1)
                     logger.error(f"[ComfyUI] 图片 {marker.index} 处理异常: {e}")
                     logger.error(traceback.format_exc())
 
         # 清空 chain，防止框架重复发送
         result.chain.clear()
+        self._cancel_early_jobs(event)
+        self._finish_trace(event, f"failed_{failed}" if failed else "handoff" if handed_off else "ok")
         logger.info(f"[ComfyUI] ✅ 多图模式发送完成")
     @llm_tool(name="comfyui_txt2img")
     async def comfyui_txt2img(self, event: AstrMessageEvent, ctx: Context = None, prompt: str = None, text: str = None, img_width: int = None, img_height: int = None, direct_send: bool = False) -> MessageEventResult:
@@ -1669,11 +2758,15 @@ class ComfyUIPlugin(Star):
                 yield event.plain_result("❌ 请输入提示词")
                 return
 
+        # 由指令进入时已记录为 command，这里只记录 LLM 直接调用
+        self._record_traffic(event, "tool", prompt_lengths=[len(prompt)], pic_count=1)
+
         # API 检查
         if not getattr(self, 'api', None):
             yield event.plain_result("❌ ComfyUI 服务未连接，请检查配置")
             return
         
+        charged, image_component = False, None
         try:
             # 敏感词检查
             passed, sensitive = self._check_sensitive(prompt, event)
@@ -1688,32 +2781,34 @@ class ComfyUIPlugin(Star):
             if not ok:
                 yield event.plain_result(f"⏱️ 冷却中，请在 {remain} 秒后重试")
                 return
+            charged = True
 
             logger.info(f"[ComfyUI] 🎨 开始生成 | 用户: {event.get_sender_id()} | Prompt: {prompt[:50]}...")
 
             # 调用 API
-            img_data, error_msg = await self.api.generate(prompt)
+            trace = self._get_trace(event)
+            trace.set_attr("source", "command")
+            img_data, error_msg = await self.api.generate(prompt, trace=trace, job=self._journal_job(event))
 
             if not img_data:
                 logger.error(f"[ComfyUI] 生成失败: {error_msg}")
+                self._refund_quota(event, 1)
+                self._finish_trace(event, "error")
                 yield event.plain_result(f"❌ 生成失败：{error_msg}")
                 return
 
-            # 保存图片
-            img_filename = f"{uuid.uuid4()}.png"
-            img_path = self.output_dir / img_filename
-            with open(img_path, 'wb') as fp:
-                fp.write(img_data)
-            
-            logger.info(f"[ComfyUI] ✅ 图片已保存: {img_filename}")
+            # 构建图片组件（disk 模式落盘，memory 模式直接走内存）
+            image_component, tmp_path = self._build_image_component(event, img_data)
+            # 结果交给框架发送，临时文件延迟删除
+            self._release_temp_image(tmp_path, delay=TEMP_IMAGE_TTL)
+            IMAGES_SENT_TOTAL.inc(mode=self.delivery_mode)
+            self._finish_trace(event, "ok")
 
             # 发送结果
             if direct_send:
-                image_component = Image.fromFileSystem(str(img_path))
                 yield event.chain_result([image_component])
             else:
                 self_id = self._get_self_id(event) or "0"
-                image_component = Image.fromFileSystem(str(img_path))
                 forward_node = Node(
                     user_id=int(self_id),
                     nickname="ComfyUI",
@@ -1721,7 +2816,13 @@ class ComfyUIPlugin(Star):
                 )
                 yield event.chain_result([forward_node])
 
+        except JobHandedOff:
+            self._finish_trace(event, "handoff")
+            logger.info("[ComfyUI] 🗂️ 插件正在重载，图片将由重载后的实例发送")
         except Exception as e:
             logger.error(f"[ComfyUI] 执行异常: {e}")
             logger.error(traceback.format_exc())
+            if charged and image_component is None:
+                # 已扣费但图片没有生成出来，退还额度
+                self._refund_quota(event, 1)
             yield event.plain_result(f"❌ 内部错误: {str(e)[:50]}")
\ No newline at end of file
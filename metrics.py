@@ -0,0 +1,368 @@
+"""
+生成流水线指标：无外部依赖的 Counter / Gauge / Histogram 与全局注册表 REGISTRY
+
+- ComfyUI 客户端和插件共用 REGISTRY，按阶段（STAGES）记录耗时直方图，以及任务数、进行中任务、准入结果、发图数等计数
+- format_summary 为 /comfy_stats 生成按阶段汇总的文字摘要
+- MetricsExporter 定期把注册表写成 Prometheus 文本文件，可选开启本地 HTTP /metrics 端点
+"""
+
+import time
+import asyncio
+import bisect
+from pathlib import Path
+from contextlib import contextmanager
+from astrbot.api import logger
+
+
+# 延迟直方图默认分桶（秒），覆盖从敏感词检查到整次 GPU 执行的量级
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+# 流水线阶段名（同时用作直方图 stage 标签）
+STAGES = (
+    "admission", "queue_wait", "submit", "execute",
+    "download", "disk_write", "transcode", "send",
+)
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames, values, extra=None) -> str:
+    pairs = [f'{k}="{_escape_label(v)}"' for k, v in zip(labelnames, values)]
+    if extra:
+        pairs.extend(f'{k}="{_escape_label(v)}"' for k, v in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(k, "")) for k in self.labelnames)
+
+    def items(self):
+        return list(self._values.items())
+
+    def clear(self):
+        self._values.clear()
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, value: float = 1, **labels):
+        self.inc(-value, **labels)
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class _HistogramState:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, bucket_count: int):
+        self.counts = [0] * bucket_count
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = _HistogramState(len(self.buckets) + 1)
+        # counts 存各桶自身计数（非累计），最后一格为 +Inf
+        state.counts[bisect.bisect_left(self.buckets, value)] += 1
+        state.sum += value
+        state.count += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def quantile(self, q: float, states) -> float:
+        """按分桶线性插值估算分位数（states 为若干 _HistogramState，会被合并）"""
+        merged = [0] * (len(self.buckets) + 1)
+        total = 0
+        for st in states:
+            total += st.count
+            for i, c in enumerate(st.counts):
+                merged[i] += c
+        if total == 0:
+            return 0.0
+
+        rank = q * total
+        cumulative = 0
+        for i, c in enumerate(merged):
+            if c and cumulative + c >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if i >= len(self.buckets):
+                    return lower
+                upper = self.buckets[i]
+                return lower + (upper - lower) * ((rank - cumulative) / c)
+            cumulative += c
+        return self.buckets[-1]
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, state in self.items():
+            cumulative = 0
+            for bound, c in zip(self.buckets + (float("inf"),), state.counts):
+                cumulative += c
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(state.sum)}")
+            lines.append(f"{self.name}_count{labels} {state.count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames=()) -> Counter:
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, labelnames=()) -> Gauge:
+        return self._register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def get(self, name: str):
+        return self._metrics.get(name)
+
+    def reset(self):
+        for metric in self._metrics.values():
+            metric.clear()
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# 全局注册表：ComfyUI 客户端和插件共用
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "comfyui_stage_seconds", "Latency of each generation pipeline stage",
+    ("stage", "workflow", "backend"),
+)
+JOBS_TOTAL = REGISTRY.counter(
+    "comfyui_jobs_total", "Finished generation jobs by outcome (success/error/timeout/handoff)",
+    ("workflow", "backend", "outcome"),
+)
+JOBS_IN_FLIGHT = REGISTRY.gauge(
+    "comfyui_jobs_in_flight", "Generation jobs currently submitted or running",
+    ("workflow", "backend"),
+)
+STAGE_ERRORS_TOTAL = REGISTRY.counter(
+    "comfyui_stage_errors_total", "Errors raised by pipeline stage",
+    ("stage", "workflow", "backend"),
+)
+ADMISSION_TOTAL = REGISTRY.counter(
+    "comfyui_admission_total", "Admission check results (access/cooldown/sensitive)",
+    ("check", "result"),
+)
+IMAGES_SENT_TOTAL = REGISTRY.counter(
+    "comfyui_images_sent_total", "Images delivered to chat by delivery mode",
+    ("mode",),
+)
+
+
+def observe_stage(stage: str, seconds: float, workflow: str = "", backend: str = ""):
+    STAGE_SECONDS.observe(max(seconds, 0.0), stage=stage, workflow=workflow, backend=backend)
+
+
+@contextmanager
+def time_stage(stage: str, workflow: str = "", backend: str = ""):
+    """计时一个阶段；阶段内抛出的异常计入 comfyui_stage_errors_total 后继续抛出"""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS_TOTAL.inc(stage=stage, workflow=workflow, backend=backend)
+        raise
+    finally:
+        observe_stage(stage, time.perf_counter() - start, workflow, backend)
+
+
+def format_summary(registry: MetricsRegistry = REGISTRY) -> list:
+    """生成 /comfy_stats 使用的文字摘要（按阶段汇总，不区分工作流）"""
+    lines = []
+
+    by_stage = {}
+    for key, state in STAGE_SECONDS.items():
+        by_stage.setdefault(key[0], []).append(state)
+
+    if by_stage:
+        lines.append("⏱️ 阶段耗时 (次数 | 平均 | p50 | p95)")
+        for stage in list(STAGES) + sorted(set(by_stage) - set(STAGES)):
+            states = by_stage.get(stage)
+            if not states:
+                continue
+            count = sum(s.count for s in states)
+            avg = sum(s.sum for s in states) / count if count else 0.0
+            p50 = STAGE_SECONDS.quantile(0.5, states)
+            p95 = STAGE_SECONDS.quantile(0.95, states)
+            lines.append(f"  • {stage}: {count} | {avg:.3f}s | {p50:.3f}s | {p95:.3f}s")
+    else:
+        lines.append("⏱️ 暂无阶段耗时数据")
+
+    outcomes = {}
+    for key, value in JOBS_TOTAL.items():
+        outcomes[key[2]] = outcomes.get(key[2], 0) + value
+    in_flight = sum(v for _, v in JOBS_IN_FLIGHT.items())
+    lines.append("")
+    lines.append(
+        f"🎨 任务: 成功 {int(outcomes.get('success', 0))} | 失败 {int(outcomes.get('error', 0))} | "
+        f"超时 {int(outcomes.get('timeout', 0))} | 进行中 {int(in_flight)}"
+    )
+
+    workflows = {}
+    for key, value in JOBS_TOTAL.items():
+        workflows[(key[0], key[1])] = workflows.get((key[0], key[1]), 0) + value
+    for (workflow, backend), total in sorted(workflows.items(), key=lambda kv: -kv[1])[:5]:
+        lines.append(f"  • {workflow} @ {backend}: {int(total)} 次")
+
+    errors = {}
+    for key, value in STAGE_ERRORS_TOTAL.items():
+        errors[key[0]] = errors.get(key[0], 0) + value
+    if errors:
+        lines.append("❗ 阶段异常: " + ", ".join(f"{k}={int(v)}" for k, v in sorted(errors.items())))
+
+    admission = {}
+    for key, value in ADMISSION_TOTAL.items():
+        admission.setdefault(key[0], {})[key[1]] = value
+    if admission:
+        parts = []
+        for check, results in sorted(admission.items()):
+            parts.append(f"{check} 通过{int(results.get('pass', 0))}/拒绝{int(results.get('reject', 0))}")
+        lines.append("🛂 准入: " + " | ".join(parts))
+
+    return lines
+
+
+class MetricsExporter:
+    """定期把注册表写成 Prometheus 文本文件，并可选开启本地 HTTP /metrics 端点"""
+
+    def __init__(self, registry: MetricsRegistry = REGISTRY, file_path: Path = None,
+                 http_host: str = "127.0.0.1", http_port: int = 0, interval: float = 15):
+        self.registry = registry
+        self.file_path = Path(file_path) if file_path else None
+        self.http_host = http_host
+        self.http_port = int(http_port or 0)
+        self.interval = max(float(interval or 15), 1.0)
+        self._task = None
+        self._runner = None
+
+    async def start(self):
+        if self.file_path and self._task is None:
+            self._task = asyncio.create_task(self._write_loop())
+        if self.http_port and self._runner is None:
+            from aiohttp import web
+
+            app = web.Application()
+            app.router.add_get("/metrics", self._handle_metrics)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, self.http_host, self.http_port)
+            try:
+                await site.start()
+            except Exception:
+                await runner.cleanup()
+                raise
+            self._runner = runner
+            logger.info(f"[ComfyUI] 📈 指标端点已开启: http://{self.http_host}:{self.http_port}/metrics")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            self.write_file()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def write_file(self):
+        if not self.file_path:
+            return
+        tmp_path = self.file_path.with_name(self.file_path.name + ".tmp")
+        try:
+            tmp_path.write_text(self.registry.render_prometheus(), encoding="utf-8")
+            tmp_path.replace(self.file_path)
+        except Exception as e:
+            logger.warning(f"[ComfyUI] 写入指标文件失败: {e}")
+
+    async def _write_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.write_file()
+
+    async def _handle_metrics(self, request):
+        from aiohttp import web
+
+        return web.Response(
+            body=self.registry.render_prometheus().encode("utf-8"),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
@@ -0,0 +1,248 @@
+import os
+import sys
+import time
+import pstats
+import asyncio
+import threading
+import tracemalloc
+from pathlib import Path
+from astrbot.api import logger
+
+# 采样时记录的最大栈深
+_MAX_DEPTH = 64
+# 内存报告中列出的分配点数量
+_TOP_ALLOCATIONS = 25
+
+
+class _SampledStats:
+    """把采样结果包装成 pstats.Stats 可以直接加载的对象（实现 create_stats 协议）"""
+
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class PluginProfiler:
+    """
+    按需性能剖析：在指定时长内对事件循环线程做 CPU 栈采样，同时用 tracemalloc 记录内存分配
+    只保留经过本插件代码（处理函数、ComfyUI 客户端）的样本；未运行时不安装任何钩子，没有额外开销
+
+    输出（写入 output_dir/<时间戳>/）：
+    - cpu.collapsed    折叠栈格式，可直接交给 flamegraph.pl / speedscope / inferno 生成火焰图
+    - cpu.prof         pstats 格式（由采样换算，调用次数即样本数），可用 snakeviz 或 pstats 查看
+    - cpu_top.txt      按自身耗时 / 累计耗时排序的函数表
+    - memory_top.txt   插件相关的内存分配热点及剖析期间的增长
+    """
+
+    def __init__(self, plugin_dir: Path, output_dir: Path, interval: float = 0.005):
+        # 插件可能通过软链接安装，原始路径和解析后的路径都算插件内
+        self._plugin_prefixes = tuple({str(Path(plugin_dir)), str(Path(plugin_dir).resolve())})
+        self.output_dir = Path(output_dir)
+        self.interval = max(float(interval), 0.001)
+        self._thread = None
+        self._stop = threading.Event()
+        self._loop_thread_id = None
+        self._stacks = {}
+        self._total_samples = 0
+        self._started_tracemalloc = False
+        self._mem_start = None
+        self.started_at = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, memory: bool = True):
+        if self._thread is not None:
+            raise RuntimeError("剖析已在进行中")
+        self._loop_thread_id = threading.get_ident()
+        self._stacks = {}
+        self._total_samples = 0
+        self._mem_start = None
+        self._started_tracemalloc = False
+        if memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(25)
+                self._started_tracemalloc = True
+            self._mem_start = tracemalloc.take_snapshot()
+        self._stop.clear()
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._sampler, name="comfyui-profiler", daemon=True)
+        self._thread.start()
+        logger.info(f"[ComfyUI] 🔬 性能剖析已开始（采样间隔 {self.interval * 1000:.0f}ms）")
+
+    async def run_for(self, seconds: float, memory: bool = True) -> dict:
+        self.start(memory=memory)
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            summary = await asyncio.get_running_loop().run_in_executor(None, self.stop)
+        return summary
+
+    def stop(self) -> dict:
+        """停止采样并写出结果，返回摘要"""
+        thread = self._thread
+        if thread is None:
+            return {}
+        self._stop.set()
+        thread.join(timeout=5)
+        self._thread = None
+
+        mem_end = None
+        if self._mem_start is not None:
+            mem_end = tracemalloc.take_snapshot()
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+
+        out_dir = self.output_dir / time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started_at))
+        out_dir.mkdir(parents=True, exist_ok=True)
+        summary = {
+            "dir": out_dir,
+            "duration": time.time() - self.started_at,
+            "samples": self._total_samples,
+            "plugin_samples": sum(self._stacks.values()),
+            "top": [],
+            "memory_top": [],
+        }
+        summary["top"] = self._write_cpu(out_dir)
+        if mem_end is not None:
+            summary["memory_top"] = self._write_memory(out_dir, self._mem_start, mem_end)
+        self._mem_start = None
+        logger.info(f"[ComfyUI] 🔬 性能剖析结束，结果已写入 {out_dir}")
+        return summary
+
+    # ====== CPU 采样 ======
+    def _is_plugin_file(self, filename: str) -> bool:
+        return filename.startswith(self._plugin_prefixes)
+
+    def _sampler(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            try:
+                self._take_sample(frame)
+            finally:
+                del frame
+
+    def _take_sample(self, frame):
+        stack = []
+        outermost_plugin = -1
+        depth = 0
+        while frame is not None and depth < _MAX_DEPTH:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+            if self._is_plugin_file(code.co_filename):
+                outermost_plugin = depth
+            frame = frame.f_back
+            depth += 1
+        self._total_samples += 1
+        if outermost_plugin < 0:
+            return
+        # 从最外层的插件帧（框架直接调用的处理函数）开始，根在前
+        key = tuple(reversed(stack[:outermost_plugin + 1]))
+        self._stacks[key] = self._stacks.get(key, 0) + 1
+
+    def _short_path(self, filename: str) -> str:
+        for prefix in self._plugin_prefixes:
+            if filename.startswith(prefix):
+                return filename[len(prefix):].lstrip(os.sep)
+        return os.path.basename(filename)
+
+    def _label(self, func: tuple) -> str:
+        filename, lineno, name = func
+        return f"{name} ({self._short_path(filename)}:{lineno})"
+
+    def _build_pstats(self) -> dict:
+        """样本 -> pstats 字典：{func: (调用次数, 原始调用次数, 自身时间, 累计时间, {调用者: (...)})}"""
+        self_samples = {}
+        cum_samples = {}
+        callers = {}
+        for stack, count in self._stacks.items():
+            leaf = stack[-1]
+            self_samples[leaf] = self_samples.get(leaf, 0) + count
+            for func in set(stack):
+                cum_samples[func] = cum_samples.get(func, 0) + count
+            for caller, callee in set(zip(stack, stack[1:])):
+                edges = callers.setdefault(callee, {})
+                edges[caller] = edges.get(caller, 0) + count
+
+        stats = {}
+        for func, cum in cum_samples.items():
+            own = self_samples.get(func, 0)
+            func_callers = {
+                caller: (n, n, n * self.interval, n * self.interval)
+                for caller, n in callers.get(func, {}).items()
+            }
+            stats[func] = (cum, cum, own * self.interval, cum * self.interval, func_callers)
+        return stats
+
+    def _write_cpu(self, out_dir: Path) -> list:
+        with open(out_dir / "cpu.collapsed", "w", encoding="utf-8") as f:
+            for stack, count in sorted(self._stacks.items(), key=lambda kv: -kv[1]):
+                f.write(";".join(self._label(func).replace(";", ":") for func in stack))
+                f.write(f" {count}\n")
+
+        stats = self._build_pstats()
+        if not stats:
+            (out_dir / "cpu_top.txt").write_text("剖析期间没有采到经过插件代码的样本\n", encoding="utf-8")
+            return []
+
+        ps = pstats.Stats(_SampledStats(stats))
+        ps.dump_stats(str(out_dir / "cpu.prof"))
+
+        by_self = sorted(stats.items(), key=lambda kv: -kv[1][2])
+        by_cum = sorted(stats.items(), key=lambda kv: -kv[1][3])
+        lines = [
+            f"样本总数 {self._total_samples}，经过插件代码 {sum(self._stacks.values())}，"
+            f"采样间隔 {self.interval * 1000:.1f}ms（时间 = 样本数 × 间隔）",
+            "",
+            "== 自身耗时 ==",
+        ]
+        lines.extend(f"{st[2]:>9.3f}s  {self._label(func)}" for func, st in by_self[:30])
+        lines += ["", "== 累计耗时 =="]
+        lines.extend(f"{st[3]:>9.3f}s  {self._label(func)}" for func, st in by_cum[:30])
+        (out_dir / "cpu_top.txt").write_text("\n".join(lines) + "\n", encoding="utf-8")
+        return [(self._label(func), st[2]) for func, st in by_self[:5]]
+
+    # ====== 内存 ======
+    def _plugin_filters(self) -> list:
+        filters = [tracemalloc.Filter(True, f"{prefix}{os.sep}*", all_frames=True) for prefix in self._plugin_prefixes]
+        # 剖析器自身的分配不计入
+        filters.append(tracemalloc.Filter(False, __file__, all_frames=True))
+        return filters
+
+    def _plugin_site(self, tb) -> str:
+        """分配调用栈中离分配点最近的插件帧，即“插件代码里哪一行导致了这次分配”"""
+        for frame in reversed(tb):
+            if self._is_plugin_file(frame.filename):
+                return f"{self._short_path(frame.filename)}:{frame.lineno}"
+        return str(tb)
+
+    def _write_memory(self, out_dir: Path, start, end) -> list:
+        filters = self._plugin_filters()
+        end = end.filter_traces(filters)
+        start = start.filter_traces(filters)
+
+        by_site = {}
+        for stat in end.compare_to(start, "traceback"):
+            site = self._plugin_site(stat.traceback)
+            size, diff, count = by_site.get(site, (0, 0, 0))
+            by_site[site] = (size + stat.size, diff + stat.size_diff, count + stat.count)
+        sites = sorted(by_site.items(), key=lambda kv: -kv[1][1])
+
+        lines = ["== 按插件代码位置汇总（当前占用 | 剖析期间增长 | 块数）=="]
+        lines.extend(
+            f"{size / 1024:>10.1f} KiB | {diff / 1024:>+10.1f} KiB | {count:>7}  {site}"
+            for site, (size, diff, count) in sites[:_TOP_ALLOCATIONS]
+        )
+        lines += ["", "== 分配点（调用栈经过插件代码）=="]
+        lines.extend(str(stat) for stat in end.statistics("lineno")[:_TOP_ALLOCATIONS])
+        lines += ["", "== 占用最多的分配调用栈 =="]
+        for stat in end.statistics("traceback")[:5]:
+            lines.append(f"{stat.size / 1024:.1f} KiB, {stat.count} 块")
+            lines.extend(f"    {line}" for line in stat.traceback.format(limit=10))
+        (out_dir / "memory_top.txt").write_text("\n".join(lines) + "\n", encoding="utf-8")
+        return [(site, diff) for site, (_, diff, _) in sites[:3] if diff]
@@ -0,0 +1,89 @@
+"""
+按会话记录绘图提示词的注入状态
+
+- 距上次出现 <pic> 的 LLM 请求数：只在内存里保留最近活跃的 max_sessions 个会话，淘汰后按 0 轮重新计数
+- /comfy_prompt 设置的模式：只保存非 auto 的会话，与轮数分开存放、不会被淘汰（每条都来自一次显式设置）；
+  可保存为快照，重载插件后继续生效
+"""
+
+import json
+from collections import OrderedDict
+from pathlib import Path
+
+from .fileio import atomic_write
+
+# 快照格式版本
+_SNAPSHOT_VERSION = 1
+
+
+class PromptSessions:
+    """modes 为可设置的模式，其中第一个（auto）是默认值，不保存"""
+
+    def __init__(self, modes: tuple, max_sessions: int = 4096):
+        self.modes = tuple(modes)
+        self.default_mode = self.modes[0]
+        self.max_sessions = max(int(max_sessions), 1)
+        self.dirty = False
+        self._turns = OrderedDict()   # umo -> 距上次出现 <pic> 的请求数
+        self._modes = {}              # umo -> 非默认模式
+
+    def __len__(self):
+        return len(self._turns)
+
+    # ====== 未画图轮数 ======
+    def turns(self, umo: str) -> int:
+        return self._turns.get(umo, 0)
+
+    def tick(self, umo: str) -> int:
+        """记一次 LLM 请求，返回此前累计的轮数"""
+        turns = self._turns.get(umo, 0)
+        self._turns[umo] = turns + 1
+        self._turns.move_to_end(umo)
+        while len(self._turns) > self.max_sessions:
+            self._turns.popitem(last=False)
+        return turns
+
+    def reset(self, umo: str):
+        """会话仍在画图，重新计数"""
+        self._turns.pop(umo, None)
+
+    # ====== 会话模式 ======
+    def mode(self, umo: str) -> str:
+        return self._modes.get(umo, self.default_mode)
+
+    def set_mode(self, umo: str, mode: str):
+        if mode not in self.modes:
+            raise ValueError(f"未知的提示词模式: {mode}")
+        if mode == self.default_mode:
+            if self._modes.pop(umo, None) is not None:
+                self.dirty = True
+            return
+        if self._modes.get(umo) != mode:
+            self._modes[umo] = mode
+            self.dirty = True
+
+    # ====== 快照 ======
+    def snapshot(self) -> dict:
+        return {"version": _SNAPSHOT_VERSION, "modes": dict(self._modes)}
+
+    def restore(self, data: dict):
+        if not isinstance(data, dict) or data.get("version") != _SNAPSHOT_VERSION:
+            return
+        self._modes.clear()
+        modes = data.get("modes")
+        for umo, mode in (modes.items() if isinstance(modes, dict) else ()):
+            if isinstance(umo, str) and mode in self.modes and mode != self.default_mode:
+                self._modes[umo] = mode
+        self.dirty = False
+
+    def save(self, path: Path):
+        atomic_write(path, json.dumps(self.snapshot(), ensure_ascii=False).encode("utf-8"))
+        self.dirty = False
+
+    def load(self, path: Path) -> bool:
+        try:
+            data = json.loads(Path(path).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return False
+        self.restore(data)
+        return True
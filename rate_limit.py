@@ -0,0 +1,229 @@
+"""
+按预估 GPU 秒计费的令牌桶限流
+
+- 每个用户、每个群各一个桶，额度单位是“GPU 秒”：一张图按最近实测的平均执行耗时计费，多图回复按张数计费
+- 桶以 容量 / 恢复时长 的速度匀速恢复；后端队列积压超过阈值时，恢复速度按 阈值 / 队列深度 等比放慢
+- 单次花费超过桶容量时（例如一次 4 张图），桶满即可放行，余额变为负数，之后需要更久才能恢复
+- 生成失败可以按张退还额度
+- 桶满等价于不存在，只保存未满的桶，并按最近使用淘汰（欠费的桶最后淘汰），内存占用有上限；可保存为快照，重启后继续计算恢复进度
+"""
+
+import json
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from .fileio import atomic_write
+
+# 实测单张耗时的指数滑动平均系数
+_EMA_ALPHA = 0.2
+# 快照格式版本
+_SNAPSHOT_VERSION = 1
+
+
+class QuotaCharge:
+    """一次成功扣费的记录，用于失败时按张退还"""
+
+    __slots__ = ("keys", "per_image", "images")
+
+    def __init__(self, keys: tuple, per_image: float, images: int):
+        self.keys = keys
+        self.per_image = per_image
+        self.images = images
+
+
+class QuotaLimiter:
+    """
+    user_capacity:  单个用户的额度（GPU 秒），0 表示一张图的预估耗时（与原来的单次冷却等价）
+    user_refill:    用户额度从用完到恢复满所需的秒数，0 表示不限制用户
+    group_capacity: 单个群的额度（GPU 秒），0 表示不限制群
+    group_refill:   群额度从用完到恢复满所需的秒数
+    image_seconds:  还没有实测数据时，一张图的预估 GPU 秒
+    slowdown_depth: 后端队列超过这个深度时放慢恢复，0 表示不放慢
+    """
+
+    def __init__(self, user_capacity: float = 0, user_refill: float = 60, group_capacity: float = 0,
+                 group_refill: float = 600, image_seconds: float = 15, slowdown_depth: int = 4,
+                 max_buckets: int = 4096):
+        self.user_capacity = max(float(user_capacity), 0.0)
+        self.user_refill = max(float(user_refill), 0.0)
+        self.group_capacity = max(float(group_capacity), 0.0)
+        self.group_refill = max(float(group_refill), 1.0)
+        self.image_seconds = max(float(image_seconds), 0.1)
+        self.slowdown_depth = max(int(slowdown_depth), 0)
+        self.max_buckets = max(int(max_buckets), 1)
+        self.queue_depth = 0
+        self.dirty = False
+        self._buckets = OrderedDict()   # "u:<id>" / "g:<id>" -> [余额, 更新时间]
+
+    def __len__(self):
+        return len(self._buckets)
+
+    @property
+    def enabled(self) -> bool:
+        return self.user_refill > 0 or self.group_capacity > 0
+
+    # ====== 参数 ======
+    def capacity(self, kind: str) -> float:
+        if kind == "u":
+            return self.user_capacity or self.image_seconds
+        return self.group_capacity
+
+    def refill_rate(self, kind: str) -> float:
+        """每秒恢复的 GPU 秒（已按队列深度放慢）"""
+        refill = self.user_refill if kind == "u" else self.group_refill
+        return self.capacity(kind) / refill * self.refill_factor
+
+    @property
+    def refill_factor(self) -> float:
+        if self.slowdown_depth and self.queue_depth > self.slowdown_depth:
+            return self.slowdown_depth / self.queue_depth
+        return 1.0
+
+    def set_queue_depth(self, depth: int):
+        self.queue_depth = max(int(depth), 0)
+
+    def observe_image_seconds(self, seconds: float):
+        """用实测的单张执行耗时更新预估"""
+        if seconds > 0:
+            self.image_seconds += _EMA_ALPHA * (seconds - self.image_seconds)
+
+    # ====== 桶 ======
+    def _targets(self, user_id: str, group_id: str = None) -> list:
+        targets = []
+        if self.user_refill > 0:
+            targets.append(f"u:{user_id}")
+        if group_id and self.group_capacity > 0:
+            targets.append(f"g:{group_id}")
+        return targets
+
+    def _level(self, key: str, now: float) -> float:
+        """当前余额（先按经过的时间恢复）；桶满时删除记录"""
+        kind = key[0]
+        cap = self.capacity(kind)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return cap
+        tokens = bucket[0] + max(now - bucket[1], 0.0) * self.refill_rate(kind)
+        if tokens >= cap:
+            del self._buckets[key]
+            self.dirty = True
+            return cap
+        bucket[0], bucket[1] = tokens, now
+        self._buckets.move_to_end(key)
+        return tokens
+
+    def _store(self, key: str, tokens: float, now: float):
+        self._buckets[key] = [tokens, now]
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_buckets:
+            self._evict(key, now)
+        self.dirty = True
+
+    def _evict(self, keep: str, now: float):
+        """
+        淘汰一个桶：被淘汰的桶下次按满额计算，所以从最久未用的开始找余额不为负的；
+        全部欠费时（极少见）淘汰恢复得最多的一个，不把欠费的桶直接变回满额
+        """
+        best_key, best_tokens = None, None
+        for key, (tokens, updated) in self._buckets.items():
+            if key == keep:
+                continue
+            tokens += max(now - updated, 0.0) * self.refill_rate(key[0])
+            if tokens >= 0:
+                best_key = key
+                break
+            if best_tokens is None or tokens > best_tokens:
+                best_key, best_tokens = key, tokens
+        del self._buckets[best_key]
+
+    def try_acquire(self, user_id: str, group_id: str = None, images: int = 1, now: float = None,
+                    force: bool = False) -> tuple:
+        """
+        按 images 张图扣费，用户桶和群桶都够时才扣；force 时不检查余额直接记账（已放行的回复补扣剩余张数）
+        返回 (是否通过, 需要等待的秒数, QuotaCharge 或 None)
+        """
+        targets = self._targets(user_id, group_id)
+        images = max(int(images), 1)
+        per_image = self.image_seconds
+        if not targets:
+            return True, 0.0, None
+        now = time.time() if now is None else now
+        cost = per_image * images
+
+        levels = []
+        wait = 0.0
+        for key in targets:
+            tokens = self._level(key, now)
+            need = min(cost, self.capacity(key[0]))
+            if tokens < need:
+                wait = max(wait, (need - tokens) / self.refill_rate(key[0]))
+            levels.append(tokens)
+        if wait > 0 and not force:
+            return False, wait, None
+
+        for key, tokens in zip(targets, levels):
+            self._store(key, tokens - cost, now)
+        return True, 0.0, QuotaCharge(tuple(targets), per_image, images)
+
+    def refund(self, charge: QuotaCharge, images: int = None, now: float = None):
+        """退还 images 张图的额度（默认全部），不会超过桶容量"""
+        if charge is None or charge.images <= 0:
+            return
+        images = charge.images if images is None else min(max(int(images), 0), charge.images)
+        if not images:
+            return
+        charge.images -= images
+        now = time.time() if now is None else now
+        amount = charge.per_image * images
+        for key in charge.keys:
+            tokens = self._level(key, now) + amount
+            if tokens >= self.capacity(key[0]):
+                self._buckets.pop(key, None)
+                self.dirty = True
+            else:
+                self._store(key, tokens, now)
+
+    def level(self, user_id: str, group_id: str = None, now: float = None) -> list:
+        """[(类别, 余额, 容量)]，供状态显示"""
+        now = time.time() if now is None else now
+        return [(key[0], self._level(key, now), self.capacity(key[0])) for key in self._targets(user_id, group_id)]
+
+    # ====== 快照 ======
+    def snapshot(self) -> dict:
+        return {
+            "version": _SNAPSHOT_VERSION,
+            "image_seconds": self.image_seconds,
+            "buckets": {key: bucket for key, bucket in self._buckets.items()},
+        }
+
+    def restore(self, data: dict):
+        if not isinstance(data, dict) or data.get("version") != _SNAPSHOT_VERSION:
+            return
+        image_seconds = data.get("image_seconds")
+        if isinstance(image_seconds, (int, float)) and image_seconds > 0:
+            self.image_seconds = float(image_seconds)
+        self._buckets.clear()
+        buckets = data.get("buckets")
+        valid = [
+            (key, float(bucket[0]), float(bucket[1]))
+            for key, bucket in (buckets.items() if isinstance(buckets, dict) else ())
+            if isinstance(key, str) and key[:2] in ("u:", "g:") and isinstance(bucket, list) and len(bucket) == 2
+            and all(isinstance(v, (int, float)) for v in bucket)
+        ]
+        # 按更新时间排序，恢复 LRU 顺序
+        for key, tokens, updated in sorted(valid, key=lambda b: b[2]):
+            self._store(key, tokens, updated)
+        self.dirty = False
+
+    def save(self, path: Path):
+        atomic_write(path, json.dumps(self.snapshot(), ensure_ascii=False).encode("utf-8"))
+        self.dirty = False
+
+    def load(self, path: Path) -> bool:
+        try:
+            data = json.loads(Path(path).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return False
+        self.restore(data)
+        return True
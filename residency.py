@@ -0,0 +1,177 @@
+"""
+模型驻留管理：让第一张图的等待时间可预期，空闲时把显存还给其他服务
+
+- 切换工作流 / 启动后提交一个最小的预热任务（64×64、1 步、不保存图片），模型加载由预热任务承担，
+  而不是之后第一个画图的用户
+- 记录后端大概率已加载的模型（最近一次成功出图或预热的工作流所用的 checkpoint），
+  切换到模型已在显存中的工作流时不重复预热
+- 连续空闲超过设定时长、插件内没有进行中的任务且后端队列为空时调用 ComfyUI 的 /free 卸载模型
+"""
+
+import asyncio
+import time
+
+from astrbot.api import logger
+
+from .metrics import JOBS_IN_FLIGHT
+
+
+class ModelResidency:
+    def __init__(self, api, idle_free_seconds: float = 1800, warm_up_on_switch: bool = True,
+                 warm_up_on_startup: bool = True, warm_up_timeout: float = 600):
+        self.api = api
+        self.idle_free_seconds = max(float(idle_free_seconds), 0.0)
+        self.warm_up_on_switch = bool(warm_up_on_switch)
+        self.warm_up_on_startup = bool(warm_up_on_startup)
+        self.warm_up_timeout = float(warm_up_timeout)
+
+        self.loaded = ()                # 认为后端已加载的 checkpoint
+        self.loaded_workflow = None
+        self.freed = False              # 由插件 /free 卸载后为 True，下次出图需要重新加载
+        self.last_active = time.monotonic()
+        self.last_warm_up = None        # 最近一次预热耗时（秒），可作为冷启动首图耗时的参考
+        self.warm_ups = 0
+        self.frees = 0
+        self._warm_task = None
+        self._warm_prompt_id = None     # 进行中的预热任务在后端的 prompt_id
+        self._idle_task = None
+        self._revoking = set()
+
+    @property
+    def warming(self) -> bool:
+        return self._warm_task is not None and not self._warm_task.done()
+
+    # ====== 生命周期 ======
+    def start(self):
+        if self.idle_free_seconds > 0 and self._idle_task is None:
+            self._idle_task = asyncio.create_task(self._watch_idle())
+        if self.warm_up_on_startup:
+            self.schedule_warm_up("启动")
+
+    def stop(self):
+        for task in (self._warm_task, self._idle_task):
+            if task is not None:
+                task.cancel()
+        self._warm_task = self._idle_task = None
+
+    # ====== 状态记录（由 ComfyUI 客户端调用）======
+    def _checkpoints(self, workflow: str) -> tuple:
+        index = self.api.workflow_index
+        entry = index.get(workflow) if index is not None else None
+        return entry.checkpoints if entry is not None else ()
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def mark_loaded(self, workflow: str):
+        """workflow 刚在后端成功执行过，其模型大概率还在显存中"""
+        self.touch()
+        self.loaded = self._checkpoints(workflow)
+        self.loaded_workflow = workflow
+        self.freed = False
+
+    def mark_freed(self):
+        self.loaded = ()
+        self.loaded_workflow = None
+        self.freed = True
+
+    def is_resident(self, workflow: str) -> bool:
+        if workflow == self.loaded_workflow:
+            return True
+        checkpoints = self._checkpoints(workflow)
+        return bool(checkpoints) and set(checkpoints) <= set(self.loaded)
+
+    # ====== 预热 ======
+    def schedule_warm_up(self, reason: str) -> bool:
+        """后台预热当前工作流；模型已驻留或没有事件循环时返回 False"""
+        workflow = self.api.wf_filename
+        if self.is_resident(workflow):
+            return False
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        if self.warming:
+            # 旧的预热被取代：后端任务一并撤销，否则仍会先加载旧工作流的模型，挡在用户的任务前面
+            self._warm_task.cancel()
+            self._revoke_warm_up()
+        self._warm_task = loop.create_task(self._warm_up(workflow, reason))
+        return True
+
+    def _on_warm_up_submitted(self, prompt_id: str):
+        self._warm_prompt_id = prompt_id
+
+    def _revoke_warm_up(self):
+        prompt_id, self._warm_prompt_id = self._warm_prompt_id, None
+        if not prompt_id:
+            return
+        task = asyncio.get_running_loop().create_task(self.api.cancel_prompt(prompt_id))
+        self._revoking.add(task)
+        task.add_done_callback(self._revoking.discard)
+
+    async def _warm_up(self, workflow: str, reason: str):
+        if sum(v for _, v in JOBS_IN_FLIGHT.items()) > 0:
+            logger.info(f"[ComfyUI] 🔥 跳过预热（{reason}）：已有生成任务，模型会随任务加载")
+            return
+        start = time.perf_counter()
+        try:
+            ok, error = await self.api.warm_up(self.warm_up_timeout, on_submitted=self._on_warm_up_submitted)
+        finally:
+            if asyncio.current_task() is self._warm_task:
+                self._warm_prompt_id = None
+        elapsed = time.perf_counter() - start
+        if not ok:
+            logger.warning(f"[ComfyUI] 🔥 预热 {workflow} 失败（{reason}）: {error}")
+            return
+        self.warm_ups += 1
+        self.last_warm_up = elapsed
+        if self.api.wf_filename == workflow:
+            self.mark_loaded(workflow)
+        logger.info(f"[ComfyUI] 🔥 已预热 {workflow}（{reason}），耗时 {elapsed:.1f}s")
+
+    # ====== 空闲卸载 ======
+    async def _watch_idle(self):
+        interval = min(max(self.idle_free_seconds / 4, 5.0), 60.0)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self._maybe_free()
+            except Exception as e:
+                logger.warning(f"[ComfyUI] 空闲卸载检查失败: {e}")
+
+    async def _maybe_free(self) -> bool:
+        if self.freed or self.warming or time.monotonic() - self.last_active < self.idle_free_seconds:
+            return False
+        if sum(v for _, v in JOBS_IN_FLIGHT.items()) > 0:
+            return False
+        if await self.api.get_queue_size():
+            # 后端还在为其他客户端工作，不打断
+            self.touch()
+            return False
+        if not await self.api.free_models():
+            self.touch()    # 等下一个空闲周期再试
+            return False
+        self.frees += 1
+        logger.info(f"[ComfyUI] 💤 空闲 {self.idle_free_seconds / 60:g} 分钟，已请求后端卸载模型释放显存")
+        return True
+
+    def describe(self) -> list:
+        """/comfy_stats 中展示的驻留状态"""
+        if self.warming:
+            state = "预热中"
+        elif self.freed:
+            state = "已卸载（下一张图需要重新加载模型）"
+        elif self.loaded_workflow:
+            state = f"已加载 {', '.join(self.loaded) or self.loaded_workflow}"
+        else:
+            state = "未知（尚未出图或预热）"
+        idle = time.monotonic() - self.last_active
+        lines = [f"🧊 模型驻留: {state}"]
+        detail = f"空闲 {idle / 60:.0f} 分钟"
+        if self.idle_free_seconds > 0:
+            detail += f" / {self.idle_free_seconds / 60:g} 分钟后卸载"
+        detail += f" · 预热 {self.warm_ups} 次 · 卸载 {self.frees} 次"
+        if self.last_warm_up is not None:
+            detail += f" · 最近预热 {self.last_warm_up:.1f}s"
+        lines.append(f"  {detail}")
+        return lines
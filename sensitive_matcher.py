@@ -0,0 +1,300 @@
+"""
+敏感词匹配引擎：每个策略编译一个 Aho-Corasick 自动机，一次线性扫描找出全部命中
+
+匹配前先用 normalize_prompt 把 SD 提示词语法归一化（词条用同样的规则处理）：
+- 全角字符等经 NFKC 归一，`(blood:1.3)`、`<lora:x:0.8>` 中的权重被去掉
+- 括号、转义符、下划线、连字符、冒号视为空格，`blood_splatter` 与 `blood splatter` 等价
+- 夹在字母之间的常见 leetspeak 数字/符号还原为字母（`bl00d` -> `blood`，`1girl`、`r18` 不受影响）
+- 大小写折叠与 re.IGNORECASE 一致
+
+匹配规则：
+- ASCII 词条与短语按整词匹配（前后不能紧挨字母、数字）
+- 非 ASCII 词条（中文等）按子串匹配
+- 从左到右取不重叠的命中；同一起点有多个候选时，按 单词 > 短语 > 非 ASCII、词库中的先后顺序取第一个
+- 结果按首次出现去重（不区分大小写），返回用户原文中对应的片段（`dub-con`、`bl00d` 原样返回）
+
+编译结果可以用 save_matchers / load_matchers 持久化，启动时词库未变就直接加载，不再重新构建
+"""
+
+import hashlib
+import json
+import marshal
+import re
+import unicodedata
+from pathlib import Path
+
+from .fileio import atomic_write
+
+# 自动机结构或匹配语义变化时递增，使旧缓存失效
+ENGINE_VERSION = 2
+
+# 与 re.IGNORECASE 一致的长度不变大小写折叠：ASCII 大写字母，
+# 以及 Unicode 中会被当作 ASCII 字母匹配的 4 个字符（İ ı ſ K）
+_FOLD_TABLE = {ord(c): ord(c.lower()) for c in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"}
+_FOLD_TABLE.update({0x130: ord("i"), 0x131: ord("i"), 0x17F: ord("s"), 0x212A: ord("k")})
+
+_WORD_CHARS = frozenset("abcdefghijklmnopqrstuvwxyz0123456789_")
+
+# SD 权重：(tag:1.3)、[a:b:0.5]、<lora:name:0.8> 中紧挨右括号或逗号的 :数值
+_WEIGHT_RE = re.compile(r":\s*[+-]?(?:\d+(?:\.\d*)?|\.\d+)(?=\s*(?:[)\]>,]|$))")
+# 提示词语法符号统一换成空格
+_SYNTAX_TABLE = str.maketrans({c: " " for c in "()[]{}<>\\_-:\t"})
+# 只还原两侧都是字母的数字/符号串，避免误伤 1girl、r18、69 这类本身带数字的标签
+_LEET_RE = re.compile(r"(?<=[A-Za-z])[013457@$]+(?=[A-Za-z])")
+_LEET_TABLE = str.maketrans("013457@$", "oieastas")
+_SPACES_RE = re.compile(r" {2,}")
+
+# 词条类别，同时是同一起点多个候选时的优先级
+KIND_WORD = 0
+KIND_PHRASE = 1
+KIND_OTHER = 2
+
+
+def fold(text: str) -> str:
+    return text.translate(_FOLD_TABLE)
+
+
+def normalize_prompt(text: str) -> str:
+    """把 SD 提示词归一化为便于匹配的纯文本：去权重、去括号、下划线转空格、还原 leetspeak"""
+    if not text.isascii():
+        text = unicodedata.normalize("NFKC", text)
+    text = _WEIGHT_RE.sub("", text)
+    text = text.translate(_SYNTAX_TABLE)
+    text = _LEET_RE.sub(lambda m: m.group().translate(_LEET_TABLE), text)
+    return _SPACES_RE.sub(" ", text)
+
+
+def _sub_with_spans(pattern, repl, text: str, spans: list) -> tuple:
+    """
+    与 pattern.sub(repl, text) 结果相同，同时维护每个字符对应的原文区间 (起点, 终点)
+    等长替换逐字符保留区间，其余替换结果整体对应被替换片段的原文区间
+    """
+    out, out_spans, last = [], [], 0
+    for m in pattern.finditer(text):
+        start, end = m.span()
+        out.append(text[last:start])
+        out_spans.extend(spans[last:start])
+        replaced = repl(m) if callable(repl) else repl
+        if len(replaced) == end - start:
+            out_spans.extend(spans[start:end])
+        elif replaced:
+            out_spans.extend([(spans[start][0], spans[end - 1][1])] * len(replaced))
+        out.append(replaced)
+        last = end
+    out.append(text[last:])
+    out_spans.extend(spans[last:])
+    return "".join(out), out_spans
+
+
+def normalize_with_spans(text: str):
+    """
+    与 normalize_prompt 相同的归一化，额外返回每个字符在原文中的区间，用于把命中还原为用户输入的写法
+    NFKC 按“基字符 + 组合符”分段处理；分段结果与整体归一化不一致时（极少见）返回 (归一化文本, None)
+    """
+    if text.isascii():
+        normalized, spans = text, [(i, i + 1) for i in range(len(text))]
+    else:
+        parts, spans = [], []
+        i, n = 0, len(text)
+        while i < n:
+            j = i + 1
+            while j < n and unicodedata.combining(text[j]):
+                j += 1
+            part = unicodedata.normalize("NFKC", text[i:j])
+            parts.append(part)
+            spans.extend([(i, j)] * len(part))
+            i = j
+        normalized = "".join(parts)
+        if normalized != unicodedata.normalize("NFKC", text):
+            return normalize_prompt(text), None
+    normalized, spans = _sub_with_spans(_WEIGHT_RE, "", normalized, spans)
+    normalized = normalized.translate(_SYNTAX_TABLE)
+    normalized = _LEET_RE.sub(lambda m: m.group().translate(_LEET_TABLE), normalized)
+    normalized, spans = _sub_with_spans(_SPACES_RE, " ", normalized, spans)
+    return normalized, spans
+
+
+def classify_terms(terms) -> list:
+    """归一化后分组去重，返回 [(类别, 词条)]，顺序即优先级"""
+    words, phrases, others = {}, {}, {}
+    for t in terms:
+        if not t or not isinstance(t, str):
+            continue
+        t = normalize_prompt(t).strip()
+        if not t:
+            continue
+        if all(ord(ch) < 128 for ch in t):
+            (phrases if " " in t else words).setdefault(t, None)
+        else:
+            others.setdefault(t, None)
+    return (
+        [(KIND_WORD, t) for t in words]
+        + [(KIND_PHRASE, t) for t in phrases]
+        + [(KIND_OTHER, t) for t in others]
+    )
+
+
+class SensitiveMatcher:
+    """
+    单个策略的 Aho-Corasick 自动机
+    状态以扁平列表保存（goto 字典 / fail 指针 / 输出），可直接 marshal 序列化
+    """
+
+    def __init__(self, terms=(), _state=None):
+        if _state is not None:
+            self.terms, self._goto, self._fail, self._out = _state
+            return
+        self.terms = classify_terms(terms)
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        self._build()
+
+    def __len__(self):
+        return len(self.terms)
+
+    def _build(self):
+        goto, out = self._goto, [[]]
+        for idx, (_, term) in enumerate(self.terms):
+            state = 0
+            for ch in fold(term):
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][ch] = nxt
+                    goto.append({})
+                    out.append([])
+                state = nxt
+            out[state].append(idx)
+
+        # 广度优先计算 fail 指针，并把 fail 链上的输出合并到当前状态
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        head = 0
+        while head < len(queue):
+            state = queue[head]
+            head += 1
+            for ch, nxt in goto[state].items():
+                queue.append(nxt)
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                target = goto[f].get(ch, 0)
+                fail[nxt] = target if target != nxt else 0
+                out[nxt].extend(out[fail[nxt]])
+        self._fail = fail
+        self._out = [tuple(sorted(o)) for o in out]
+
+    def to_state(self) -> tuple:
+        return self.terms, self._goto, self._fail, self._out
+
+    @classmethod
+    def from_state(cls, state) -> "SensitiveMatcher":
+        terms, goto, fail, out = state
+        return cls(_state=([tuple(t) for t in terms], goto, fail, [tuple(o) for o in out]))
+
+    def find(self, text: str) -> list:
+        if not text or not self.terms:
+            return []
+        original = text
+        text = normalize_prompt(text)
+        folded = fold(text)
+        goto, fail, out, terms = self._goto, self._fail, self._out, self.terms
+        n = len(folded)
+
+        # 第一遍：线性扫描，记录每个起点上优先级最高的合法命中 {起点: (词条序号, 终点)}
+        best = {}
+        state = 0
+        for i, ch in enumerate(folded):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if not out[state]:
+                continue
+            end = i + 1
+            for idx in out[state]:
+                kind, term = terms[idx]
+                start = end - len(term)
+                if kind != KIND_OTHER:
+                    if start > 0 and folded[start - 1] in _WORD_CHARS:
+                        continue
+                    if end < n and folded[end] in _WORD_CHARS:
+                        continue
+                prev = best.get(start)
+                if prev is None or idx < prev[0]:
+                    best[start] = (idx, end)
+
+        # 第二遍：从左到右取不重叠的命中，按首次出现去重（按归一化写法判断重复）
+        hits = []
+        seen = set()
+        pos = 0
+        for start in sorted(best):
+            if start < pos:
+                continue
+            _, end = best[start]
+            pos = end
+            key = folded[start:end]
+            if key not in seen:
+                seen.add(key)
+                hits.append((start, end))
+        if not hits:
+            return []
+
+        # 有命中时才计算原文区间，未命中的提示词不多花时间
+        mapped, spans = normalize_with_spans(original)
+        if spans is None or mapped != text:
+            return [text[start:end] for start, end in hits]
+        return [original[spans[start][0]:spans[end - 1][1]] for start, end in hits]
+
+
+# ====== 编译结果缓存 ======
+def lexicon_digest(lexicon_bytes: bytes, policies: dict) -> str:
+    """缓存键：词库文件原始内容 + 策略定义（策略 -> 分类）+ 引擎版本"""
+    h = hashlib.sha256()
+    h.update(f"engine={ENGINE_VERSION}\n".encode())
+    h.update(lexicon_bytes or b"")
+    h.update(json.dumps({k: sorted(v) for k, v in policies.items()}, sort_keys=True).encode("utf-8"))
+    return h.hexdigest()
+
+
+def load_matchers(path: Path, digest: str):
+    """读取缓存，键一致时返回 {策略: SensitiveMatcher | None}，否则返回 None"""
+    try:
+        data = marshal.loads(Path(path).read_bytes())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(data, dict) or data.get("digest") != digest:
+        return None
+    try:
+        return {
+            policy: SensitiveMatcher.from_state(state) if state is not None else None
+            for policy, state in data["matchers"].items()
+        }
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def save_matchers(path: Path, digest: str, matchers: dict):
+    """写入缓存（原子替换）"""
+    data = {
+        "digest": digest,
+        "matchers": {p: m.to_state() if m is not None else None for p, m in matchers.items()},
+    }
+    atomic_write(path, marshal.dumps(data))
+
+
+def diff_lexicon(old: dict, new: dict) -> dict:
+    """
+    逐分类比较两个词库，返回 {分类: (新增词条数, 删除词条数)}，只包含有变化的分类
+    词条顺序也决定匹配优先级，所以只调整顺序的分类同样算作变化（增删均为 0）
+    """
+    changed = {}
+    for cat in set(old) | set(new):
+        before = old.get(cat, [])
+        after = new.get(cat, [])
+        if before == after:
+            continue
+        before_set = {t for t in before if isinstance(t, str)}
+        after_set = {t for t in after if isinstance(t, str)}
+        changed[cat] = (len(after_set - before_set), len(before_set - after_set))
+    return changed
@@ -0,0 +1,246 @@
+"""
+LLM 回复标签解析：一次扫描 completion，识别 <pic prompt="...">、<think>、<ctx>、<render> 标签
+
+语义与原先的多遍正则保持一致：
+- <pic prompt="...">（pic 后可以是任意空白）：内容到第一个 `">` 为止，内容中的其他标签不解析；未闭合的 <pic 按普通文本处理
+- <think>...</think>：到第一个 </think> 为止整体删除（中间的 <pic> 仍会被提取）；没有对应 </think> 的 <think> 保留为文本
+- <ctx>、</ctx>：删除
+- <render ...>、</render>：保留在文本中，只记录每个文本段是否包含开/闭标签
+
+所有查找都从当前位置向后进行，每个字符最多被扫描常数次，畸形或恶意构造的输入也保持线性时间
+"""
+
+import re
+
+# 标签起点；<pic 后必须跟空白和 prompt="，<render 只要求单词边界
+_TOKEN_RE = re.compile(r'<(?:pic\s+prompt="|think>|/think>|/?ctx>|render\b|/render>)')
+_PIC_OPEN_RE = re.compile(r'<pic\s+prompt="')
+_RENDER_OPEN_RE = re.compile(r'<render\b')
+_PIC_CLOSE = '">'
+
+_PROMPT_PREFIX_RE = re.compile(r'^提示词是\s*[:：]?\s*')
+_PLACEHOLDER_RE = re.compile(r'^(?:\.{2,}|…+|[.。]+|[xX]{2,}|[-_=]{2,}|\[.*?\]|\{.*?\})$')
+
+
+class TextPart:
+    """两个 <pic> 之间的文本（已去掉 think/ctx），以及其中是否出现 render 开/闭标签"""
+
+    __slots__ = ("text", "render_open", "render_close")
+
+    def __init__(self, text: str, render_open: bool, render_close: bool):
+        self.text = text
+        self.render_open = render_open
+        self.render_close = render_close
+
+
+class ParsedReply:
+    """
+    prompts:          按出现顺序的 <pic> 提示词原文
+    parts:            文本段，len(parts) == len(prompts) + 1，与 re.split(<pic>) 的切分位置一致
+    cleaned_text:     去掉 pic/think/ctx 后的完整文本（已 strip）
+    render_open_tag:  原文中第一个完整的 <render ...> 开标签（与原先对全文做 re.search 相同）
+    """
+
+    __slots__ = ("prompts", "parts", "cleaned_text", "render_open_tag")
+
+    def __init__(self, prompts, parts, cleaned_text, render_open_tag):
+        self.prompts = prompts
+        self.parts = parts
+        self.cleaned_text = cleaned_text
+        self.render_open_tag = render_open_tag
+
+    def segments(self) -> list:
+        """[("text", 文本段) / ("pic", 提示词)] 交替序列，空文本段已跳过"""
+        out = []
+        for i, part in enumerate(self.parts):
+            if part.text:
+                out.append(("text", part.text))
+            if i < len(self.prompts):
+                out.append(("pic", self.prompts[i]))
+        return out
+
+
+def parse_reply(text: str) -> ParsedReply:
+    prompts = []
+    parts = []
+    pieces = []
+    render_open = render_close = False
+    # 从该位置起再也没有 `">`，之后的 <pic 都不可能闭合，不再向后查找
+    no_pic_close_from = len(text) + 1
+    # 出现过未闭合的 <think> 后，后面的 <think> 也不可能闭合
+    think_closable = True
+
+    pos = 0
+    think_start = -1    # >= 0 表示处在 <think> 块内
+    snapshot = None     # 进入 think 块时的状态，块未闭合时回退用
+
+    while True:
+        m = _TOKEN_RE.search(text, pos)
+        if m is None:
+            if think_start >= 0:
+                # 没有对应的 </think>：<think> 按文本保留，从它之后重新扫描
+                prompts_len, parts_len, pieces, pieces_len, render_open, render_close = snapshot
+                del prompts[prompts_len:], parts[parts_len:], pieces[pieces_len:]
+                pieces.append("<think>")
+                pos = think_start + len("<think>")
+                think_start = -1
+                think_closable = False
+                continue
+            pieces.append(text[pos:])
+            break
+
+        start, end = m.span()
+        token = m.group()
+        in_think = think_start >= 0
+
+        if token.startswith("<pic"):
+            close = text.find(_PIC_CLOSE, end) if end < no_pic_close_from else -1
+            if close < 0:
+                no_pic_close_from = min(no_pic_close_from, end)
+                if not in_think:
+                    pieces.append(text[pos:end])
+                pos = end
+                continue
+            if not in_think:
+                pieces.append(text[pos:start])
+            prompts.append(text[end:close])
+            parts.append((pieces, render_open, render_close))
+            pieces = []
+            render_open = render_close = False
+            pos = close + len(_PIC_CLOSE)
+            continue
+
+        if in_think:
+            if token == "</think>":
+                think_start = -1
+            pos = end
+            continue
+
+        if token == "<think>":
+            if not think_closable:
+                pieces.append(text[pos:end])
+                pos = end
+                continue
+            pieces.append(text[pos:start])
+            think_start = start
+            snapshot = (len(prompts), len(parts), pieces, len(pieces), render_open, render_close)
+            pos = end
+            continue
+
+        if token in ("<ctx>", "</ctx>"):
+            pieces.append(text[pos:start])
+            pos = end
+            continue
+
+        # render 标签和多余的 </think> 原样保留
+        pieces.append(text[pos:end])
+        if token == "</render>":
+            render_close = True
+        elif token.startswith("<render"):
+            render_open = True
+        pos = end
+
+    parts.append((pieces, render_open, render_close))
+    text_parts = [TextPart("".join(p).strip(), o, c) for p, o, c in parts]
+    cleaned_text = "".join("".join(p) for p, _, _ in parts).strip()
+    return ParsedReply(prompts, text_parts, cleaned_text, _first_render_tag(text))
+
+
+def _first_render_tag(text: str):
+    """等价于 re.search(r'<render\\b[^>]*>', text)，但第一个 <render 之后没有 > 时直接结束，不会退化为平方复杂度"""
+    m = _RENDER_OPEN_RE.search(text)
+    if m is None:
+        return None
+    gt = text.find(">", m.end())
+    return text[m.start():gt + 1] if gt >= 0 else None
+
+
+def strip_pic_tags(text: str) -> tuple:
+    """删除所有 <pic prompt="..."> 标签，返回 (新文本, 删除个数)；文本未变化时原样返回"""
+    pieces = []
+    count = 0
+    pos = 0
+    while True:
+        m = _PIC_OPEN_RE.search(text, pos)
+        if m is None:
+            break
+        close = text.find(_PIC_CLOSE, m.end())
+        if close < 0:
+            break
+        pieces.append(text[pos:m.start()])
+        pos = close + len(_PIC_CLOSE)
+        count += 1
+    if not count:
+        return text, 0
+    pieces.append(text[pos:])
+    return "".join(pieces), count
+
+
+def clean_prompt(prompt: str) -> str:
+    """去掉“提示词是：”前缀和包裹的引号"""
+    prompt = _PROMPT_PREFIX_RE.sub("", prompt).strip()
+    return prompt.strip('`"\'""''').strip()
+
+
+def is_placeholder(prompt: str) -> bool:
+    return _PLACEHOLDER_RE.match(prompt) is not None
+
+
+# <pic\s+prompt=" 的所有前缀（流式分片可能在标签中间断开）
+_PIC_OPEN_PREFIX_RE = re.compile(r'<(?:p(?:i(?:c(?:\s+(?:p(?:r(?:o(?:m(?:p(?:t=?)?)?)?)?)?)?)?)?)?)?')
+
+
+class PicStreamDetector:
+    """
+    流式 <pic> 检测：逐块喂入 LLM 输出，每当一个 <pic prompt="..."> 的 `">` 到达就返回其提示词
+    与 parse_reply 的提取结果一致（<pic> 在任何位置都会被识别，内容不解析其他标签）；
+    只保留可能构成标签的尾部，已确定的文本立即丢弃，总耗时与输入长度成线性
+    """
+
+    def __init__(self):
+        self._tail = ""          # 标签外：可能是 <pic 开头的未决尾部
+        self._content = None     # 标签内：已收到的提示词分片，None 表示在标签外
+        self._pending_quote = False
+        self.count = 0
+
+    def feed(self, chunk: str) -> list:
+        closed = []
+        text = chunk
+        while text:
+            if self._content is None:
+                text = self._feed_outside(text)
+            else:
+                text = self._feed_inside(text, closed)
+        return closed
+
+    def _feed_outside(self, chunk: str) -> str:
+        buf = self._tail + chunk
+        m = _PIC_OPEN_RE.search(buf)
+        if m is not None:
+            self._tail = ""
+            self._content = []
+            self._pending_quote = False
+            return buf[m.end():]
+        # 没有完整的开标签：只保留最后一个 '<' 起、仍可能补全为开标签的部分
+        lt = buf.rfind("<")
+        self._tail = buf[lt:] if lt >= 0 and _PIC_OPEN_PREFIX_RE.fullmatch(buf, lt) else ""
+        return ""
+
+    def _feed_inside(self, chunk: str, closed: list) -> str:
+        if self._pending_quote and chunk.startswith(">"):
+            # 上一块以 `"` 结尾，这一块以 `>` 开头
+            self._finish(self._content[:-1] + [self._content[-1][:-1]], closed)
+            return chunk[1:]
+        end = chunk.find(_PIC_CLOSE)
+        if end < 0:
+            self._content.append(chunk)
+            self._pending_quote = chunk.endswith('"')
+            return ""
+        self._finish(self._content + [chunk[:end]], closed)
+        return chunk[end + len(_PIC_CLOSE):]
+
+    def _finish(self, pieces: list, closed: list):
+        closed.append("".join(pieces))
+        self.count += 1
+        self._content = None
+        self._pending_quote = False
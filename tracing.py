@@ -0,0 +1,123 @@
+import json
+import time
+import uuid
+from pathlib import Path
+from contextlib import contextmanager
+from astrbot.api import logger
+
+
+class _NullTrace:
+    """未开启追踪时使用的空对象，所有操作均为空操作"""
+    request_id = ""
+    enabled = False
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        yield
+
+    def add_span(self, name: str, start: float, duration: float, **attrs):
+        pass
+
+    def set_attr(self, key: str, value):
+        pass
+
+
+NULL_TRACE = _NullTrace()
+
+
+class RequestTrace:
+    """
+    单次绘图请求的追踪记录
+    一个请求会跨越 on_llm_response -> on_decorating_result(99) -> 发送阶段等多个钩子，
+    各钩子通过 event extra 拿到同一个 RequestTrace 并记录自己的 span
+    """
+    enabled = True
+
+    def __init__(self, request_id: str = None, **attrs):
+        self.request_id = request_id or uuid.uuid4().hex[:12]
+        self.attrs = dict(attrs)
+        self.started_at = time.time()
+        self.spans = []
+        self._stack = []
+        self.finished = False
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        start = time.time()
+        perf_start = time.perf_counter()
+        parent = self._stack[-1] if self._stack else None
+        self._stack.append(name)
+        try:
+            yield
+        except BaseException as e:
+            attrs["error"] = f"{type(e).__name__}: {e}"[:200]
+            raise
+        finally:
+            self._stack.pop()
+            self._record(name, start, time.perf_counter() - perf_start, parent, attrs)
+
+    def add_span(self, name: str, start: float, duration: float, **attrs):
+        """补记一个在别处测得的 span（如 ComfyUI history 中的排队/执行时间）"""
+        parent = self._stack[-1] if self._stack else None
+        self._record(name, start, duration, parent, attrs)
+
+    def set_attr(self, key: str, value):
+        self.attrs[key] = value
+
+    def _record(self, name: str, start: float, duration: float, parent, attrs: dict):
+        self.spans.append({
+            "name": name,
+            "parent": parent,
+            "start": round(start, 6),
+            "duration_ms": round(max(duration, 0.0) * 1000, 3),
+            "attrs": attrs,
+        })
+
+    @property
+    def elapsed(self) -> float:
+        return time.time() - self.started_at
+
+    def to_records(self, status: str) -> list:
+        total_ms = round(self.elapsed * 1000, 3)
+        base = {"request_id": self.request_id}
+        records = [dict(base, **span) for span in self.spans]
+        records.append(dict(
+            base, name="request", parent=None, start=round(self.started_at, 6),
+            duration_ms=total_ms, attrs=dict(self.attrs, status=status),
+        ))
+        return records
+
+
+class TraceExporter:
+    """把完成的请求追踪以 JSON Lines 追加写入文件（每行一个 span，最后一行为整个请求）"""
+
+    def __init__(self, file_path: Path, slow_threshold_ms: float = 0, max_bytes: int = 20 * 1024 * 1024):
+        self.file_path = Path(file_path)
+        self.slow_threshold_ms = float(slow_threshold_ms or 0)
+        self.max_bytes = int(max_bytes)
+
+    def new_trace(self, **attrs) -> RequestTrace:
+        return RequestTrace(**attrs)
+
+    def export(self, trace: RequestTrace, status: str = "ok"):
+        if not trace.enabled or trace.finished:
+            return
+        trace.finished = True
+        if self.slow_threshold_ms and trace.elapsed * 1000 < self.slow_threshold_ms:
+            return
+        try:
+            self._rotate_if_needed()
+            with open(self.file_path, "a", encoding="utf-8") as f:
+                for record in trace.to_records(status):
+                    f.write(json.dumps(record, ensure_ascii=False, default=str))
+                    f.write("\n")
+        except Exception as e:
+            logger.warning(f"[ComfyUI] 写入追踪记录失败: {e}")
+
+    def _rotate_if_needed(self):
+        if not self.max_bytes or not self.file_path.exists():
+            return
+        if self.file_path.stat().st_size < self.max_bytes:
+            return
+        rotated = self.file_path.with_name(self.file_path.name + ".1")
+        self.file_path.replace(rotated)
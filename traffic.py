@@ -0,0 +1,90 @@
+import hashlib
+import hmac
+import json
+import os
+import time
+from pathlib import Path
+from astrbot.api import logger
+
+
+class TrafficRecorder:
+    """
+    匿名流量录制：记录每个到达插件的绘图相关事件，供 bench/replay.py 回放
+    只保存时间戳、来源（指令/LLM 自动绘图/LLM 工具）、提示词长度、<pic> 数量、工作流，
+    群号与用户 ID 经带盐 HMAC 处理为不可逆的分桶标识，不记录任何文本内容
+    """
+
+    def __init__(self, file_path: Path, salt_path: Path, max_bytes: int = 50 * 1024 * 1024):
+        self.file_path = Path(file_path)
+        self.max_bytes = int(max_bytes)
+        self._salt = self._load_salt(Path(salt_path))
+
+    @staticmethod
+    def _load_salt(salt_path: Path) -> bytes:
+        """盐值按安装持久化：同一用户在多次录制间映射到同一分桶，但无法反推原始 ID"""
+        try:
+            if salt_path.exists():
+                salt = salt_path.read_bytes()
+                if salt:
+                    return salt
+            salt = os.urandom(16).hex().encode()
+            salt_path.write_bytes(salt)
+            return salt
+        except Exception as e:
+            logger.warning(f"[ComfyUI] 读取流量录制盐值失败，本次使用临时盐值: {e}")
+            return os.urandom(16).hex().encode()
+
+    def bucket(self, value) -> str:
+        if value is None or value == "":
+            return ""
+        return hmac.new(self._salt, str(value).encode("utf-8"), hashlib.sha256).hexdigest()[:10]
+
+    def record(self, kind: str, user_id=None, group_id=None, prompt_lengths=(), pic_count: int = 0,
+               reply_length: int = 0, workflow: str = "", **extra):
+        """
+        kind: command（/画图 等指令）| llm（LLM 回复中的 <pic>）| tool（LLM 直接调用 comfyui_txt2img）
+        """
+        entry = {
+            "ts": round(time.time(), 3),
+            "kind": kind,
+            "group": self.bucket(group_id),
+            "user": self.bucket(user_id),
+            "prompt_lengths": [int(n) for n in prompt_lengths],
+            "pic_count": int(pic_count),
+            "reply_length": int(reply_length),
+            "workflow": workflow,
+        }
+        entry.update(extra)
+        try:
+            self._rotate_if_needed()
+            with open(self.file_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False))
+                f.write("\n")
+        except Exception as e:
+            logger.warning(f"[ComfyUI] 写入流量录制失败: {e}")
+
+    def _rotate_if_needed(self):
+        if not self.max_bytes or not self.file_path.exists():
+            return
+        if self.file_path.stat().st_size < self.max_bytes:
+            return
+        rotated = self.file_path.with_name(self.file_path.name + ".1")
+        self.file_path.replace(rotated)
+
+
+def load_traffic(path) -> list:
+    """读取录制文件，跳过损坏的行，按时间排序"""
+    entries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(entry, dict) and "ts" in entry and "kind" in entry:
+                entries.append(entry)
+    entries.sort(key=lambda e: e["ts"])
+    return entries
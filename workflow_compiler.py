@@ -0,0 +1,281 @@
+"""
+工作流编译：导入（/comfy_save）时做一次校验、规范化与分析，结果存到 <名称>.compiled.json
+
+- 校验：必须是 API 格式（{节点ID: {"class_type", "inputs"}}），编辑器格式（含 nodes/links）直接拒绝；
+  每条连线 [节点ID, 输出序号] 指向的节点必须存在
+- 规范化：节点 ID 与连线目标统一为字符串，只保留 class_type / inputs / _meta，紧凑存储
+- 分析：从采样器沿 positive/negative 连线向上找到正/负面提示词节点及其文本字段，识别输出节点、
+  种子输入（以及其中属于主采样器的部分）、潜空间（宽高）节点，预先算好注入位置（slots）
+- 元数据带工作流原文的摘要，原文被手动改动后自动失效，重新在内存中分析
+"""
+
+import hashlib
+import json
+from collections import deque
+from pathlib import Path
+
+COMPILED_SUFFIX = ".compiled.json"
+COMPILED_VERSION = 2
+
+# 提示词文本字段（与注入时的查找顺序一致）
+PROMPT_INPUT_KEYS = ("text", "opt_text", "string", "text_positive", "positive", "prompt", "wildcard_text")
+NEGATIVE_INPUT_KEYS = ("text", "string", "negative", "text_negative", "prompt")
+SEED_INPUT_KEYS = ("seed", "noise_seed")
+MODEL_INPUT_KEYS = ("ckpt_name", "unet_name")
+OUTPUT_CLASS_SUFFIXES = ("SaveImage", "PreviewImage", "SaveImageWebsocket")
+# 从采样器向上查找提示词节点的最大深度（跨过 ConditioningCombine 之类的中间节点）
+_MAX_COND_DEPTH = 8
+
+
+class WorkflowCompileError(ValueError):
+    """工作流校验失败，problems 为逐条的问题描述"""
+
+    def __init__(self, problems: list):
+        self.problems = list(problems)
+        super().__init__("；".join(self.problems[:3]))
+
+
+def is_link(value) -> bool:
+    """ComfyUI API 格式中的连线：[源节点ID, 输出序号]"""
+    return (isinstance(value, list) and len(value) == 2 and isinstance(value[0], (str, int))
+            and isinstance(value[1], int) and not isinstance(value[1], bool))
+
+
+def dumps_compact(workflow: dict) -> str:
+    return json.dumps(workflow, ensure_ascii=False, separators=(",", ":"))
+
+
+def digest(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def compiled_path(workflow_path: Path) -> Path:
+    workflow_path = Path(workflow_path)
+    return workflow_path.with_name(f"{workflow_path.stem}{COMPILED_SUFFIX}")
+
+
+# ====== 校验与规范化 ======
+def normalize(data) -> dict:
+    """校验并返回规范化后的工作流；有问题时抛出 WorkflowCompileError"""
+    if isinstance(data, dict) and "nodes" in data and "links" in data:
+        raise WorkflowCompileError(["这是 ComfyUI 编辑器格式的工作流，请在 ComfyUI 中用 Export (API) 导出"])
+    if isinstance(data, dict) and isinstance(data.get("prompt"), dict) and "class_type" not in data["prompt"]:
+        # 兼容直接粘贴 /prompt 请求体的情况
+        data = data["prompt"]
+    if not isinstance(data, dict) or not data:
+        raise WorkflowCompileError(["工作流必须是非空的 {节点ID: 节点} 对象"])
+
+    problems = []
+    workflow = {}
+    for nid, node in data.items():
+        nid = str(nid)
+        if not isinstance(node, dict) or not isinstance(node.get("class_type"), str) or not node["class_type"]:
+            problems.append(f"节点 {nid} 缺少 class_type，不是 API 格式")
+            continue
+        inputs = node.get("inputs", {})
+        if not isinstance(inputs, dict):
+            problems.append(f"节点 {nid} 的 inputs 不是对象")
+            continue
+        normalized = {"class_type": node["class_type"], "inputs": {
+            key: [str(value[0]), value[1]] if is_link(value) else value for key, value in inputs.items()
+        }}
+        if isinstance(node.get("_meta"), dict):
+            normalized["_meta"] = node["_meta"]
+        workflow[nid] = normalized
+
+    for nid, node in workflow.items():
+        for key, value in node["inputs"].items():
+            if is_link(value) and value[0] not in workflow:
+                problems.append(f"节点 {nid}.{key} 连接的节点 {value[0]} 不存在")
+            elif is_link(value) and value[1] < 0:
+                problems.append(f"节点 {nid}.{key} 的输出序号 {value[1]} 无效")
+    if problems:
+        raise WorkflowCompileError(problems)
+    return workflow
+
+
+# ====== 分析 ======
+def _text_key(inputs: dict, keys: tuple):
+    for key in keys:
+        if isinstance(inputs.get(key), str):
+            return key
+    return None
+
+
+def _find_text_node(workflow: dict, start: str, keys: tuple):
+    """从 start 沿连线向上广度优先查找第一个带文本字段的节点，返回 {"node", "key"}"""
+    seen = {start}
+    queue = deque([(start, 0)])
+    while queue:
+        nid, depth = queue.popleft()
+        inputs = workflow[nid]["inputs"]
+        key = _text_key(inputs, keys)
+        if key is not None:
+            return {"node": nid, "key": key}
+        if depth >= _MAX_COND_DEPTH:
+            continue
+        for value in inputs.values():
+            if is_link(value) and value[0] not in seen:
+                seen.add(value[0])
+                queue.append((value[0], depth + 1))
+    return None
+
+
+def upstream(workflow: dict, roots) -> set:
+    """roots 及其所有上游节点"""
+    seen = set()
+    stack = [r for r in roots if r in workflow]
+    while stack:
+        nid = stack.pop()
+        if nid in seen:
+            continue
+        seen.add(nid)
+        for value in workflow[nid]["inputs"].values():
+            if is_link(value) and value[0] in workflow and value[0] not in seen:
+                stack.append(value[0])
+    return seen
+
+
+def unreachable(workflow: dict, output_id) -> tuple:
+    """与 output_id 无关（不在其上游）的节点 ID；output_id 为空或不在工作流中时返回空"""
+    if output_id not in workflow:
+        return ()
+    keep = upstream(workflow, [output_id])
+    return tuple(nid for nid in workflow if nid not in keep)
+
+
+def _seed_source(workflow: dict, nid: str, key: str):
+    """采样器的种子输入：字面值时就是它自己，是连线时沿连线找到提供种子的节点（如 Seed 节点）"""
+    for _ in range(_MAX_COND_DEPTH):
+        value = workflow[nid]["inputs"][key]
+        if not is_link(value):
+            return [nid, key]
+        nid = value[0]
+        key = next((k for k in SEED_INPUT_KEYS if k in workflow[nid]["inputs"]), None)
+        if key is None:
+            return None
+    return None
+
+
+def _primary_seeds(workflow: dict, primary: list, reachable: set, seeds: list) -> list:
+    """
+    换图时需要重新随机的种子：主采样器的种子（或为其提供种子的节点）
+    主采样器不带种子时（如 SamplerCustomAdvanced + RandomNoise）退回到主输出上游的全部种子
+    """
+    result = []
+    for nid in primary:
+        for key in SEED_INPUT_KEYS:
+            if key in workflow[nid]["inputs"]:
+                slot = _seed_source(workflow, nid, key)
+                if slot is not None and slot not in result:
+                    result.append(slot)
+    return result or [slot for slot in seeds if slot[0] in reachable]
+
+
+def analyze(workflow: dict) -> dict:
+    """分析规范化后的工作流，返回可写入 .compiled.json 的元数据"""
+    outputs, samplers, seeds, text_nodes, checkpoints = [], [], [], [], []
+    latent = None
+    for nid, node in workflow.items():
+        class_type = node["class_type"]
+        inputs = node["inputs"]
+        if class_type.endswith(OUTPUT_CLASS_SUFFIXES):
+            outputs.append(nid)
+        if is_link(inputs.get("positive")) and is_link(inputs.get("negative")):
+            samplers.append(nid)
+        for key in SEED_INPUT_KEYS:
+            if key in inputs and not is_link(inputs[key]):
+                seeds.append([nid, key])
+        if "CLIPTextEncode" in class_type or _text_key(inputs, PROMPT_INPUT_KEYS):
+            text_nodes.append(nid)
+        for key in MODEL_INPUT_KEYS:
+            if isinstance(inputs.get(key), str) and inputs[key] not in checkpoints:
+                checkpoints.append(inputs[key])
+        if latent is None and all(isinstance(inputs.get(k), int) for k in ("width", "height", "batch_size")):
+            latent = {"node": nid, "width": "width", "height": "height", "batch": "batch_size"}
+
+    # 主输出：优先写入历史记录的 SaveImage（插件从 /history 取图），其次任意图片输出
+    output = next((n for n in outputs if workflow[n]["class_type"] == "SaveImage"), None) \
+        or next((n for n in outputs if not workflow[n]["class_type"].endswith("Websocket")), None) \
+        or (outputs[0] if outputs else None)
+    # 主采样器：主输出上游的采样器（没有输出节点时取全部）
+    reachable = upstream(workflow, [output]) if output else set(workflow)
+    primary = [n for n in samplers if n in reachable] or samplers
+
+    positive = negative = None
+    for nid in primary:
+        inputs = workflow[nid]["inputs"]
+        positive = positive or _find_text_node(workflow, inputs["positive"][0], PROMPT_INPUT_KEYS)
+        negative = negative or _find_text_node(workflow, inputs["negative"][0], NEGATIVE_INPUT_KEYS)
+        if positive and negative:
+            break
+    if positive is None:
+        # 没有采样器连线可循时，取第一个提示词节点
+        for nid in text_nodes:
+            key = _text_key(workflow[nid]["inputs"], PROMPT_INPUT_KEYS)
+            if key:
+                positive = {"node": nid, "key": key}
+                break
+
+    return {
+        "version": COMPILED_VERSION,
+        "node_count": len(workflow),
+        "positive": positive,
+        "negative": negative,
+        "output": output,
+        "outputs": outputs,
+        "samplers": primary,
+        "seeds": seeds,
+        "primary_seeds": _primary_seeds(workflow, primary, reachable, seeds),
+        "latent": latent,
+        "text_nodes": text_nodes,
+        "checkpoints": checkpoints,
+    }
+
+
+def warm_up_workflow(workflow: dict, meta: dict, size: int = 64) -> dict:
+    """
+    缩成只为让后端加载模型的最小任务：只保留主输出上游的节点，画布 size×size、批量 1、
+    所有采样步数改为 1，SaveImage 换成不落盘的 PreviewImage
+    """
+    output = meta["output"]
+    if output not in workflow:
+        raise WorkflowCompileError(["没有识别出输出节点，无法构造预热任务"])
+    keep = upstream(workflow, [output])
+    result = {nid: node for nid, node in workflow.items() if nid in keep}
+    latent = meta["latent"]
+    if latent and latent["node"] in result:
+        inputs = result[latent["node"]]["inputs"]
+        inputs[latent["width"]] = inputs[latent["height"]] = size
+        inputs[latent["batch"]] = 1
+    for node in result.values():
+        if isinstance(node["inputs"].get("steps"), int):
+            node["inputs"]["steps"] = 1
+    if result[output]["class_type"] == "SaveImage":
+        result[output] = {"class_type": "PreviewImage", "inputs": {"images": result[output]["inputs"].get("images")}}
+    return result
+
+
+def compile_workflow(data) -> tuple:
+    """校验、规范化并分析，返回 (紧凑 JSON 文本, 元数据)；元数据中带有该文本的摘要"""
+    workflow = normalize(data)
+    text = dumps_compact(workflow)
+    meta = analyze(workflow)
+    meta["digest"] = digest(text)
+    return text, meta
+
+
+# ====== 元数据读写 ======
+def save_compiled(path: Path, meta: dict):
+    Path(path).write_text(json.dumps(meta, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+
+
+def load_compiled(path: Path, text: str):
+    """读取元数据；文件不存在、版本不符或与工作流原文摘要不一致时返回 None"""
+    try:
+        meta = json.loads(Path(path).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if not isinstance(meta, dict) or meta.get("version") != COMPILED_VERSION or meta.get("digest") != digest(text):
+        return None
+    return meta
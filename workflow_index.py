@@ -0,0 +1,294 @@
+"""
+工作流目录索引
+
+启动时扫描一次 workflow/ 目录，缓存每个工作流的原文与元数据（大小、修改时间、节点数、步数覆盖数、
+模型名、识别出的提示词/输出节点、注入位置、按输出节点算好的裁剪结果）。
+元数据优先取导入时生成的 .compiled.json（摘要与原文一致时），否则在内存中分析一次。之后按文件 (mtime, size) 判断是否需要重新解析：
+- refresh() 重新列目录（两次之间至少间隔 min_interval 秒），只解析新增或改动过的文件
+- get() 只 stat 单个工作流及其 .steps.json / .seeds.json，生成时不再每次读盘解析 sidecar
+/comfy_ls、/comfy_use、UI 下拉列表和 ComfyUI 客户端共用同一个索引
+"""
+
+import json
+import os
+import time
+from pathlib import Path
+
+from astrbot.api import logger
+
+from .workflow_compiler import COMPILED_SUFFIX, WorkflowCompileError, analyze, load_compiled, normalize, unreachable
+
+SEEDS_SUFFIX = ".seeds.json"
+# 工作流目录中不是工作流本身的附属文件
+SIDECAR_SUFFIXES = (".steps.json", SEEDS_SUFFIX, COMPILED_SUFFIX)
+
+
+def is_workflow_file(name: str) -> bool:
+    return name.endswith(".json") and not name.endswith(SIDECAR_SUFFIXES)
+
+
+def sidecar_name(filename: str, suffix: str = ".steps.json") -> str:
+    return f"{Path(filename).stem}{suffix}"
+
+
+def parse_steps_override(data) -> dict:
+    """
+    解析 steps 覆盖配置，返回 {"3839": 20, "4521": 50}
+    支持新格式 {"3839": {"steps": 20}} 和简化格式 {"3839": 20}
+    """
+    if not isinstance(data, dict):
+        return {}
+    result = {}
+    for key, value in data.items():
+        if isinstance(value, dict) and "steps" in value:
+            steps = value.get("steps")
+            if isinstance(steps, (int, float)) and steps > 0:
+                result[str(key)] = int(steps)
+        elif isinstance(value, (int, float)) and value > 0:
+            result[str(key)] = int(value)
+    return result
+
+
+def parse_seed_policy(data):
+    """
+    解析种子配置：None 为自动（只重新随机主采样器的种子），"all" 为所有种子，
+    节点 ID 元组为只随机这些节点；支持 {"mode": "auto"|"all"}、{"nodes": [...]} 和直接写节点列表
+    """
+    if isinstance(data, dict):
+        if data.get("mode") == "all":
+            return "all"
+        data = data.get("nodes")
+    if isinstance(data, list) and data:
+        return tuple(str(nid) for nid in data)
+    return None
+
+
+def describe_seed_policy(policy) -> str:
+    if policy == "all":
+        return "全部种子"
+    if policy:
+        return f"指定节点 {', '.join(policy)}"
+    return "自动（主采样器）"
+
+
+def _stat_key(path: str):
+    """(mtime_ns, size)；文件不存在时返回 None"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class WorkflowEntry:
+    """单个工作流文件的缓存：原文 + 元数据"""
+
+    __slots__ = ("name", "path", "steps_path", "stat", "raw", "compiled", "node_count", "checkpoints",
+                 "prompt_nodes", "output_nodes", "error", "steps_stat", "steps_overrides", "seeds_path",
+                 "seeds_stat", "seed_policy", "_pruned")
+
+    def __init__(self, name: str, path: str, stat: tuple, raw: str):
+        self.name = name
+        self.path = path
+        self.steps_path = os.path.join(os.path.dirname(path), sidecar_name(name))
+        self.stat = stat
+        self.raw = raw
+        self.compiled = None
+        self.node_count = 0
+        self.checkpoints = ()
+        self.prompt_nodes = ()
+        self.output_nodes = ()
+        self.error = None
+        self.steps_stat = None
+        self.steps_overrides = {}
+        self.seeds_path = os.path.join(os.path.dirname(path), sidecar_name(name, SEEDS_SUFFIX))
+        self.seeds_stat = None
+        self.seed_policy = None
+        self._pruned = {}            # 输出节点 ID -> 裁剪掉的节点（文件改动后整个条目重建，缓存随之失效）
+        self._analyze()
+
+    @property
+    def size(self) -> int:
+        return self.stat[1]
+
+    @property
+    def mtime(self) -> float:
+        return self.stat[0] / 1e9
+
+    @property
+    def override_count(self) -> int:
+        return len(self.steps_overrides)
+
+    def _analyze(self):
+        meta = load_compiled(os.path.join(os.path.dirname(self.path), sidecar_name(self.name, COMPILED_SUFFIX)),
+                             self.raw)
+        if meta is None:
+            try:
+                meta = analyze(normalize(json.loads(self.raw)))
+            except WorkflowCompileError as e:
+                self.error = str(e)
+                return
+            except ValueError as e:
+                self.error = f"JSON 解析失败: {e}"
+                return
+        self.compiled = meta
+        self.node_count = meta["node_count"]
+        self.checkpoints = tuple(meta["checkpoints"])
+        self.prompt_nodes = tuple(meta["text_nodes"])
+        self.output_nodes = tuple(meta["outputs"])
+
+    def pruned_nodes(self, output_id: str) -> tuple:
+        """
+        以 output_id 为输出时可以删除的节点 ID
+        output_id 不是识别出的输出节点（不存在，或是 VAEDecode 之类的中间节点）时改用主输出，
+        否则会把真正的输出节点裁掉
+        """
+        pruned = self._pruned.get(output_id)
+        if pruned is None:
+            workflow = normalize(self.load())
+            target = output_id if output_id in self.compiled["outputs"] else self.compiled["output"]
+            pruned = self._pruned[output_id] = unreachable(workflow, target)
+            if pruned:
+                logger.info(f"[ComfyUI] 工作流 {self.name} 以节点 {target} 为输出，提交时裁剪 {len(pruned)} 个无关节点")
+        return pruned
+
+    def load(self) -> dict:
+        """返回一份新的工作流字典（调用方可以随意修改）"""
+        if self.error:
+            raise ValueError(f"工作流 {self.name} 无效: {self.error}")
+        return json.loads(self.raw)
+
+
+class WorkflowIndex:
+    def __init__(self, directory: Path, min_interval: float = 1.0):
+        self.directory = Path(directory)
+        self.min_interval = max(float(min_interval), 0.0)
+        self.generation = 0          # 文件列表或内容每变化一次加一
+        self._entries = {}           # 文件名 -> WorkflowEntry
+        self._names = ()
+        self._checked_at = None
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name: str):
+        return name in self._entries
+
+    # ====== 刷新 ======
+    def refresh(self, force: bool = False) -> bool:
+        """重新列目录，只解析新增/改动的文件；返回列表或内容是否有变化"""
+        now = time.monotonic()
+        if not force and self._checked_at is not None and now - self._checked_at < self.min_interval:
+            return False
+        self._checked_at = now
+
+        names = self.list_files()
+
+        changed = tuple(names) != self._names
+        entries = {}
+        for name in names:
+            entry, updated = self._load_entry(name, self._entries.get(name))
+            if entry is None:
+                changed = True
+                continue
+            changed |= updated
+            entries[name] = entry
+        self._entries = entries
+        self._names = tuple(n for n in names if n in entries)
+        if changed:
+            self.generation += 1
+        return changed
+
+    def list_files(self) -> list:
+        """只列出工作流文件名（按名称排序），不读取内容"""
+        try:
+            return sorted(e.name for e in os.scandir(self.directory) if e.is_file() and is_workflow_file(e.name))
+        except OSError:
+            return []
+
+    def _load_entry(self, name: str, cached: WorkflowEntry = None) -> tuple:
+        """按需重新读取，返回 (WorkflowEntry 或 None, 是否有更新)"""
+        # 生成时每次都会走到这里，路径字符串缓存在条目上
+        path = cached.path if cached is not None else os.path.join(self.directory, name)
+        stat = _stat_key(path)
+        if stat is None:
+            return None, cached is not None
+        updated = False
+        entry = cached
+        if entry is None or entry.stat != stat:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    raw = f.read()
+            except (OSError, UnicodeDecodeError) as e:
+                logger.warning(f"[ComfyUI] 读取工作流 {name} 失败: {e}")
+                return None, cached is not None
+            entry = WorkflowEntry(name, path, stat, raw)
+            if entry.error:
+                logger.warning(f"[ComfyUI] 工作流 {name} {entry.error}")
+            updated = True
+        updated |= self._refresh_steps(entry)
+        updated |= self._refresh_seeds(entry)
+        return entry, updated
+
+    def _refresh_steps(self, entry: WorkflowEntry) -> bool:
+        stat = _stat_key(entry.steps_path)
+        if stat == entry.steps_stat and (stat is not None or not entry.steps_overrides):
+            return False
+        overrides = {}
+        if stat is not None:
+            try:
+                with open(entry.steps_path, "r", encoding="utf-8") as f:
+                    overrides = parse_steps_override(json.load(f))
+            except Exception as e:
+                logger.warning(f"[ComfyUI] 读取 steps 覆盖文件失败: {e}")
+        changed = overrides != entry.steps_overrides
+        entry.steps_stat, entry.steps_overrides = stat, overrides
+        return changed
+
+    def _refresh_seeds(self, entry: WorkflowEntry) -> bool:
+        stat = _stat_key(entry.seeds_path)
+        if stat == entry.seeds_stat and (stat is not None or entry.seed_policy is None):
+            return False
+        policy = None
+        if stat is not None:
+            try:
+                with open(entry.seeds_path, "r", encoding="utf-8") as f:
+                    policy = parse_seed_policy(json.load(f))
+            except Exception as e:
+                logger.warning(f"[ComfyUI] 读取种子配置文件失败: {e}")
+        changed = policy != entry.seed_policy
+        entry.seeds_stat, entry.seed_policy = stat, policy
+        return changed
+
+    def invalidate(self, name: str = None):
+        """本进程写了文件之后调用，下次访问时立即重新检查"""
+        self._checked_at = None
+        if name is not None:
+            entry = self._entries.get(name)
+            if entry is not None:
+                entry.stat = entry.steps_stat = entry.seeds_stat = None
+
+    # ====== 查询 ======
+    def names(self) -> tuple:
+        self.refresh()
+        return self._names
+
+    def entries(self) -> list:
+        self.refresh()
+        return [self._entries[name] for name in self._names]
+
+    def get(self, name: str):
+        """取单个工作流（只 stat 该文件及其 sidecar），不存在时返回 None"""
+        entry, updated = self._load_entry(name, self._entries.get(name))
+        if entry is None:
+            if self._entries.pop(name, None) is not None:
+                self._names = tuple(n for n in self._names if n != name)
+                self.generation += 1
+            return None
+        if name not in self._entries:
+            self._entries[name] = entry
+            self._names = tuple(sorted(self._names + (name,)))
+            updated = True
+        if updated:
+            self.generation += 1
+        return entry